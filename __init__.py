@@ -5,7 +5,14 @@ from lnbits.tasks import create_permanent_unique_task
 from loguru import logger
 
 from .crud import db
-from .tasks import wait_for_paid_invoices
+from .tasks import (
+    archive_ledger_periodically,
+    expire_holds_periodically,
+    reconcile_system_totals_periodically,
+    reconcile_topups_periodically,
+    sweep_topups_periodically,
+    wait_for_paid_invoices,
+)
 from .views import bitsatcredit_generic_router
 from .views_api import bitsatcredit_api_router
 
@@ -37,6 +44,16 @@ def bitsatcredit_stop():
 def bitsatcredit_start():
     task = create_permanent_unique_task("ext_bitsatcredit", wait_for_paid_invoices)
     scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_bitsatcredit_holds", expire_holds_periodically)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_bitsatcredit_totals", reconcile_system_totals_periodically)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_bitsatcredit_topups", reconcile_topups_periodically)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_bitsatcredit_topup_sweeper", sweep_topups_periodically)
+    scheduled_tasks.append(task)
+    task = create_permanent_unique_task("ext_bitsatcredit_ledger_archive", archive_ledger_periodically)
+    scheduled_tasks.append(task)
 
 
 __all__ = [
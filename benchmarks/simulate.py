@@ -0,0 +1,329 @@
+# Relay traffic simulator.
+#
+# Replays BitSatRelay-shaped traffic against the real router in-process, on
+# top of the benchmark harness in bench.py:
+#
+#   relays    can-spend then spend per message, skewed towards hot users
+#   passes    a batch spend flush every satellite pass
+#   top-ups   invoices created over the API and paid through the invoice
+#             listener queue, some delivered twice like a replayed event
+#   admin     dashboard polling of stats, users and recent transactions
+#
+# Afterwards every user is checked against the ledger. Exits non-zero when
+# an invariant is violated.
+#
+#   python -m bitsatcredit.benchmarks.simulate --users 10000 --duration 30
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+from loguru import logger
+
+from .. import crud
+from ..crud import SYSTEM_TOTALS_FIELDS, SYSTEM_TOTALS_QUERY
+from ..pubsub import TooManyWaitersError, topup_hub
+from ..tasks import invoice_worker_stats
+from .bench import Bench, bench_npub, open_database, seed_users, summarize
+
+MAX_REPORTED_VIOLATIONS = 20
+SETTLEMENT_TIMEOUT_SECONDS = 30
+
+# per user: the ledger (plus any pruned checkpoint) and the running totals
+# must both add up to what the user holds
+LEDGER_AUDIT_QUERY = """
+    SELECT * FROM (
+        SELECT
+            u.npub,
+            u.balance_sats,
+            u.held_sats,
+            u.total_deposited - u.total_spent as totals_net,
+            COALESCE(l.deposited, 0) + COALESCE(c.deposited_sats, 0)
+                - COALESCE(l.spent, 0) - COALESCE(c.spent_sats, 0) as ledger_net
+        FROM bitsatcredit.users u
+        LEFT JOIN (
+            SELECT
+                npub,
+                SUM(CASE WHEN type = 'deposit' THEN amount_sats ELSE 0 END) as deposited,
+                SUM(CASE WHEN type = 'spend' THEN amount_sats ELSE 0 END) as spent
+            FROM bitsatcredit.transactions
+            GROUP BY npub
+        ) l ON l.npub = u.npub
+        LEFT JOIN bitsatcredit.ledger_checkpoints c ON c.npub = u.npub
+    ) audit
+    WHERE balance_sats < 0
+        OR held_sats < 0
+        OR ledger_net <> balance_sats + held_sats
+        OR totals_net <> balance_sats + held_sats
+"""
+
+
+async def check_invariants(expected_topup_sats: int | None = None) -> list[dict]:
+    """Balance invariants that do not hold, empty when the books add up"""
+    rows: list[dict] = await crud.db.fetchall(LEDGER_AUDIT_QUERY)
+    violations = [{"check": "user_ledger", **dict(row)} for row in rows]
+
+    stored = await crud.get_system_stats()
+    actual: dict = await crud.db.fetchone(SYSTEM_TOTALS_QUERY)
+    drift = {field: stored[field] - actual[field] for field in SYSTEM_TOTALS_FIELDS if stored[field] != actual[field]}
+    if drift:
+        violations.append({"check": "system_totals", "drift": drift})
+
+    if expected_topup_sats is not None:
+        row: dict = await crud.db.fetchone(
+            "SELECT COALESCE(SUM(amount_sats), 0) as paid FROM bitsatcredit.topup_requests WHERE paid = :paid",
+            {"paid": True},
+        )
+        if row["paid"] != expected_topup_sats:
+            violations.append(
+                {"check": "topups_credited", "paid_sats": row["paid"], "expected_sats": expected_topup_sats}
+            )
+    return violations
+
+
+class Simulation(Bench):
+    """One simulated campaign against an already seeded population"""
+
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(args.relays, 0, args.seed)
+        self.args = args
+        self.users = args.users
+        self.hot_users = max(1, int(args.users * args.hot_fraction))
+        self.latencies: dict[str, list[float]] = {}
+        self.counters: Counter = Counter()
+        self.delivered_sats = 0
+        self.deadline = 0.0
+
+    def pick_npub(self) -> str:
+        hot = self.random.random() < self.args.hot_share
+        return bench_npub(self.random.randrange(self.hot_users if hot else self.users))
+
+    def running(self) -> bool:
+        return time.monotonic() < self.deadline
+
+    async def timed(self, operation: str, request):
+        started = time.perf_counter()
+        try:
+            response = await request
+        except Exception:
+            self.counters[f"{operation}_errors"] += 1
+            return None
+        self.latencies.setdefault(operation, []).append(time.perf_counter() - started)
+        return response
+
+    async def relay(self):
+        while self.running():
+            npub = self.pick_npub()
+            amount = self.random.randint(1, self.args.spend_max)
+            response = await self.timed(
+                "can_spend",
+                self.client.get(f"/bitsatcredit/api/v1/user/{npub}/can-spend", params={"amount": amount}),
+            )
+            if response is None or response.status_code != 200:
+                self.counters["errors"] += 1
+                continue
+            if not response.json()["can_afford"]:
+                self.counters["refused"] += 1
+                continue
+
+            response = await self.timed(
+                "spend",
+                self.client.post(f"/bitsatcredit/api/v1/user/{npub}/spend", params={"amount": amount}),
+            )
+            if response is None:
+                self.counters["errors"] += 1
+            elif response.status_code == 200:
+                self.counters["messages"] += 1
+            elif response.status_code == 402:
+                # a concurrent spend got there between the check and the spend
+                self.counters["insufficient_funds"] += 1
+            else:
+                self.counters["errors"] += 1
+
+    async def satellite_passes(self):
+        while self.running():
+            await asyncio.sleep(self.args.pass_interval)
+            items = [
+                {"npub": self.pick_npub(), "amount": self.random.randint(1, self.args.spend_max)}
+                for _ in range(self.args.pass_size)
+            ]
+            response = await self.timed("batch_spend", self.client.post("/bitsatcredit/api/v1/spend/batch", json=items))
+            if response is None or response.status_code != 200:
+                self.counters["errors"] += 1
+                continue
+            for result in response.json():
+                if result["status"] == "spent":
+                    self.counters["messages"] += 1
+                else:
+                    self.counters[result["status"]] += 1
+
+    async def topups(self):
+        while self.running():
+            npub = self.pick_npub()
+            amount = self.args.topup_amount
+            response = await self.timed(
+                "topup_invoice",
+                self.client.post(
+                    "/bitsatcredit/api/v1/topup",
+                    params={"wallet_id": "simulate"},
+                    json={"npub": npub, "amount_sats": amount},
+                ),
+            )
+            if response is None or response.status_code != 200:
+                self.counters["errors"] += 1
+                continue
+            self.counters["topups_created"] += 1
+            payment = SimpleNamespace(
+                payment_hash=response.json()["payment_hash"],
+                amount=amount * 1000,
+                extra={"tag": "bitsatcredit_topup", "npub": npub},
+            )
+            await asyncio.sleep(self.random.uniform(0, self.args.topup_delay))
+
+            assert self.listener_queue
+            try:
+                with topup_hub.subscribe(payment.payment_hash) as credited:
+                    started = time.perf_counter()
+                    await self.listener_queue.put(payment)
+                    self.counters["payments_delivered"] += 1
+                    self.delivered_sats += amount
+                    if self.random.random() < self.args.duplicate_rate:
+                        await self.listener_queue.put(payment)
+                        self.counters["payments_delivered"] += 1
+                    await asyncio.wait_for(credited.wait(), SETTLEMENT_TIMEOUT_SECONDS)
+            except (TooManyWaitersError, asyncio.TimeoutError):
+                self.counters["settlement_timeouts"] += 1
+                continue
+            self.latencies.setdefault("settlement", []).append(time.perf_counter() - started)
+            self.counters["topups_credited"] += 1
+
+    async def admin_dashboard(self):
+        while self.running():
+            await asyncio.sleep(self.args.admin_interval)
+            for operation, path in (
+                ("admin_stats", "/bitsatcredit/api/v1/stats"),
+                ("admin_users", "/bitsatcredit/api/v1/users?limit=50"),
+                ("admin_transactions", "/bitsatcredit/api/v1/transactions/recent?limit=50"),
+            ):
+                response = await self.timed(operation, self.client.get(path))
+                if response is None or response.status_code != 200:
+                    self.counters["errors"] += 1
+
+    async def drain(self, handled_before: int) -> None:
+        """Wait until the workers have handled every delivered payment"""
+        deadline = time.monotonic() + SETTLEMENT_TIMEOUT_SECONDS
+        while time.monotonic() < deadline:
+            stats = invoice_worker_stats.snapshot()
+            if stats["processed"] + stats["failed"] - handled_before >= self.counters["payments_delivered"]:
+                return
+            await asyncio.sleep(0.05)
+        logger.warning("invoice workers did not drain before the invariant check")
+
+    async def run(self) -> dict:
+        args = self.args
+        stats = invoice_worker_stats.snapshot()
+        handled_before = stats["processed"] + stats["failed"]
+
+        started = time.perf_counter()
+        self.deadline = time.monotonic() + args.duration
+        await asyncio.gather(
+            *[self.relay() for _ in range(args.relays)],
+            *[self.topups() for _ in range(args.topup_clients)],
+            self.satellite_passes(),
+            self.admin_dashboard(),
+        )
+        elapsed = time.perf_counter() - started
+        await self.drain(handled_before)
+
+        violations = await check_invariants(self.delivered_sats)
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "messages_per_second": round(self.counters["messages"] / elapsed, 1),
+            "counters": dict(sorted(self.counters.items())),
+            "operations": {
+                operation: summarize(latencies, elapsed, self.counters[f"{operation}_errors"])
+                for operation, latencies in sorted(self.latencies.items())
+            },
+            "invoice_workers": invoice_worker_stats.snapshot(),
+            "violation_count": len(violations),
+            "violations": violations[:MAX_REPORTED_VIOLATIONS],
+        }
+
+
+async def simulate(args: argparse.Namespace) -> dict:
+    """Seed `crud.db` and run one simulation, returns the report"""
+    seeded = time.perf_counter()
+    await seed_users(0, args.users, balance=args.balance, ledger=True)
+    logger.info(f"seeded {args.users} users in {time.perf_counter() - seeded:.1f}s")
+    async with Simulation(args) as simulation:
+        report = await simulation.run()
+
+    for operation, result in report["operations"].items():
+        logger.info(
+            f"{operation:<20} {result['throughput_rps']:>9} req/s "
+            f"p50 {result['p50_ms']}ms p99 {result['p99_ms']}ms errors {result['errors']}"
+        )
+    logger.info(f"{report['messages_per_second']} messages/s, counters {report['counters']}")
+    if report["violation_count"]:
+        logger.error(f"{report['violation_count']} invariant violations, first: {report['violations'][:3]}")
+    else:
+        logger.info("all balance invariants hold")
+    return report
+
+
+async def main(args: argparse.Namespace) -> int:
+    logger.remove()
+    logger.add(lambda message: print(message, end=""), filter=__name__, format="{message}")
+
+    db = await open_database(args.postgres)
+    try:
+        report = await simulate(args)
+    finally:
+        await db.engine.dispose()
+
+    now = datetime.now(timezone.utc)
+    backend = db.type or "unknown"
+    report = {"created_at": now.isoformat(), "backend": backend, "config": vars(args), **report}
+    output = Path(
+        args.output or Path(__file__).parent / "results" / f"{now:%Y%m%dT%H%M%SZ}-simulate-{backend.lower()}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"report written to {output}")
+    return 1 if report["violation_count"] else 0
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Simulate BitSatRelay traffic against BitSatCredit")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--balance", type=int, default=1_000, help="starting balance of every user in sats")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of traffic")
+    parser.add_argument("--relays", type=int, default=16, help="concurrent relay connections")
+    parser.add_argument("--spend-max", type=int, default=10, help="largest per-message spend in sats")
+    parser.add_argument("--hot-fraction", type=float, default=0.01, help="share of users that are hot")
+    parser.add_argument("--hot-share", type=float, default=0.8, help="share of traffic going to hot users")
+    parser.add_argument("--pass-interval", type=float, default=5, help="seconds between satellite pass flushes")
+    parser.add_argument("--pass-size", type=int, default=200, help="messages flushed per pass")
+    parser.add_argument("--topup-clients", type=int, default=4, help="concurrent users topping up")
+    parser.add_argument("--topup-amount", type=int, default=500)
+    parser.add_argument("--topup-delay", type=float, default=0.5, help="max seconds between invoice and payment")
+    parser.add_argument("--duplicate-rate", type=float, default=0.05, help="share of payments delivered twice")
+    parser.add_argument("--admin-interval", type=float, default=2, help="seconds between dashboard polls")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--postgres",
+        action="store_true",
+        help="use the scratch Postgres database in LNBITS_DATABASE_URL, default is a temporary SQLite",
+    )
+    parser.add_argument("--output", help="JSON report path, default benchmarks/results/<timestamp>-simulate.json")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
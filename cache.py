@@ -0,0 +1,79 @@
+# In-process cache of user rows, kept correct by write-through from crud.py
+
+import time
+from collections import OrderedDict
+
+from .models import User
+
+
+class UserCache:
+    """Bounded LRU cache of `User` rows keyed by npub with a TTL.
+
+    Every mutation in crud.py writes the fresh row through (or invalidates
+    it), so the TTL only bounds staleness from writes made outside this
+    extension.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, User]] = OrderedDict()
+
+    def get(self, npub: str) -> User | None:
+        entry = self._entries.get(npub)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[npub]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(npub)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, user: User) -> None:
+        self._entries[user.npub] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user.npub)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, npub: str) -> None:
+        self._entries.pop(npub, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class SettingsSnapshot:
+    """In-process copy of the `system_settings` table.
+
+    `version` changes whenever the snapshot is reloaded, so clients can
+    compare it to see whether anything changed.
+    """
+
+    def __init__(self):
+        self.values: dict[str, str] | None = None
+        self.version = 0
+
+    def load(self, values: dict[str, str]) -> None:
+        self.values = dict(values)
+        self.version = max(self.version + 1, time.time_ns() // 1_000_000)
+
+    def clear(self) -> None:
+        self.values = None
+
+
+user_cache = UserCache()
+settings_snapshot = SettingsSnapshot()
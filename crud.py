@@ -1,36 +1,228 @@
 # Description: This file contains the CRUD operations for talking to the database.
 
+import asyncio
+import sqlite3
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
-from lnbits.db import Database
+from typing import Any
+
+from lnbits.db import SQLITE, Connection, Database
 from lnbits.helpers import urlsafe_short_hash
 from loguru import logger
-
-from .models import User, CreateUser, Transaction, CreateTransaction, TopUpRequest
+from sqlalchemy.sql import text
+
+from .cache import settings_snapshot, user_cache
+from .metrics import instrument_database, topup_sats_paid, topups_created, topups_paid
+from .models import (
+    BatchSpendItem,
+    BatchSpendResult,
+    BulkCreditResult,
+    CreateTransaction,
+    CreateUser,
+    Hold,
+    ImportUserRow,
+    LedgerCheckpoint,
+    TopUpRequest,
+    Transaction,
+    UsageBucket,
+    User,
+)
+from .tracing import annotate, traced
 
 db = Database("ext_bitsatcredit")
+instrument_database(db)
+
+
+@asynccontextmanager
+async def atomic() -> AsyncIterator[Connection]:
+    """Open a connection whose statements commit (or roll back) together.
+
+    `Connection.execute` commits after every statement, so inside this block
+    writes must go through `execute_in` and reads through `conn.fetchone` /
+    `conn.fetchall`, which do not commit.
+    """
+    async with db.connect() as conn:
+        try:
+            yield conn
+            await conn.conn.commit()
+        except BaseException:
+            await conn.conn.rollback()
+            raise
+
+
+async def execute_in(conn: Connection, query: str, values: dict | list[dict] | None = None):
+    """Execute a statement on an `atomic()` connection without committing.
+
+    A list of parameter dicts runs the statement as one executemany batch.
+    """
+    if isinstance(values, list):
+        params: dict | list[dict] = [conn.rewrite_values(v) for v in values]
+    else:
+        params = conn.rewrite_values(values) if values else {}
+    return await conn.conn.execute(text(conn.rewrite_query(query)), params)
+
+
+def supports_returning() -> bool:
+    """Whether the backend returns written rows (Postgres, SQLite 3.35+)"""
+    if db.type == SQLITE:
+        return sqlite3.sqlite_version_info >= (3, 35, 0)
+    return True
+
+
+async def execute_returning(
+    conn: Connection, query: str, values: dict, reread: str, reread_values: dict
+):
+    """Run a single-row write on an `atomic()` connection and return the row.
+
+    Uses `RETURNING *` so the row comes back from the write itself; on a
+    backend without it the row is read again with `reread`. Returns None if
+    nothing was written.
+    """
+    if supports_returning():
+        result = await execute_in(conn, f"{query} RETURNING *", values)
+        return result.mappings().first()
+    result = await execute_in(conn, query, values)
+    if result.rowcount == 0:
+        return None
+    return await conn.fetchone(reread, reread_values)
+
+
+def in_clause(prefix: str, items: list) -> tuple[str, dict]:
+    """Placeholders and values for an `IN (...)` clause"""
+    values = {f"{prefix}{i}": item for i, item in enumerate(items)}
+    return ", ".join(f":{key}" for key in values), values
+
+
+async def bump_system_totals(
+    conn: Connection,
+    users: int = 0,
+    balance: int = 0,
+    held: int = 0,
+    spent: int = 0,
+    deposited: int = 0,
+    messages: int = 0,
+):
+    """Apply user table deltas to the `system_totals` aggregate.
+
+    Must run inside the same `atomic()` block as the change it mirrors.
+    """
+    await execute_in(
+        conn,
+        """
+        UPDATE bitsatcredit.system_totals
+        SET total_users = total_users + :users,
+            total_balance = total_balance + :balance,
+            total_held = total_held + :held,
+            total_spent = total_spent + :spent,
+            total_deposited = total_deposited + :deposited,
+            total_messages = total_messages + :messages
+        WHERE id = 1
+        """,
+        {
+            "users": users,
+            "balance": balance,
+            "held": held,
+            "spent": spent,
+            "deposited": deposited,
+            "messages": messages,
+        },
+    )
+
+
+ROLLUP_BUCKETS = {"hour": 3600, "day": 86400}
+ROLLUP_FIELDS = ("deposit_sats", "deposit_count", "spend_sats", "spend_count", "messages")
+
+
+async def bump_usage_rollups(
+    conn: Connection,
+    deposit_sats: int = 0,
+    deposit_count: int = 0,
+    spend_sats: int = 0,
+    spend_count: int = 0,
+    messages: int = 0,
+):
+    """Add ledger activity to the current hourly and daily rollup buckets.
+
+    Must run inside the same `atomic()` block as the ledger write.
+    """
+    now = int(datetime.now(timezone.utc).timestamp())
+    values = {
+        "deposit_sats": deposit_sats,
+        "deposit_count": deposit_count,
+        "spend_sats": spend_sats,
+        "spend_count": spend_count,
+        "messages": messages,
+    }
+    await execute_in(
+        conn,
+        f"""
+        INSERT INTO bitsatcredit.usage_rollups (bucket, bucket_start, {", ".join(ROLLUP_FIELDS)})
+        VALUES
+            ('hour', :hour_start, :deposit_sats, :deposit_count, :spend_sats, :spend_count, :messages),
+            ('day', :day_start, :deposit_sats, :deposit_count, :spend_sats, :spend_count, :messages)
+        ON CONFLICT (bucket, bucket_start) DO UPDATE SET
+            {", ".join(f"{field} = usage_rollups.{field} + excluded.{field}" for field in ROLLUP_FIELDS)}
+        """,
+        {
+            **values,
+            "hour_start": now - now % ROLLUP_BUCKETS["hour"],
+            "day_start": now - now % ROLLUP_BUCKETS["day"],
+        },
+    )
 
 
 # User operations
+@traced
 async def get_user(npub: str) -> User | None:
+    user = user_cache.get(npub)
+    if user:
+        return user
+    return await _fetch_user(npub)
+
+
+async def _fetch_user(npub: str) -> User | None:
+    """Read a user from the database and refresh the cache"""
     row = await db.fetchone(
         "SELECT * FROM bitsatcredit.users WHERE npub = :npub",
         {"npub": npub},
     )
-    return User(**row) if row else None
+    if not row:
+        return None
+    user = User(**row)
+    user_cache.set(user)
+    return user
 
 
-async def create_user(data: CreateUser) -> User:
-    user_id = await db.execute(
+USER_BY_NPUB = "SELECT * FROM bitsatcredit.users WHERE npub = :npub"
+
+
+async def _insert_user(conn: Connection, npub: str, balance_sats: int = 0, deposited: int = 0, spent: int = 0):
+    """Insert a user on an `atomic()` connection, returns the new row"""
+    row = await execute_returning(
+        conn,
         """
-        INSERT INTO bitsatcredit.users (npub, balance_sats)
-        VALUES (:npub, :balance_sats)
+        INSERT INTO bitsatcredit.users (npub, balance_sats, total_deposited, total_spent)
+        VALUES (:npub, :balance_sats, :deposited, :spent)
         """,
-        {"npub": data.npub, "balance_sats": data.initial_balance},
+        {"npub": npub, "balance_sats": balance_sats, "deposited": deposited, "spent": spent},
+        USER_BY_NPUB,
+        {"npub": npub},
     )
-    user = await get_user(data.npub)
+    await bump_system_totals(conn, users=1, balance=balance_sats, deposited=deposited, spent=spent)
+    return row
+
+
+@traced
+async def create_user(data: CreateUser) -> User:
+    async with atomic() as conn:
+        row = await _insert_user(conn, data.npub, data.initial_balance)
+    user = User(**row)
+    user_cache.set(user)
     return user
 
 
+@traced
 async def get_or_create_user(npub: str) -> User:
     user = await get_user(npub)
     if not user:
@@ -38,59 +230,637 @@ async def get_or_create_user(npub: str) -> User:
     return user
 
 
+@traced
 async def update_user_balance(npub: str, amount_delta: int) -> User:
     """Update user balance (positive for deposit, negative for spend)"""
-    logger.info(f"📊 Updating balance for {npub[:16]}...: delta={amount_delta} sats")
+    async with atomic() as conn:
+        row = await _apply_balance_delta(conn, npub, amount_delta)
+    user = User(**row)
+    user_cache.set(user)
+    annotate(npub=npub, amount_delta=amount_delta, balance_sats=user.balance_sats)
+    return user
 
-    user = await get_or_create_user(npub)
-    old_balance = user.balance_sats
 
-    new_balance = user.balance_sats + amount_delta
-    new_total_deposited = user.total_deposited + (amount_delta if amount_delta > 0 else 0)
-    new_total_spent = user.total_spent + (abs(amount_delta) if amount_delta < 0 else 0)
+async def _apply_balance_delta(conn: Connection, npub: str, amount_delta: int):
+    """Credit or debit a user (created if missing) on an `atomic()` connection.
 
-    await db.execute(
+    The deltas are applied in SQL; returns the updated row.
+    """
+    deposited = amount_delta if amount_delta > 0 else 0
+    spent = abs(amount_delta) if amount_delta < 0 else 0
+
+    row = await execute_returning(
+        conn,
         """
         UPDATE bitsatcredit.users
-        SET balance_sats = :balance_sats,
-            total_deposited = :total_deposited,
-            total_spent = :total_spent,
+        SET balance_sats = balance_sats + :delta,
+            total_deposited = total_deposited + :deposited,
+            total_spent = total_spent + :spent,
             updated_at = :updated_at
         WHERE npub = :npub
         """,
         {
             "npub": npub,
-            "balance_sats": new_balance,
-            "total_deposited": new_total_deposited,
-            "total_spent": new_total_spent,
+            "delta": amount_delta,
+            "deposited": deposited,
+            "spent": spent,
             "updated_at": int(datetime.now(timezone.utc).timestamp()),
         },
+        USER_BY_NPUB,
+        {"npub": npub},
     )
+    if not row:
+        return await _insert_user(conn, npub, amount_delta, deposited, spent)
+    await bump_system_totals(conn, balance=amount_delta, spent=spent, deposited=deposited)
+    return row
+
+
+@traced
+async def increment_message_count(npub: str) -> User | None:
+    async with atomic() as conn:
+        row = await execute_returning(
+            conn,
+            """
+            UPDATE bitsatcredit.users
+            SET message_count = message_count + 1,
+                updated_at = :updated_at
+            WHERE npub = :npub
+            """,
+            {"npub": npub, "updated_at": int(datetime.now(timezone.utc).timestamp())},
+            USER_BY_NPUB,
+            {"npub": npub},
+        )
+        if row:
+            await bump_system_totals(conn, messages=1)
+    if not row:
+        return None
+    user = User(**row)
+    user_cache.set(user)
+    return user
 
-    logger.info(f"✅ Balance updated: {npub[:16]}... {old_balance} → {new_balance} sats")
 
-    user = await get_user(npub)
+@traced
+async def spend_credits(npub: str, amount: int, memo: str | None = None) -> User | None:
+    """Debit a user for a relayed message in a single transaction.
+
+    The balance check is part of the UPDATE, so concurrent spends can never
+    overdraw. Returns the updated user, or None if the user does not exist or
+    cannot afford `amount`. Raises ValueError for an amount below 1 sat.
+    """
+    if amount <= 0:
+        raise ValueError(f"Cannot spend {amount} sats")
+    now = int(datetime.now(timezone.utc).timestamp())
+    async with atomic() as conn:
+        row = await execute_returning(
+            conn,
+            """
+            UPDATE bitsatcredit.users
+            SET balance_sats = balance_sats - :amount,
+                total_spent = total_spent + :amount,
+                message_count = message_count + 1,
+                updated_at = :updated_at
+            WHERE npub = :npub AND balance_sats >= :amount
+            """,
+            {"npub": npub, "amount": amount, "updated_at": now},
+            USER_BY_NPUB,
+            {"npub": npub},
+        )
+        if not row:
+            return None
+        await bump_system_totals(conn, balance=-amount, spent=amount, messages=1)
+        await bump_usage_rollups(conn, spend_sats=amount, spend_count=1, messages=1)
+
+        await execute_in(
+            conn,
+            """
+            INSERT INTO bitsatcredit.transactions (id, npub, type, amount_sats, payment_hash, memo)
+            VALUES (:id, :npub, :type, :amount_sats, :payment_hash, :memo)
+            """,
+            {
+                "id": urlsafe_short_hash(),
+                "npub": npub,
+                "type": "spend",
+                "amount_sats": amount,
+                "payment_hash": None,
+                "memo": memo,
+            },
+        )
+    user = User(**row)
+    user_cache.set(user)
     return user
 
 
-async def increment_message_count(npub: str) -> User:
-    await db.execute(
+@traced
+async def spend_credits_batch(items: list[BatchSpendItem]) -> list[BatchSpendResult]:
+    """Apply a batch of relay spends in one transaction, in order.
+
+    Items whose idempotency key is already in the ledger (or earlier in the
+    batch) are reported as duplicates and not charged again.
+    """
+    now = int(datetime.now(timezone.utc).timestamp())
+    keys = [item.idempotency_key for item in items if item.idempotency_key]
+    npubs = list({item.npub for item in items})
+    statuses: list[str] = []
+    ledger: list[dict] = []
+
+    async with atomic() as conn:
+        seen_keys: set[str] = set()
+        if keys:
+            placeholders, values = in_clause("key", keys)
+            rows = await conn.fetchall(
+                f"""
+                SELECT idempotency_key FROM bitsatcredit.transactions
+                WHERE idempotency_key IN ({placeholders})
+                """,
+                values,
+            )
+            seen_keys = {row["idempotency_key"] for row in rows}
+
+        for item in items:
+            if item.idempotency_key and item.idempotency_key in seen_keys:
+                statuses.append("duplicate")
+                continue
+
+            result = await execute_in(
+                conn,
+                """
+                UPDATE bitsatcredit.users
+                SET balance_sats = balance_sats - :amount,
+                    total_spent = total_spent + :amount,
+                    message_count = message_count + 1,
+                    updated_at = :updated_at
+                WHERE npub = :npub AND balance_sats >= :amount
+                """,
+                {"npub": item.npub, "amount": item.amount, "updated_at": now},
+            )
+            if result.rowcount == 0:
+                statuses.append("insufficient_funds")
+                continue
+
+            statuses.append("spent")
+            if item.idempotency_key:
+                seen_keys.add(item.idempotency_key)
+            ledger.append(
+                {
+                    "id": urlsafe_short_hash(),
+                    "npub": item.npub,
+                    "type": "spend",
+                    "amount_sats": item.amount,
+                    "memo": item.memo,
+                    "idempotency_key": item.idempotency_key,
+                }
+            )
+
+        if ledger:
+            await execute_in(
+                conn,
+                """
+                INSERT INTO bitsatcredit.transactions (id, npub, type, amount_sats, memo, idempotency_key)
+                VALUES (:id, :npub, :type, :amount_sats, :memo, :idempotency_key)
+                """,
+                ledger,
+            )
+            spent = sum(row["amount_sats"] for row in ledger)
+            await bump_system_totals(conn, balance=-spent, spent=spent, messages=len(ledger))
+            await bump_usage_rollups(conn, spend_sats=spent, spend_count=len(ledger), messages=len(ledger))
+
+        placeholders, values = in_clause("npub", npubs)
+        rows = await conn.fetchall(
+            f"SELECT * FROM bitsatcredit.users WHERE npub IN ({placeholders})",
+            values,
+        )
+    balances = {}
+    for row in rows:
+        user = User(**row)
+        user_cache.set(user)
+        balances[user.npub] = user.balance_sats
+
+    return [
+        BatchSpendResult(
+            npub=item.npub,
+            amount=item.amount,
+            idempotency_key=item.idempotency_key,
+            status="not_found" if item.npub not in balances else status,
+            balance_sats=balances.get(item.npub),
+        )
+        for item, status in zip(items, statuses, strict=True)
+    ]
+
+
+BULK_CHUNK_SIZE = 500
+
+
+@traced
+async def get_npubs(active_since: int | None = None, limit: int = 10_000) -> list[str]:
+    """Npubs of all users, or of those updated at or after `active_since`"""
+    where = "WHERE updated_at >= :active_since" if active_since is not None else ""
+    rows = await db.fetchall(
+        f"""
+        SELECT npub FROM bitsatcredit.users
+        {where}
+        ORDER BY updated_at DESC, npub DESC
+        LIMIT :limit
+        """,
+        {"active_since": active_since, "limit": limit},
+    )
+    return [row["npub"] for row in rows]
+
+
+@traced
+async def add_credits_batch(npubs: list[str], amount: int, memo: str | None = None) -> list[BulkCreditResult]:
+    """Credit `amount` to every npub (creating missing users) in one transaction.
+
+    Users, balances and deposit ledger rows are written with batched
+    statements; an npub listed twice is credited once and reported as
+    `duplicate` the second time.
+    """
+    unique = list(dict.fromkeys(npubs))
+    now = int(datetime.now(timezone.utc).timestamp())
+    chunks = [unique[i : i + BULK_CHUNK_SIZE] for i in range(0, len(unique), BULK_CHUNK_SIZE)]
+
+    async with atomic() as conn:
+        existing: set[str] = set()
+        for chunk in chunks:
+            placeholders, values = in_clause("npub", chunk)
+            rows = await conn.fetchall(
+                f"SELECT npub FROM bitsatcredit.users WHERE npub IN ({placeholders})",
+                values,
+            )
+            existing.update(row["npub"] for row in rows)
+
+        missing = [npub for npub in unique if npub not in existing]
+        if missing:
+            await execute_in(
+                conn,
+                "INSERT INTO bitsatcredit.users (npub, balance_sats) VALUES (:npub, 0)",
+                [{"npub": npub} for npub in missing],
+            )
+        if unique:
+            await execute_in(
+                conn,
+                """
+                UPDATE bitsatcredit.users
+                SET balance_sats = balance_sats + :amount,
+                    total_deposited = total_deposited + :amount,
+                    updated_at = :updated_at
+                WHERE npub = :npub
+                """,
+                [{"npub": npub, "amount": amount, "updated_at": now} for npub in unique],
+            )
+            await execute_in(
+                conn,
+                """
+                INSERT INTO bitsatcredit.transactions (id, npub, type, amount_sats, memo)
+                VALUES (:id, :npub, 'deposit', :amount_sats, :memo)
+                """,
+                [
+                    {"id": urlsafe_short_hash(), "npub": npub, "amount_sats": amount, "memo": memo}
+                    for npub in unique
+                ],
+            )
+            total = amount * len(unique)
+            await bump_system_totals(conn, users=len(missing), balance=total, deposited=total)
+            await bump_usage_rollups(conn, deposit_sats=total, deposit_count=len(unique))
+
+        users: dict[str, User] = {}
+        for chunk in chunks:
+            placeholders, values = in_clause("npub", chunk)
+            rows = await conn.fetchall(
+                f"SELECT * FROM bitsatcredit.users WHERE npub IN ({placeholders})",
+                values,
+            )
+            users.update((row["npub"], User(**row)) for row in rows)
+
+    for user in users.values():
+        user_cache.set(user)
+
+    results = []
+    seen: set[str] = set()
+    for npub in npubs:
+        status = "duplicate" if npub in seen else "credited" if npub in existing else "created"
+        seen.add(npub)
+        results.append(BulkCreditResult(npub=npub, status=status, balance_sats=users[npub].balance_sats))
+    logger.info(f"💸 Bulk credited {amount} sats to {len(unique)} users ({len(missing)} new)")
+    return results
+
+
+IMPORT_FIELDS = ("balance_sats", "total_spent", "total_deposited", "message_count", "memo")
+
+
+@traced
+async def import_users_batch(rows: list[ImportUserRow], dry_run: bool = False) -> list[dict]:
+    """Upsert a batch of imported users in one transaction, returns a diff per row.
+
+    Balances are set to the imported value and the difference is written to
+    the ledger as a deposit or spend. Totals left out of a row move with
+    that difference, a missing memo keeps the current one. The batch must
+    not repeat an npub. With `dry_run` only the diff is computed.
+    """
+    now = int(datetime.now(timezone.utc).timestamp())
+    placeholders, values = in_clause("npub", [row.npub for row in rows])
+    async with atomic() as conn:
+        existing = {
+            row["npub"]: row
+            for row in await conn.fetchall(
+                f"SELECT * FROM bitsatcredit.users WHERE npub IN ({placeholders})",
+                values,
+            )
+        }
+
+        diffs: list[dict[str, Any]] = []
+        upserts: list[dict[str, Any]] = []
+        ledger: list[dict[str, Any]] = []
+        for row in rows:
+            old = existing.get(row.npub)
+            before: dict[str, Any] | None = {field: old[field] for field in IMPORT_FIELDS} if old else None
+            delta = row.balance_sats - (old["balance_sats"] if old else 0)
+            after: dict[str, Any] = {
+                "balance_sats": row.balance_sats,
+                "total_spent": row.total_spent
+                if row.total_spent is not None
+                else (old["total_spent"] if old else 0) + max(-delta, 0),
+                "total_deposited": row.total_deposited
+                if row.total_deposited is not None
+                else (old["total_deposited"] if old else 0) + max(delta, 0),
+                "message_count": row.message_count
+                if row.message_count is not None
+                else (old["message_count"] if old else 0),
+                "memo": row.memo if row.memo is not None else (old["memo"] if old else None),
+            }
+            action = "create" if not old else "unchanged" if after == before else "update"
+            diffs.append({"npub": row.npub, "action": action, "before": before, "after": after})
+            if action == "unchanged":
+                continue
+            upserts.append({"npub": row.npub, **after, "updated_at": now})
+            if delta:
+                ledger.append(
+                    {
+                        "id": urlsafe_short_hash(),
+                        "npub": row.npub,
+                        "type": "deposit" if delta > 0 else "spend",
+                        "amount_sats": abs(delta),
+                        "memo": "Balance import",
+                    }
+                )
+
+        if dry_run or not upserts:
+            return diffs
+
+        rows_sql, params = [], {}
+        for i, upsert in enumerate(upserts):
+            rows_sql.append(
+                f"(:npub{i}, :balance_sats{i}, :total_spent{i}, :total_deposited{i},"
+                f" :message_count{i}, :memo{i}, :updated_at{i})"
+            )
+            params.update({f"{key}{i}": value for key, value in upsert.items()})
+        await execute_in(
+            conn,
+            f"""
+            INSERT INTO bitsatcredit.users
+                (npub, balance_sats, total_spent, total_deposited, message_count, memo, updated_at)
+            VALUES {", ".join(rows_sql)}
+            ON CONFLICT (npub) DO UPDATE SET
+                balance_sats = excluded.balance_sats,
+                total_spent = excluded.total_spent,
+                total_deposited = excluded.total_deposited,
+                message_count = excluded.message_count,
+                memo = excluded.memo,
+                updated_at = excluded.updated_at
+            """,
+            params,
+        )
+        if ledger:
+            rows_sql, params = [], {}
+            for i, entry in enumerate(ledger):
+                rows_sql.append(f"(:id{i}, :npub{i}, :type{i}, :amount_sats{i}, :memo{i})")
+                params.update({f"{key}{i}": value for key, value in entry.items()})
+            await execute_in(
+                conn,
+                f"""
+                INSERT INTO bitsatcredit.transactions (id, npub, type, amount_sats, memo)
+                VALUES {", ".join(rows_sql)}
+                """,
+                params,
+            )
+
+        changed = [diff for diff in diffs if diff["action"] != "unchanged"]
+
+        def total(field: str) -> int:
+            return sum(d["after"][field] - (d["before"][field] if d["before"] else 0) for d in changed)
+
+        await bump_system_totals(
+            conn,
+            users=sum(1 for diff in changed if diff["action"] == "create"),
+            balance=total("balance_sats"),
+            spent=total("total_spent"),
+            deposited=total("total_deposited"),
+            messages=total("message_count"),
+        )
+        deposits = [entry["amount_sats"] for entry in ledger if entry["type"] == "deposit"]
+        spends = [entry["amount_sats"] for entry in ledger if entry["type"] == "spend"]
+        await bump_usage_rollups(
+            conn,
+            deposit_sats=sum(deposits),
+            deposit_count=len(deposits),
+            spend_sats=sum(spends),
+            spend_count=len(spends),
+        )
+
+    for upsert in upserts:
+        user_cache.invalidate(upsert["npub"])
+    return diffs
+
+
+# Credit hold operations
+@traced
+async def create_hold(npub: str, amount: int, ttl_seconds: int, memo: str | None = None) -> Hold | None:
+    """Move sats from the available balance into a hold.
+
+    Returns None if the user does not exist or cannot afford `amount`.
+    """
+    now = int(datetime.now(timezone.utc).timestamp())
+    hold_id = urlsafe_short_hash()
+    async with atomic() as conn:
+        result = await execute_in(
+            conn,
+            """
+            UPDATE bitsatcredit.users
+            SET balance_sats = balance_sats - :amount,
+                held_sats = held_sats + :amount,
+                updated_at = :updated_at
+            WHERE npub = :npub AND balance_sats >= :amount
+            """,
+            {"npub": npub, "amount": amount, "updated_at": now},
+        )
+        if result.rowcount == 0:
+            return None
+        await bump_system_totals(conn, balance=-amount, held=amount)
+
+        await execute_in(
+            conn,
+            """
+            INSERT INTO bitsatcredit.holds (id, npub, amount_sats, status, memo, expires_at)
+            VALUES (:id, :npub, :amount_sats, 'held', :memo, :expires_at)
+            """,
+            {
+                "id": hold_id,
+                "npub": npub,
+                "amount_sats": amount,
+                "memo": memo,
+                "expires_at": now + ttl_seconds,
+            },
+        )
+        hold_row = await conn.fetchone(
+            "SELECT * FROM bitsatcredit.holds WHERE id = :id",
+            {"id": hold_id},
+        )
+        user_row = await conn.fetchone(
+            "SELECT * FROM bitsatcredit.users WHERE npub = :npub",
+            {"npub": npub},
+        )
+    user_cache.set(User(**user_row))
+    return Hold(**hold_row)
+
+
+@traced
+async def get_hold(hold_id: str) -> Hold | None:
+    row = await db.fetchone(
+        "SELECT * FROM bitsatcredit.holds WHERE id = :id",
+        {"id": hold_id},
+    )
+    return Hold(**row) if row else None
+
+
+@traced
+async def settle_hold(
+    hold_id: str,
+    status: str,
+    capture_amount: int = 0,
+    messages: int = 0,
+    memo: str | None = None,
+) -> Hold | None:
+    """Finalise a hold: capture part or all of it, release the remainder.
+
+    `status` is 'captured', 'released' or 'expired'. Only a hold that is
+    still 'held' can be settled; returns None otherwise. A hold past its
+    TTL can no longer be captured or released: it is expired on the spot,
+    returning the sats to the balance, and None is returned.
+    """
+    now = int(datetime.now(timezone.utc).timestamp())
+    async with atomic() as conn:
+        row = await conn.fetchone(
+            "SELECT * FROM bitsatcredit.holds WHERE id = :id",
+            {"id": hold_id},
+        )
+        if not row:
+            return None
+        hold = Hold(**row)
+        if capture_amount > hold.amount_sats:
+            raise ValueError(f"Cannot capture {capture_amount} sats from a {hold.amount_sats} sat hold")
+        lapsed = status != "expired" and hold.expires_at <= now
+        if lapsed:
+            status, capture_amount, messages = "expired", 0, 0
+
+        result = await execute_in(
+            conn,
+            """
+            UPDATE bitsatcredit.holds
+            SET status = :status, captured_sats = :captured_sats, settled_at = :settled_at
+            WHERE id = :id AND status = 'held' AND (:status = 'expired' OR expires_at > :now)
+            """,
+            {"id": hold_id, "status": status, "captured_sats": capture_amount, "settled_at": now, "now": now},
+        )
+        if result.rowcount == 0:
+            return None
+
+        await execute_in(
+            conn,
+            """
+            UPDATE bitsatcredit.users
+            SET held_sats = held_sats - :held,
+                balance_sats = balance_sats + :released,
+                total_spent = total_spent + :captured,
+                message_count = message_count + :messages,
+                updated_at = :updated_at
+            WHERE npub = :npub
+            """,
+            {
+                "npub": hold.npub,
+                "held": hold.amount_sats,
+                "released": hold.amount_sats - capture_amount,
+                "captured": capture_amount,
+                "messages": messages,
+                "updated_at": now,
+            },
+        )
+        await bump_system_totals(
+            conn,
+            balance=hold.amount_sats - capture_amount,
+            held=-hold.amount_sats,
+            spent=capture_amount,
+            messages=messages,
+        )
+        if capture_amount:
+            await bump_usage_rollups(conn, spend_sats=capture_amount, spend_count=1, messages=messages)
+            await execute_in(
+                conn,
+                """
+                INSERT INTO bitsatcredit.transactions (id, npub, type, amount_sats, memo)
+                VALUES (:id, :npub, 'spend', :amount_sats, :memo)
+                """,
+                {
+                    "id": urlsafe_short_hash(),
+                    "npub": hold.npub,
+                    "amount_sats": capture_amount,
+                    "memo": memo or hold.memo,
+                },
+            )
+
+        hold_row = await conn.fetchone(
+            "SELECT * FROM bitsatcredit.holds WHERE id = :id",
+            {"id": hold_id},
+        )
+        user_row = await conn.fetchone(
+            "SELECT * FROM bitsatcredit.users WHERE npub = :npub",
+            {"npub": hold.npub},
+        )
+    if user_row:
+        user_cache.set(User(**user_row))
+    return None if lapsed else Hold(**hold_row)
+
+
+@traced
+async def expire_holds(limit: int = 500) -> int:
+    """Release holds whose TTL has passed, returns how many were expired"""
+    rows = await db.fetchall(
         """
-        UPDATE bitsatcredit.users
-        SET message_count = message_count + 1,
-            updated_at = :updated_at
-        WHERE npub = :npub
+        SELECT id FROM bitsatcredit.holds
+        WHERE status = 'held' AND expires_at < :now
+        ORDER BY expires_at
+        LIMIT :limit
         """,
-        {"npub": npub, "updated_at": int(datetime.now(timezone.utc).timestamp())},
+        {"now": int(datetime.now(timezone.utc).timestamp()), "limit": limit},
     )
-    user = await get_user(npub)
-    return user
+    expired = 0
+    for row in rows:
+        if await settle_hold(row["id"], "expired"):
+            expired += 1
+    return expired
 
 
 # Transaction operations
+@traced
 async def create_transaction(data: CreateTransaction) -> Transaction:
+    async with atomic() as conn:
+        row = await _insert_transaction(conn, data)
+    return Transaction(**row)
+
+
+async def _insert_transaction(conn: Connection, data: CreateTransaction):
+    """Write a ledger row and its usage rollups on an `atomic()` connection, returns the row"""
     tx_id = urlsafe_short_hash()
-    await db.execute(
+    row = await execute_returning(
+        conn,
         """
         INSERT INTO bitsatcredit.transactions (id, npub, type, amount_sats, payment_hash, memo)
         VALUES (:id, :npub, :type, :amount_sats, :payment_hash, :memo)
@@ -103,48 +873,68 @@ async def create_transaction(data: CreateTransaction) -> Transaction:
             "payment_hash": data.payment_hash,
             "memo": data.memo,
         },
-    )
-    row = await db.fetchone(
         "SELECT * FROM bitsatcredit.transactions WHERE id = :id",
         {"id": tx_id},
     )
-    return Transaction(**row)
-
-
-async def get_user_transactions(npub: str) -> list[Transaction]:
+    if data.type == "deposit":
+        await bump_usage_rollups(conn, deposit_sats=data.amount_sats, deposit_count=1)
+    elif data.type == "spend":
+        await bump_usage_rollups(conn, spend_sats=data.amount_sats, spend_count=1)
+    return row
+
+
+@traced
+async def get_user_transactions(
+    npub: str, limit: int = 100, after: tuple[int, str] | None = None
+) -> list[Transaction]:
+    """User's transactions, newest first, strictly after the `(created_at, id)` keyset"""
+    values: dict = {"npub": npub, "limit": limit}
+    keyset = ""
+    if after:
+        keyset = "AND (created_at, id) < (:after_created_at, :after_id)"
+        values.update(after_created_at=after[0], after_id=after[1])
     rows = await db.fetchall(
-        """
+        f"""
         SELECT * FROM bitsatcredit.transactions
-        WHERE npub = :npub
-        ORDER BY created_at DESC
-        LIMIT 100
+        WHERE npub = :npub {keyset}
+        ORDER BY created_at DESC, id DESC
+        LIMIT :limit
         """,
-        {"npub": npub},
+        values,
     )
     return [Transaction(**row) for row in rows]
 
 
 # Top-up operations
-async def create_topup_request(npub: str, amount_sats: int, payment_hash: str, bolt11: str) -> TopUpRequest:
+@traced
+async def create_topup_request(
+    npub: str, amount_sats: int, payment_hash: str, bolt11: str, expires_at: int | None = None
+) -> TopUpRequest:
     topup_id = urlsafe_short_hash()
-    await db.execute(
-        """
-        INSERT INTO bitsatcredit.topup_requests (id, npub, amount_sats, payment_hash, bolt11, paid)
-        VALUES (:id, :npub, :amount_sats, :payment_hash, :bolt11, :paid)
-        """,
-        {
-            "id": topup_id,
-            "npub": npub,
-            "amount_sats": amount_sats,
-            "payment_hash": payment_hash,
-            "bolt11": bolt11,
-            "paid": False,
-        },
-    )
-    topup = await get_topup_by_payment_hash(payment_hash)
-    return topup
-
-
+    async with atomic() as conn:
+        row = await execute_returning(
+            conn,
+            """
+            INSERT INTO bitsatcredit.topup_requests (id, npub, amount_sats, payment_hash, bolt11, paid, expires_at)
+            VALUES (:id, :npub, :amount_sats, :payment_hash, :bolt11, :paid, :expires_at)
+            """,
+            {
+                "id": topup_id,
+                "npub": npub,
+                "amount_sats": amount_sats,
+                "payment_hash": payment_hash,
+                "bolt11": bolt11,
+                "paid": False,
+                "expires_at": expires_at,
+            },
+            "SELECT * FROM bitsatcredit.topup_requests WHERE id = :id",
+            {"id": topup_id},
+        )
+    topups_created.inc()
+    return TopUpRequest(**row)
+
+
+@traced
 async def get_topup_by_payment_hash(payment_hash: str) -> TopUpRequest | None:
     row = await db.fetchone(
         "SELECT * FROM bitsatcredit.topup_requests WHERE payment_hash = :payment_hash",
@@ -153,182 +943,692 @@ async def get_topup_by_payment_hash(payment_hash: str) -> TopUpRequest | None:
     return TopUpRequest(**row) if row else None
 
 
-async def mark_topup_paid(payment_hash: str):
-    """Mark top-up as paid and credit user"""
-    logger.info(f"🔍 Looking up top-up request for payment_hash: {payment_hash}")
-
-    topup = await get_topup_by_payment_hash(payment_hash)
-    if not topup:
-        logger.error(f"❌ No top-up request found for payment_hash: {payment_hash}")
-        return
-
-    if topup.paid:
-        logger.warning(f"⚠️ Top-up already marked as paid: {payment_hash}")
-        return
-
-    logger.info(f"💾 Marking top-up as paid: {topup.id}, npub: {topup.npub[:16]}..., amount: {topup.amount_sats}")
-
-    # Mark paid
-    await db.execute(
-        """
-        UPDATE bitsatcredit.topup_requests
-        SET paid = :paid, paid_at = :paid_at
-        WHERE payment_hash = :payment_hash
+@traced
+async def get_unpaid_topups(
+    since: int, limit: int = 100, after: tuple[int, str] | None = None
+) -> list[TopUpRequest]:
+    """Unpaid top-ups created at or after `since`, oldest first, strictly after the `(created_at, id)` keyset"""
+    values: dict = {"since": since, "limit": limit}
+    keyset = ""
+    if after:
+        keyset = "AND (created_at, id) > (:after_created_at, :after_id)"
+        values.update(after_created_at=after[0], after_id=after[1])
+    rows = await db.fetchall(
+        f"""
+        SELECT * FROM bitsatcredit.topup_requests
+        WHERE paid = FALSE AND created_at >= :since {keyset}
+        ORDER BY created_at, id
+        LIMIT :limit
         """,
-        {
-            "paid": True,
-            "paid_at": int(datetime.now(timezone.utc).timestamp()),
-            "payment_hash": payment_hash,
-        },
+        values,
     )
+    return [TopUpRequest(**row) for row in rows]
+
+
+@traced
+async def mark_topup_paid(payment_hash: str) -> bool:
+    """Mark top-up as paid and credit user, all in one transaction.
+
+    The `paid = FALSE -> TRUE` transition is conditional, so replaying the
+    same payment is a no-op. Returns True only if this call credited the
+    user.
+    """
+    now = int(datetime.now(timezone.utc).timestamp())
+    async with atomic() as conn:
+        row = await execute_returning(
+            conn,
+            """
+            UPDATE bitsatcredit.topup_requests
+            SET paid = :paid, paid_at = :paid_at
+            WHERE payment_hash = :payment_hash AND paid = :unpaid
+            """,
+            {"paid": True, "unpaid": False, "paid_at": now, "payment_hash": payment_hash},
+            "SELECT * FROM bitsatcredit.topup_requests WHERE payment_hash = :payment_hash",
+            {"payment_hash": payment_hash},
+        )
+        if not row:
+            if await conn.fetchone(
+                "SELECT id FROM bitsatcredit.topup_requests WHERE payment_hash = :payment_hash",
+                {"payment_hash": payment_hash},
+            ):
+                logger.warning(f"⚠️ Top-up already marked as paid: {payment_hash}")
+            else:
+                logger.error(f"❌ No top-up request found for payment_hash: {payment_hash}")
+            return False
+
+        topup = TopUpRequest(**row)
+        user_row = await _apply_balance_delta(conn, topup.npub, topup.amount_sats)
+        await _insert_transaction(
+            conn,
+            CreateTransaction(
+                npub=topup.npub,
+                type="deposit",
+                amount_sats=topup.amount_sats,
+                payment_hash=payment_hash,
+                memo=f"Top-up: {topup.amount_sats} sats"
+            ),
+        )
+    user_cache.set(User(**user_row))
+    topups_paid.inc()
+    topup_sats_paid.inc(amount=topup.amount_sats)
+    annotate(npub=topup.npub, amount_sats=topup.amount_sats)
+    return True
 
-    logger.info(f"💰 Updating user balance: {topup.npub[:16]}... +{topup.amount_sats} sats")
-
-    # Credit user
-    await update_user_balance(topup.npub, topup.amount_sats)
-
-    logger.info(f"📝 Creating transaction record")
-
-    # Create transaction record
-    await create_transaction(CreateTransaction(
-        npub=topup.npub,
-        type="deposit",
-        amount_sats=topup.amount_sats,
-        payment_hash=payment_hash,
-        memo=f"Top-up: {topup.amount_sats} sats"
-    ))
 
-    logger.info(f"✅ Top-up completed: {topup.npub[:16]}... credited with {topup.amount_sats} sats")
+@traced
+async def expire_topups(chunk_size: int = 500) -> int:
+    """Mark unpaid top-ups past their invoice expiry as expired.
+
+    Works in chunks of `chunk_size`, each its own short transaction, and
+    returns how many were marked.
+    """
+    now = int(datetime.now(timezone.utc).timestamp())
+    expired = 0
+    while True:
+        async with atomic() as conn:
+            rows = await conn.fetchall(
+                """
+                SELECT id FROM bitsatcredit.topup_requests
+                WHERE paid = FALSE AND expired = FALSE AND expires_at < :now
+                LIMIT :limit
+                """,
+                {"now": now, "limit": chunk_size},
+            )
+            if rows:
+                placeholders, values = in_clause("id", [row["id"] for row in rows])
+                await execute_in(
+                    conn,
+                    f"UPDATE bitsatcredit.topup_requests SET expired = TRUE WHERE id IN ({placeholders})",
+                    values,
+                )
+        expired += len(rows)
+        if len(rows) < chunk_size:
+            return expired
+        # let other queries take the connection between chunks
+        await asyncio.sleep(0)
+
+
+@traced
+async def compact_topups(older_than: int, archive: bool = True, chunk_size: int = 500) -> int:
+    """Remove unpaid top-ups created before `older_than` from the hot table.
+
+    With `archive` the rows are first copied (without the bolt11) into
+    `topup_requests_archive`. Works in bounded chunks and returns how many
+    rows were removed.
+    """
+    removed = 0
+    while True:
+        async with atomic() as conn:
+            rows = await conn.fetchall(
+                """
+                SELECT id FROM bitsatcredit.topup_requests
+                WHERE paid = FALSE AND created_at < :older_than
+                ORDER BY created_at, id
+                LIMIT :limit
+                """,
+                {"older_than": older_than, "limit": chunk_size},
+            )
+            if rows:
+                placeholders, values = in_clause("id", [row["id"] for row in rows])
+                if archive:
+                    await execute_in(
+                        conn,
+                        f"""
+                        INSERT INTO bitsatcredit.topup_requests_archive
+                            (id, npub, amount_sats, payment_hash, created_at, expires_at)
+                        SELECT id, npub, amount_sats, payment_hash, created_at, expires_at
+                        FROM bitsatcredit.topup_requests
+                        WHERE id IN ({placeholders})
+                        """,
+                        values,
+                    )
+                await execute_in(
+                    conn,
+                    f"DELETE FROM bitsatcredit.topup_requests WHERE id IN ({placeholders})",
+                    values,
+                )
+        removed += len(rows)
+        if len(rows) < chunk_size:
+            return removed
+        await asyncio.sleep(0)
 
 
 # Admin/Stats operations
+@traced
 async def delete_user(npub: str) -> bool:
     """Delete user and all related records"""
     logger.info(f"🗑️ Deleting user: {npub[:16]}...")
 
-    # Delete transactions
-    await db.execute(
-        "DELETE FROM bitsatcredit.transactions WHERE npub = :npub",
-        {"npub": npub}
-    )
-
-    # Delete top-up requests
-    await db.execute(
-        "DELETE FROM bitsatcredit.topup_requests WHERE npub = :npub",
-        {"npub": npub}
-    )
-
-    # Delete user
-    await db.execute(
-        "DELETE FROM bitsatcredit.users WHERE npub = :npub",
-        {"npub": npub}
-    )
+    async with atomic() as conn:
+        # Delete transactions
+        await execute_in(
+            conn,
+            "DELETE FROM bitsatcredit.transactions WHERE npub = :npub",
+            {"npub": npub}
+        )
+
+        # Delete top-up requests
+        await execute_in(
+            conn,
+            "DELETE FROM bitsatcredit.topup_requests WHERE npub = :npub",
+            {"npub": npub}
+        )
+
+        await execute_in(
+            conn,
+            "DELETE FROM bitsatcredit.topup_requests_archive WHERE npub = :npub",
+            {"npub": npub}
+        )
+
+        await execute_in(
+            conn,
+            "DELETE FROM bitsatcredit.ledger_checkpoints WHERE npub = :npub",
+            {"npub": npub}
+        )
+
+        # Delete credit holds
+        await execute_in(
+            conn,
+            "DELETE FROM bitsatcredit.holds WHERE npub = :npub",
+            {"npub": npub}
+        )
+
+        # Delete user and take it out of the totals
+        row = await conn.fetchone(
+            "SELECT * FROM bitsatcredit.users WHERE npub = :npub",
+            {"npub": npub},
+        )
+        if row:
+            await execute_in(
+                conn,
+                "DELETE FROM bitsatcredit.users WHERE npub = :npub",
+                {"npub": npub}
+            )
+            await bump_system_totals(
+                conn,
+                users=-1,
+                balance=-row["balance_sats"],
+                held=-row["held_sats"],
+                spent=-row["total_spent"],
+                deposited=-row["total_deposited"],
+                messages=-row["message_count"],
+            )
+    user_cache.invalidate(npub)
 
     logger.info(f"✅ User deleted: {npub[:16]}...")
     return True
 
 
+@traced
 async def update_user_stats(npub: str, total_spent: int = None, total_deposited: int = None, message_count: int = None) -> User:
     """Update user statistics (admin function)"""
     logger.info(f"📝 Updating user stats: {npub[:16]}...")
 
-    user = await get_user(npub)
-    if not user:
-        raise ValueError(f"User {npub} not found")
-
     # Build update query dynamically
     updates = []
+    totals = []
     params = {"npub": npub, "updated_at": int(datetime.now(timezone.utc).timestamp())}
 
-    if total_spent is not None:
-        updates.append("total_spent = :total_spent")
-        params["total_spent"] = total_spent
-
-    if total_deposited is not None:
-        updates.append("total_deposited = :total_deposited")
-        params["total_deposited"] = total_deposited
-
-    if message_count is not None:
-        updates.append("message_count = :message_count")
-        params["message_count"] = message_count
+    for field, total, value in (
+        ("total_spent", "total_spent", total_spent),
+        ("total_deposited", "total_deposited", total_deposited),
+        ("message_count", "total_messages", message_count),
+    ):
+        if value is not None:
+            updates.append(f"{field} = :{field}")
+            # the diff against the current row is taken in SQL, before the update
+            totals.append(
+                f"{total} = {total} + COALESCE(:{field} - "
+                f"(SELECT {field} FROM bitsatcredit.users WHERE npub = :npub), 0)"
+            )
+            params[field] = value
 
     if not updates:
+        user = await get_user(npub)
+        if not user:
+            raise ValueError(f"User {npub} not found")
         return user
 
     updates.append("updated_at = :updated_at")
 
-    await db.execute(
-        f"""
-        UPDATE bitsatcredit.users
-        SET {", ".join(updates)}
-        WHERE npub = :npub
-        """,
-        params
-    )
+    async with atomic() as conn:
+        await execute_in(
+            conn,
+            f"UPDATE bitsatcredit.system_totals SET {', '.join(totals)} WHERE id = 1",
+            params,
+        )
+        row = await execute_returning(
+            conn,
+            f"""
+            UPDATE bitsatcredit.users
+            SET {", ".join(updates)}
+            WHERE npub = :npub
+            """,
+            params,
+            USER_BY_NPUB,
+            {"npub": npub},
+        )
+        if not row:
+            # rolls the totals update back
+            raise ValueError(f"User {npub} not found")
+    user = User(**row)
+    user_cache.set(user)
 
     logger.info(f"✅ User stats updated: {npub[:16]}...")
-    return await get_user(npub)
+    return user
 
 
 
-async def get_all_users(limit: int = 100, offset: int = 0) -> list[User]:
-    """Get paginated list of all users"""
+@traced
+async def get_all_users(limit: int = 100, after: tuple[int, str] | None = None) -> list[User]:
+    """Get users by last activity, strictly after the `(updated_at, npub)` keyset"""
+    values: dict = {"limit": limit}
+    keyset = ""
+    if after:
+        keyset = "WHERE (updated_at, npub) < (:after_updated_at, :after_npub)"
+        values.update(after_updated_at=after[0], after_npub=after[1])
     rows = await db.fetchall(
-        """
+        f"""
         SELECT * FROM bitsatcredit.users
-        ORDER BY updated_at DESC
-        LIMIT :limit OFFSET :offset
+        {keyset}
+        ORDER BY updated_at DESC, npub DESC
+        LIMIT :limit
         """,
-        {"limit": limit, "offset": offset},
+        values,
     )
     return [User(**row) for row in rows]
 
 
-async def get_recent_transactions(limit: int = 50) -> list[Transaction]:
-    """Get recent transactions across all users"""
+@traced
+async def get_recent_transactions(limit: int = 50, after: tuple[int, str] | None = None) -> list[Transaction]:
+    """Get recent transactions across all users, strictly after the `(created_at, id)` keyset"""
+    values: dict = {"limit": limit}
+    keyset = ""
+    if after:
+        keyset = "WHERE (created_at, id) < (:after_created_at, :after_id)"
+        values.update(after_created_at=after[0], after_id=after[1])
     rows = await db.fetchall(
-        """
+        f"""
         SELECT * FROM bitsatcredit.transactions
-        ORDER BY created_at DESC
+        {keyset}
+        ORDER BY created_at DESC, id DESC
         LIMIT :limit
         """,
-        {"limit": limit},
+        values,
     )
     return [Transaction(**row) for row in rows]
 
 
+EXPORT_CHUNK_SIZE = 1000
+
+
+def _export_filters(npub: str | None, since: int | None, until: int | None) -> tuple[list[str], dict]:
+    clauses: list[str] = []
+    values: dict[str, int | str] = {}
+    if npub:
+        clauses.append("npub = :npub")
+        values["npub"] = npub
+    if since is not None:
+        clauses.append("created_at >= :since")
+        values["since"] = since
+    if until is not None:
+        clauses.append("created_at < :until")
+        values["until"] = until
+    return clauses, values
+
+
+async def stream_users(
+    npub: str | None = None,
+    since: int | None = None,
+    until: int | None = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> AsyncIterator[list[dict]]:
+    """Yield raw user rows in npub order, one keyset chunk at a time.
+
+    Every chunk is a separate short query, so a long export never holds the
+    connection between chunks. `since`/`until` filter on `created_at`.
+    """
+    clauses, values = _export_filters(npub, since, until)
+    values["limit"] = chunk_size
+    after = None
+    while True:
+        keyset = ["npub > :after_npub"] if after else []
+        where = " AND ".join(clauses + keyset)
+        if after:
+            values["after_npub"] = after
+        rows = await db.fetchall(
+            f"""
+            SELECT * FROM bitsatcredit.users
+            {"WHERE " + where if where else ""}
+            ORDER BY npub
+            LIMIT :limit
+            """,
+            values,
+        )
+        if not rows:
+            return
+        yield [dict(row) for row in rows]
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1]["npub"]
+
+
+async def stream_transactions(
+    npub: str | None = None,
+    since: int | None = None,
+    until: int | None = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> AsyncIterator[list[dict]]:
+    """Yield raw ledger rows oldest first, one `(created_at, id)` keyset chunk at a time"""
+    clauses, values = _export_filters(npub, since, until)
+    values["limit"] = chunk_size
+    after = None
+    while True:
+        keyset = ["(created_at, id) > (:after_created_at, :after_id)"] if after else []
+        where = " AND ".join(clauses + keyset)
+        if after:
+            values.update(after_created_at=after[0], after_id=after[1])
+        rows = await db.fetchall(
+            f"""
+            SELECT * FROM bitsatcredit.transactions
+            {"WHERE " + where if where else ""}
+            ORDER BY created_at, id
+            LIMIT :limit
+            """,
+            values,
+        )
+        if not rows:
+            return
+        yield [dict(row) for row in rows]
+        if len(rows) < chunk_size:
+            return
+        after = (rows[-1]["created_at"], rows[-1]["id"])
+
+
+SYSTEM_TOTALS_QUERY = """
+    SELECT
+        COUNT(*) as total_users,
+        COALESCE(SUM(balance_sats), 0) as total_balance,
+        COALESCE(SUM(held_sats), 0) as total_held,
+        COALESCE(SUM(total_spent), 0) as total_spent,
+        COALESCE(SUM(total_deposited), 0) as total_deposited,
+        COALESCE(SUM(message_count), 0) as total_messages
+    FROM bitsatcredit.users
+"""
+SYSTEM_TOTALS_FIELDS = (
+    "total_users",
+    "total_balance",
+    "total_held",
+    "total_spent",
+    "total_deposited",
+    "total_messages",
+)
+
+
+@traced
 async def get_system_stats() -> dict:
-    """Calculate system-wide statistics"""
-    stats = await db.fetchone(
+    """System-wide statistics from the incrementally maintained totals row"""
+    stats = await db.fetchone("SELECT * FROM bitsatcredit.system_totals WHERE id = 1")
+    return {field: stats[field] if stats else 0 for field in SYSTEM_TOTALS_FIELDS}
+
+
+@traced
+async def reconcile_system_totals() -> dict:
+    """Recompute the totals from the users table and repair any drift.
+
+    Returns the per-field drift (stored minus actual), empty when in sync.
+    """
+    async with atomic() as conn:
+        stored = await conn.fetchone("SELECT * FROM bitsatcredit.system_totals WHERE id = 1")
+        actual = await conn.fetchone(SYSTEM_TOTALS_QUERY)
+        drift = {
+            field: stored[field] - actual[field]
+            for field in SYSTEM_TOTALS_FIELDS
+            if stored[field] != actual[field]
+        }
+        if drift:
+            await execute_in(
+                conn,
+                """
+                UPDATE bitsatcredit.system_totals
+                SET total_users = :total_users,
+                    total_balance = :total_balance,
+                    total_held = :total_held,
+                    total_spent = :total_spent,
+                    total_deposited = :total_deposited,
+                    total_messages = :total_messages
+                WHERE id = 1
+                """,
+                {field: actual[field] for field in SYSTEM_TOTALS_FIELDS},
+            )
+    return drift
+
+
+# Analytics operations
+@traced
+async def get_usage_timeseries(bucket: str, start: int, end: int) -> list[UsageBucket]:
+    """Rollup buckets in `[start, end]`, with empty buckets filled in"""
+    seconds = ROLLUP_BUCKETS[bucket]
+    first = start - start % seconds
+    rows = await db.fetchall(
         """
-        SELECT
-            COUNT(*) as total_users,
-            COALESCE(SUM(balance_sats), 0) as total_balance,
-            COALESCE(SUM(total_spent), 0) as total_spent,
-            COALESCE(SUM(total_deposited), 0) as total_deposited,
-            COALESCE(SUM(message_count), 0) as total_messages
-        FROM bitsatcredit.users
+        SELECT * FROM bitsatcredit.usage_rollups
+        WHERE bucket = :bucket AND bucket_start >= :start AND bucket_start <= :end
+        ORDER BY bucket_start
+        """,
+        {"bucket": bucket, "start": first, "end": end},
+    )
+    found = {row["bucket_start"]: UsageBucket(**row) for row in rows}
+    return [found.get(ts) or UsageBucket(bucket_start=ts) for ts in range(first, end + 1, seconds)]
+
+
+@traced
+async def backfill_usage_rollups() -> int:
+    """Rebuild the rollup buckets from the ledger, returns the bucket count.
+
+    The ledger has one row per spend, so rebuilt message counts assume one
+    message per spend (a hold captured for several messages counts once).
+    Buckets before `ledger_pruned_through` are kept as they are, their
+    ledger rows now live in the archive. The cutoff is rounded up to the
+    widest bucket so a kept bucket is never rebuilt from part of its rows.
+    """
+    pruned_through = int(await get_setting("ledger_pruned_through", "0"))
+    widest = max(ROLLUP_BUCKETS.values())
+    since = -(-pruned_through // widest) * widest
+    async with atomic() as conn:
+        await execute_in(conn, "DELETE FROM bitsatcredit.usage_rollups WHERE bucket_start >= :since", {"since": since})
+        for bucket, seconds in ROLLUP_BUCKETS.items():
+            await execute_in(
+                conn,
+                f"""
+                INSERT INTO bitsatcredit.usage_rollups (bucket, bucket_start, {", ".join(ROLLUP_FIELDS)})
+                SELECT
+                    :bucket,
+                    created_at - (created_at % {seconds}),
+                    SUM(CASE WHEN type = 'deposit' THEN amount_sats ELSE 0 END),
+                    SUM(CASE WHEN type = 'deposit' THEN 1 ELSE 0 END),
+                    SUM(CASE WHEN type = 'spend' THEN amount_sats ELSE 0 END),
+                    SUM(CASE WHEN type = 'spend' THEN 1 ELSE 0 END),
+                    SUM(CASE WHEN type = 'spend' THEN 1 ELSE 0 END)
+                FROM bitsatcredit.transactions
+                WHERE created_at >= :since
+                GROUP BY created_at - (created_at % {seconds})
+                """,
+                {"bucket": bucket, "since": since},
+            )
+        row = await conn.fetchone("SELECT COUNT(*) AS buckets FROM bitsatcredit.usage_rollups")
+    return row["buckets"]
+
+
+# Ledger retention
+@traced
+async def get_transactions_before(
+    before: int, limit: int = 500, after: tuple[int, str] | None = None
+) -> list[dict]:
+    """Raw ledger rows created before `before`, oldest first, after the keyset"""
+    values: dict = {"before": before, "limit": limit}
+    keyset = ""
+    if after:
+        keyset = "AND (created_at, id) > (:after_created_at, :after_id)"
+        values.update(after_created_at=after[0], after_id=after[1])
+    rows = await db.fetchall(
+        f"""
+        SELECT * FROM bitsatcredit.transactions
+        WHERE created_at < :before {keyset}
+        ORDER BY created_at, id
+        LIMIT :limit
+        """,
+        values,
+    )
+    return [dict(row) for row in rows]
+
+
+async def _bump_ledger_checkpoints(conn: Connection, rows: list, sign: int = 1):
+    """Add (or with `sign=-1` take back) ledger rows to their users' checkpoints"""
+    now = int(datetime.now(timezone.utc).timestamp())
+    checkpoints: dict[str, dict] = {}
+    for row in rows:
+        checkpoint = checkpoints.setdefault(
+            row["npub"],
+            {"npub": row["npub"], "deposited": 0, "spent": 0, "count": 0, "through": 0, "updated_at": now},
+        )
+        if row["type"] == "deposit":
+            checkpoint["deposited"] += sign * row["amount_sats"]
+        elif row["type"] == "spend":
+            checkpoint["spent"] += sign * row["amount_sats"]
+        checkpoint["count"] += sign
+        if sign > 0:
+            checkpoint["through"] = max(checkpoint["through"], row["created_at"])
+    if not checkpoints:
+        return
+    await execute_in(
+        conn,
         """
+        INSERT INTO bitsatcredit.ledger_checkpoints
+            (npub, deposited_sats, spent_sats, transaction_count, through_created_at, updated_at)
+        VALUES (:npub, :deposited, :spent, :count, :through, :updated_at)
+        ON CONFLICT (npub) DO UPDATE SET
+            deposited_sats = ledger_checkpoints.deposited_sats + excluded.deposited_sats,
+            spent_sats = ledger_checkpoints.spent_sats + excluded.spent_sats,
+            transaction_count = ledger_checkpoints.transaction_count + excluded.transaction_count,
+            through_created_at = CASE
+                WHEN excluded.through_created_at > ledger_checkpoints.through_created_at
+                THEN excluded.through_created_at ELSE ledger_checkpoints.through_created_at END,
+            updated_at = excluded.updated_at
+        """,
+        list(checkpoints.values()),
     )
-    return {
-        "total_users": stats["total_users"] if stats else 0,
-        "total_balance": stats["total_balance"] if stats else 0,
-        "total_spent": stats["total_spent"] if stats else 0,
-        "total_deposited": stats["total_deposited"] if stats else 0,
-        "total_messages": stats["total_messages"] if stats else 0,
-    }
+
+
+@traced
+async def prune_transactions(before: int, through: tuple[int, str], chunk_size: int = 500) -> int:
+    """Fold ledger rows up to the archived `through` keyset into checkpoints and delete them.
+
+    Only call this once the rows are safely archived. Each chunk is its own
+    short transaction; returns the number of rows pruned.
+    """
+    # rollups before this point can no longer be rebuilt from the ledger
+    pruned_through = max(before, int(await get_setting("ledger_pruned_through", "0")))
+    await set_setting("ledger_pruned_through", str(pruned_through))
+
+    pruned = 0
+    while True:
+        async with atomic() as conn:
+            rows = await conn.fetchall(
+                """
+                SELECT id, npub, type, amount_sats, created_at FROM bitsatcredit.transactions
+                WHERE created_at < :before AND (created_at, id) <= (:through_created_at, :through_id)
+                ORDER BY created_at, id
+                LIMIT :limit
+                """,
+                {
+                    "before": before,
+                    "through_created_at": through[0],
+                    "through_id": through[1],
+                    "limit": chunk_size,
+                },
+            )
+            if rows:
+                await _bump_ledger_checkpoints(conn, rows)
+                placeholders, values = in_clause("id", [row["id"] for row in rows])
+                await execute_in(
+                    conn,
+                    f"DELETE FROM bitsatcredit.transactions WHERE id IN ({placeholders})",
+                    values,
+                )
+        pruned += len(rows)
+        if len(rows) < chunk_size:
+            return pruned
+        await asyncio.sleep(0)
+
+
+@traced
+async def restore_transactions(rows: list[dict]) -> int:
+    """Put archived ledger rows back and take them out of the checkpoints.
+
+    Rows already in the ledger are skipped; returns how many were restored.
+    """
+    restored = []
+    async with atomic() as conn:
+        for row in rows:
+            result = await execute_in(
+                conn,
+                """
+                INSERT INTO bitsatcredit.transactions
+                    (id, npub, type, amount_sats, payment_hash, memo, idempotency_key, created_at)
+                VALUES (:id, :npub, :type, :amount_sats, :payment_hash, :memo, :idempotency_key, :created_at)
+                ON CONFLICT (id) DO NOTHING
+                """,
+                {
+                    "id": row["id"],
+                    "npub": row["npub"],
+                    "type": row["type"],
+                    "amount_sats": row["amount_sats"],
+                    "payment_hash": row.get("payment_hash"),
+                    "memo": row.get("memo"),
+                    "idempotency_key": row.get("idempotency_key"),
+                    "created_at": row["created_at"],
+                },
+            )
+            if result.rowcount:
+                restored.append(row)
+        await _bump_ledger_checkpoints(conn, restored, sign=-1)
+    return len(restored)
+
+
+@traced
+async def get_ledger_checkpoint(npub: str) -> LedgerCheckpoint | None:
+    row = await db.fetchone(
+        "SELECT * FROM bitsatcredit.ledger_checkpoints WHERE npub = :npub",
+        {"npub": npub},
+    )
+    return LedgerCheckpoint(**row) if row else None
 
 
 # System settings operations
+@traced
+async def get_settings() -> dict[str, str]:
+    """All system settings, from the in-process snapshot"""
+    if settings_snapshot.values is None:
+        await load_settings()
+    return settings_snapshot.values or {}
+
+
+@traced
+async def load_settings() -> None:
+    """(Re)load the settings snapshot from the database"""
+    rows = await db.fetchall("SELECT key, value FROM bitsatcredit.system_settings")
+    settings_snapshot.load({row["key"]: row["value"] for row in rows})
+
+
+@traced
 async def get_setting(key: str, default: str = "") -> str:
     """Get system setting value"""
-    row = await db.fetchone(
-        "SELECT value FROM bitsatcredit.system_settings WHERE key = :key",
-        {"key": key},
-    )
-    return row["value"] if row else default
+    settings = await get_settings()
+    return settings.get(key, default)
 
 
+@traced
 async def set_setting(key: str, value: str):
     """Set system setting value (upsert)"""
     await db.execute(
@@ -343,28 +1643,34 @@ async def set_setting(key: str, value: str):
             "updated_at": int(datetime.now(timezone.utc).timestamp()),
         },
     )
+    await load_settings()
 
 
+@traced
 async def set_user_memo(npub: str, memo: str) -> User:
     """Set admin memo/note for user"""
     logger.info(f"📝 Setting memo for user: {npub[:16]}...")
 
-    user = await get_user(npub)
-    if not user:
+    async with atomic() as conn:
+        row = await execute_returning(
+            conn,
+            """
+            UPDATE bitsatcredit.users
+            SET memo = :memo, updated_at = :updated_at
+            WHERE npub = :npub
+            """,
+            {
+                "npub": npub,
+                "memo": memo,
+                "updated_at": int(datetime.now(timezone.utc).timestamp()),
+            },
+            USER_BY_NPUB,
+            {"npub": npub},
+        )
+    if not row:
         raise ValueError(f"User {npub} not found")
-
-    await db.execute(
-        """
-        UPDATE bitsatcredit.users
-        SET memo = :memo, updated_at = :updated_at
-        WHERE npub = :npub
-        """,
-        {
-            "npub": npub,
-            "memo": memo,
-            "updated_at": int(datetime.now(timezone.utc).timestamp()),
-        },
-    )
+    user = User(**row)
+    user_cache.set(user)
 
     logger.info(f"✅ User memo updated: {npub[:16]}...")
-    return await get_user(npub)
+    return user
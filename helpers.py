@@ -1 +1,59 @@
 # Helper functions for BitSatCredit extension
+
+import base64
+import csv
+import io
+import json
+from collections.abc import AsyncIterator
+
+
+def encode_cursor(sort_key: int, item_id: str) -> str:
+    """Opaque keyset pagination cursor for the row at `(sort_key, item_id)`"""
+    raw = json.dumps([sort_key, item_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[int, str]:
+    """Inverse of `encode_cursor`, raises ValueError on a malformed cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_key, item_id = json.loads(raw)
+    except Exception as exc:
+        raise ValueError("Invalid cursor") from exc
+    if not isinstance(sort_key, int) or not isinstance(item_id, str):
+        raise ValueError("Invalid cursor")
+    return sort_key, item_id
+
+
+async def export_lines(chunks: AsyncIterator[list[dict]], fields: list[str], fmt: str = "csv") -> AsyncIterator[str]:
+    """Render row chunks as CSV (with a header) or NDJSON, one string per chunk"""
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore", lineterminator="\n")
+        writer.writeheader()
+        yield buffer.getvalue()
+    async for rows in chunks:
+        if fmt == "csv":
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore", lineterminator="\n")
+            writer.writerows(rows)
+            yield buffer.getvalue()
+        else:
+            yield "".join(json.dumps({field: row.get(field) for field in fields}, default=str) + "\n" for row in rows)
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a byte stream into decoded lines without reading it all"""
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8-sig").rstrip("\r")
+    if pending:
+        yield pending.decode("utf-8-sig").rstrip("\r")
+
+
+def sse_event(event: str, data: dict) -> str:
+    """A server-sent event frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,162 @@
+# Compressed NDJSON cold storage for ledger rows pruned by the retention job
+#
+# Layout under the archive root:
+#
+#   transactions/date=YYYY-MM-DD/<run_id>.ndjson.gz   one file per day per run
+#   manifests/<run_id>.json                           written last, per run
+#
+# A manifest lists the files of a run with their row count and sha256 and
+# the `(created_at, id)` keyset the run archived through. Rows are only
+# pruned from the database once the data files, the manifest and the
+# directory entries pointing at them are fsynced.
+#
+# Everything here is blocking file IO, call it through `asyncio.to_thread`.
+
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from itertools import islice
+from pathlib import Path
+from typing import IO
+
+MANIFEST_DIR = "manifests"
+TRANSACTIONS_DIR = "transactions"
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _fsync_file(path: Path) -> None:
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path: Path) -> None:
+    """Make renames and new entries in a directory durable (a no-op off POSIX)"""
+    if os.name != "posix":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_write(path: Path, data: str) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(path.parent)
+
+
+class LedgerArchiveWriter:
+    """Streams ledger rows of one archive run into per-day gzip files"""
+
+    def __init__(self, root: Path, run_id: str):
+        self.root = root
+        self.run_id = run_id
+        self.handles: dict[str, IO[str]] = {}
+        self.rows: dict[str, int] = {}
+
+    def _path(self, day: str) -> Path:
+        return self.root / TRANSACTIONS_DIR / f"date={day}" / f"{self.run_id}.ndjson.gz"
+
+    def write(self, rows: list[dict]) -> None:
+        for row in rows:
+            day = datetime.fromtimestamp(row["created_at"], timezone.utc).strftime("%Y-%m-%d")
+            handle = self.handles.get(day)
+            if handle is None:
+                path = self._path(day)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                handle = gzip.open(path.with_name(path.name + ".tmp"), "wt", encoding="utf-8")
+                self.handles[day] = handle
+                self.rows[day] = 0
+            handle.write(json.dumps(row, separators=(",", ":"), default=str) + "\n")
+            self.rows[day] += 1
+
+    def close(self, older_than: int, through: tuple[int, str]) -> dict:
+        """Finish the data files and write the manifest, returns the manifest"""
+        files = []
+        for day, handle in sorted(self.handles.items()):
+            handle.close()
+            path = self._path(day)
+            tmp = path.with_name(path.name + ".tmp")
+            _fsync_file(tmp)
+            os.replace(tmp, path)
+            _fsync_dir(path.parent)
+            files.append(
+                {
+                    "path": str(path.relative_to(self.root)),
+                    "date": day,
+                    "rows": self.rows[day],
+                    "sha256": _sha256(path),
+                }
+            )
+        self.handles = {}
+        if files:
+            _fsync_dir(self.root / TRANSACTIONS_DIR)
+
+        manifest = {
+            "run_id": self.run_id,
+            "created_at": int(datetime.now(timezone.utc).timestamp()),
+            "older_than": older_than,
+            "through": list(through),
+            "rows": sum(self.rows.values()),
+            "files": files,
+        }
+        manifest_dir = self.root / MANIFEST_DIR
+        manifest_dir.mkdir(parents=True, exist_ok=True)
+        _fsync_write(manifest_dir / f"{self.run_id}.json", json.dumps(manifest, indent=2))
+        _fsync_dir(self.root)
+        return manifest
+
+    def abort(self) -> None:
+        """Drop the partial files of a failed run"""
+        for day, handle in self.handles.items():
+            handle.close()
+            self._path(day).with_name(self._path(day).name + ".tmp").unlink(missing_ok=True)
+        self.handles = {}
+
+
+def list_manifests(root: Path) -> list[dict]:
+    """All archive run manifests, oldest first"""
+    manifest_dir = root / MANIFEST_DIR
+    if not manifest_dir.is_dir():
+        return []
+    return [json.loads(path.read_text(encoding="utf-8")) for path in sorted(manifest_dir.glob("*.json"))]
+
+
+def load_manifest(root: Path, run_id: str) -> dict:
+    path = root / MANIFEST_DIR / f"{Path(run_id).name}.json"
+    if not path.is_file():
+        raise ValueError(f"Unknown archive run {run_id}")
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def verify_manifest(root: Path, manifest: dict) -> list[str]:
+    """Paths of files that are missing or fail their checksum"""
+    bad = []
+    for entry in manifest["files"]:
+        path = root / entry["path"]
+        if not path.is_file() or _sha256(path) != entry["sha256"]:
+            bad.append(entry["path"])
+    return bad
+
+
+def open_archive_file(root: Path, entry: dict) -> IO[str]:
+    return gzip.open(root / entry["path"], "rt", encoding="utf-8")
+
+
+def read_rows(handle: IO[str], limit: int) -> list[dict]:
+    """Next `limit` rows of an open archive file, empty at the end"""
+    return [json.loads(line) for line in islice(handle, limit)]
@@ -0,0 +1,254 @@
+# In-process Prometheus metrics, rendered by GET /api/v1/metrics
+#
+# Collection is a dict update per sample so it can run on every request in
+# the spend path. Values that already live elsewhere (cache counters,
+# invoice queue depth) are read at scrape time instead of being mirrored.
+
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections.abc import Callable, Iterable
+from contextvars import ContextVar
+from typing import TypeVar
+
+from fastapi import Request, Response
+from fastapi.exceptions import HTTPException
+from fastapi.routing import APIRoute
+from lnbits.db import Database
+from sqlalchemy import event
+
+from .cache import user_cache
+from .pubsub import topup_hub
+from .ratelimit import invoice_limiter
+from .tracing import tracer
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SETTLEMENT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name of the endpoint (or background job) the current DB statements belong to
+current_operation: ContextVar[str] = ContextVar("bitsatcredit_operation", default="other")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    @abstractmethod
+    def lines(self) -> Iterable[str]:
+        """Sample lines in the text exposition format"""
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(f"{line}\n" for line in self.lines())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def lines(self) -> Iterable[str]:
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # per label set: count per bucket (last one is +Inf), then the sum
+        self.values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def lines(self) -> Iterable[str]:
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts, strict=True):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Gauge(Metric):
+    """Read at scrape time from `collect`, which returns values by label tuple"""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        collect: Callable[[], dict[tuple[str, ...], float]],
+        labelnames: tuple[str, ...] = (),
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def lines(self) -> Iterable[str]:
+        for labels, value in sorted(self.collect().items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class CollectedCounter(Gauge):
+    """A counter kept by another component, read at scrape time"""
+
+    kind = "counter"
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self.metrics)
+
+    def reset(self) -> None:
+        for metric in self.metrics:
+            if isinstance(metric, (Counter, Histogram)):
+                metric.values.clear()
+
+
+registry = Registry()
+
+http_requests = registry.register(
+    Counter("bitsatcredit_http_requests_total", "API requests by endpoint and status", ("method", "path", "status"))
+)
+http_request_seconds = registry.register(
+    Histogram("bitsatcredit_http_request_duration_seconds", "API request latency by endpoint", ("method", "path"))
+)
+db_statements = registry.register(
+    Counter("bitsatcredit_db_statements_total", "SQL statements executed per operation", ("operation",))
+)
+db_seconds = registry.register(
+    Counter("bitsatcredit_db_seconds_total", "Time spent executing SQL per operation", ("operation",))
+)
+topups_created = registry.register(Counter("bitsatcredit_topups_created_total", "Top-up invoices created"))
+topups_paid = registry.register(Counter("bitsatcredit_topups_paid_total", "Top-ups credited to a user"))
+topup_sats_paid = registry.register(Counter("bitsatcredit_topup_sats_paid_total", "Sats credited by top-ups"))
+settlement_seconds = registry.register(
+    Histogram(
+        "bitsatcredit_settlement_lag_seconds",
+        "Time from the invoice listener receiving a paid invoice to the credit being applied",
+        buckets=SETTLEMENT_BUCKETS,
+    )
+)
+spend_rejections = registry.register(
+    Counter("bitsatcredit_spend_rejections_total", "Spends and holds rejected", ("endpoint", "reason"))
+)
+registry.register(
+    CollectedCounter("bitsatcredit_user_cache_hits_total", "User cache hits", lambda: {(): user_cache.hits})
+)
+registry.register(
+    CollectedCounter("bitsatcredit_user_cache_misses_total", "User cache misses", lambda: {(): user_cache.misses})
+)
+registry.register(Gauge("bitsatcredit_user_cache_size", "Users in the cache", lambda: {(): user_cache.stats()["size"]}))
+registry.register(
+    CollectedCounter(
+        "bitsatcredit_rate_limited_total",
+        "Invoice requests rejected with 429 by the limit that was hit",
+        lambda: {(scope,): count for scope, count in invoice_limiter.rejected.items()},
+        ("scope",),
+    )
+)
+registry.register(
+    Gauge("bitsatcredit_topup_waiters", "Open top-up event streams and long polls", lambda: {(): topup_hub.waiters})
+)
+
+
+class MetricsRoute(APIRoute):
+    """Route class that times every request, labels its DB statements and
+    opens a trace for sampled requests"""
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        method = next(iter(self.methods)) if self.methods else ""
+        path = self.path
+        operation = self.name
+
+        async def timed_handler(request: Request) -> Response:
+            token = current_operation.set(operation)
+            started = time.perf_counter()
+            status = 500
+            try:
+                with tracer.trace(operation) as span:
+                    try:
+                        response = await handler(request)
+                        status = response.status_code
+                        return response
+                    except HTTPException as exc:
+                        status = exc.status_code
+                        raise
+                    finally:
+                        if span:
+                            span.attributes.update(method=method, path=path, status=status)
+            finally:
+                current_operation.reset(token)
+                http_requests.inc(method, path, str(status))
+                http_request_seconds.observe(time.perf_counter() - started, method, path)
+
+        return timed_handler
+
+
+def instrument_database(database: Database) -> None:
+    """Count statements and time them against the current operation"""
+    engine = database.engine.sync_engine
+    if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+# statements on one connection never overlap, so one start time is enough
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["bitsatcredit_started"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop("bitsatcredit_started", time.perf_counter())
+    operation = current_operation.get()
+    db_statements.inc(operation)
+    db_seconds.inc(operation, amount=elapsed)
+    tracer.record_statement(statement, elapsed)
@@ -2,6 +2,8 @@
 # If you create a new release for your extension ,
 # remember the migration file is like a blockchain, never edit only add!
 
+from lnbits.db import SQLITE
+
 empty_dict: dict[str, str] = {}
 
 
@@ -119,3 +121,205 @@ async def m006_add_user_memo(db):
         )
     except Exception:
         pass
+
+
+def create_index(db, name: str, table: str, columns: str, unique: bool = False, where: str = "") -> str:
+    """CREATE INDEX statement for the extension schema.
+
+    SQLite puts the schema on the index name, Postgres on the table name.
+    """
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    if db.type == SQLITE:
+        target = f"bitsatcredit.{name} ON {table}"
+    else:
+        target = f"{name} ON bitsatcredit.{table}"
+    return f"CREATE {kind} IF NOT EXISTS {target} ({columns}) {where};"
+
+
+async def m007_transaction_idempotency_key(db):
+    """Idempotency key for relay batch spends"""
+    await db.execute(
+        """
+        ALTER TABLE bitsatcredit.transactions ADD COLUMN idempotency_key TEXT;
+        """
+    )
+    await db.execute(
+        create_index(db, "transactions_idempotency_key_idx", "transactions", "idempotency_key", unique=True)
+    )
+
+
+async def m008_credit_holds(db):
+    """Credit reservations (hold / capture / release)"""
+    await db.execute(
+        """
+        ALTER TABLE bitsatcredit.users ADD COLUMN held_sats INTEGER NOT NULL DEFAULT 0;
+        """
+    )
+    await db.execute(
+        f"""
+        CREATE TABLE bitsatcredit.holds (
+            id TEXT PRIMARY KEY,
+            npub TEXT NOT NULL,
+            amount_sats INTEGER NOT NULL,
+            captured_sats INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'held',
+            memo TEXT,
+            expires_at INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT {db.timestamp_now},
+            settled_at INTEGER,
+            FOREIGN KEY (npub) REFERENCES users(npub)
+        );
+        """
+    )
+    await db.execute(create_index(db, "holds_status_expires_at_idx", "holds", "status, expires_at"))
+
+
+async def m009_access_path_indexes(db):
+    """Indexes matching the ledger, top-up and user list queries"""
+    # per-user history (ORDER BY created_at) and delete by npub
+    await db.execute(create_index(db, "transactions_npub_created_at_idx", "transactions", "npub, created_at"))
+    # recent transactions across all users
+    await db.execute(create_index(db, "transactions_created_at_idx", "transactions", "created_at"))
+    # admin user list ordered by last activity
+    await db.execute(create_index(db, "users_updated_at_idx", "users", "updated_at"))
+    # delete by npub
+    await db.execute(create_index(db, "topup_requests_npub_idx", "topup_requests", "npub"))
+    await db.execute(create_index(db, "holds_npub_idx", "holds", "npub"))
+    # only unpaid top-ups are ever scanned for expiry and reconciliation
+    await db.execute(
+        create_index(
+            db, "topup_requests_unpaid_created_at_idx", "topup_requests", "created_at", where="WHERE paid = FALSE"
+        )
+    )
+
+
+async def m010_keyset_pagination_indexes(db):
+    """Add the id tie-breaker to the list indexes for keyset pagination"""
+    await db.execute(create_index(db, "users_updated_at_npub_idx", "users", "updated_at, npub"))
+    await db.execute(create_index(db, "transactions_npub_created_at_id_idx", "transactions", "npub, created_at, id"))
+    await db.execute(create_index(db, "transactions_created_at_id_idx", "transactions", "created_at, id"))
+    for superseded in ("users_updated_at_idx", "transactions_npub_created_at_idx", "transactions_created_at_idx"):
+        await db.execute(f"DROP INDEX IF EXISTS bitsatcredit.{superseded};")
+
+
+async def m011_system_totals(db):
+    """Incrementally maintained system statistics, seeded from the users table"""
+    await db.execute(
+        f"""
+        CREATE TABLE bitsatcredit.system_totals (
+            id INTEGER PRIMARY KEY,
+            total_users {db.big_int} NOT NULL DEFAULT 0,
+            total_balance {db.big_int} NOT NULL DEFAULT 0,
+            total_held {db.big_int} NOT NULL DEFAULT 0,
+            total_spent {db.big_int} NOT NULL DEFAULT 0,
+            total_deposited {db.big_int} NOT NULL DEFAULT 0,
+            total_messages {db.big_int} NOT NULL DEFAULT 0
+        );
+        """
+    )
+    await db.execute(
+        """
+        INSERT INTO bitsatcredit.system_totals
+            (id, total_users, total_balance, total_held, total_spent, total_deposited, total_messages)
+        SELECT
+            1,
+            COUNT(*),
+            COALESCE(SUM(balance_sats), 0),
+            COALESCE(SUM(held_sats), 0),
+            COALESCE(SUM(total_spent), 0),
+            COALESCE(SUM(total_deposited), 0),
+            COALESCE(SUM(message_count), 0)
+        FROM bitsatcredit.users;
+        """
+    )
+
+
+async def m012_usage_rollups(db):
+    """Hourly and daily usage rollups, backfilled from the ledger"""
+    await db.execute(
+        f"""
+        CREATE TABLE bitsatcredit.usage_rollups (
+            bucket TEXT NOT NULL,
+            bucket_start INTEGER NOT NULL,
+            deposit_sats {db.big_int} NOT NULL DEFAULT 0,
+            deposit_count INTEGER NOT NULL DEFAULT 0,
+            spend_sats {db.big_int} NOT NULL DEFAULT 0,
+            spend_count INTEGER NOT NULL DEFAULT 0,
+            messages INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, bucket_start)
+        );
+        """
+    )
+    for bucket, seconds in (("hour", 3600), ("day", 86400)):
+        await db.execute(
+            f"""
+            INSERT INTO bitsatcredit.usage_rollups
+                (bucket, bucket_start, deposit_sats, deposit_count, spend_sats, spend_count, messages)
+            SELECT
+                '{bucket}',
+                created_at - (created_at % {seconds}),
+                SUM(CASE WHEN type = 'deposit' THEN amount_sats ELSE 0 END),
+                SUM(CASE WHEN type = 'deposit' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN type = 'spend' THEN amount_sats ELSE 0 END),
+                SUM(CASE WHEN type = 'spend' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN type = 'spend' THEN 1 ELSE 0 END)
+            FROM bitsatcredit.transactions
+            GROUP BY created_at - (created_at % {seconds});
+            """
+        )
+
+
+async def m013_unpaid_topups_keyset_index(db):
+    """Keyset index over unpaid top-ups for chunked reconciliation"""
+    await db.execute(
+        create_index(
+            db, "topup_requests_unpaid_created_at_id_idx", "topup_requests", "created_at, id", where="WHERE paid = FALSE"
+        )
+    )
+    await db.execute("DROP INDEX IF EXISTS bitsatcredit.topup_requests_unpaid_created_at_idx;")
+
+
+async def m014_topup_expiry_and_archive(db):
+    """Top-up invoice expiry and compact archive of stale unpaid requests"""
+    await db.execute("ALTER TABLE bitsatcredit.topup_requests ADD COLUMN expires_at INTEGER;")
+    await db.execute("ALTER TABLE bitsatcredit.topup_requests ADD COLUMN expired BOOLEAN NOT NULL DEFAULT FALSE;")
+    # existing requests used the LNbits default expiry of one hour
+    await db.execute("UPDATE bitsatcredit.topup_requests SET expires_at = created_at + 3600;")
+    await db.execute(
+        create_index(
+            db,
+            "topup_requests_pending_expires_at_idx",
+            "topup_requests",
+            "expires_at",
+            where="WHERE paid = FALSE AND expired = FALSE",
+        )
+    )
+    await db.execute(
+        """
+        CREATE TABLE bitsatcredit.topup_requests_archive (
+            id TEXT PRIMARY KEY,
+            npub TEXT NOT NULL,
+            amount_sats INTEGER NOT NULL,
+            payment_hash TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            expires_at INTEGER
+        );
+        """
+    )
+    await db.execute(create_index(db, "topup_requests_archive_npub_idx", "topup_requests_archive", "npub"))
+
+
+async def m015_ledger_checkpoints(db):
+    """Per-user sums of ledger rows pruned by the retention job"""
+    await db.execute(
+        f"""
+        CREATE TABLE bitsatcredit.ledger_checkpoints (
+            npub TEXT PRIMARY KEY,
+            deposited_sats {db.big_int} NOT NULL DEFAULT 0,
+            spent_sats {db.big_int} NOT NULL DEFAULT 0,
+            transaction_count INTEGER NOT NULL DEFAULT 0,
+            through_created_at INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER NOT NULL DEFAULT 0
+        );
+        """
+    )
@@ -16,11 +16,17 @@ class User(BaseModel):
     total_spent: int = 0
     total_deposited: int = 0
     message_count: int = 0
+    held_sats: int = 0
     memo: str | None = None
     created_at: int | None = None
     updated_at: int | None = None
 
 
+class UserPage(BaseModel):
+    data: list[User]
+    next_cursor: str | None = None  # pass back as `cursor` for the next page
+
+
 # Transaction models
 class CreateTransaction(BaseModel):
     npub: str
@@ -39,7 +45,69 @@ class Transaction(BaseModel):
     amount_sats: int
     payment_hash: str | None
     memo: str | None
+    idempotency_key: str | None = None
+    created_at: int | None = None
+
+
+class TransactionPage(BaseModel):
+    data: list[Transaction]
+    next_cursor: str | None = None  # pass back as `cursor` for the next page
+
+
+class LedgerCheckpoint(BaseModel):
+    """Sums of a user's ledger rows that were pruned into the archive"""
+
+    npub: str
+    deposited_sats: int = 0
+    spent_sats: int = 0
+    transaction_count: int = 0
+    through_created_at: int = 0  # created_at of the newest pruned row
+    updated_at: int | None = None
+
+    @property
+    def balance_sats(self) -> int:
+        return self.deposited_sats - self.spent_sats
+
+
+# Batch spend models
+class BatchSpendItem(BaseModel):
+    npub: str
+    amount: int = Field(..., ge=1)
+    memo: str | None = None
+    idempotency_key: str | None = None
+
+
+class BatchSpendResult(BaseModel):
+    npub: str
+    amount: int
+    idempotency_key: str | None = None
+    status: str  # 'spent', 'insufficient_funds', 'not_found' or 'duplicate'
+    balance_sats: int | None = None  # balance after the whole batch
+
+
+# Credit hold models
+class Hold(BaseModel):
+    model_config = ConfigDict(from_attributes=True, arbitrary_types_allowed=True, extra='ignore')
+
+    id: str
+    npub: str
+    amount_sats: int
+    captured_sats: int = 0
+    status: str  # 'held', 'captured', 'released' or 'expired'
+    memo: str | None = None
+    expires_at: int
     created_at: int | None = None
+    settled_at: int | None = None
+
+
+# Analytics models
+class UsageBucket(BaseModel):
+    bucket_start: int  # unix timestamp (UTC) of the start of the hour/day
+    deposit_sats: int = 0
+    deposit_count: int = 0
+    spend_sats: int = 0
+    spend_count: int = 0
+    messages: int = 0
 
 
 # Top-up request models
@@ -57,10 +125,20 @@ class TopUpRequest(BaseModel):
     payment_hash: str
     bolt11: str
     paid: bool = False
+    expired: bool = False
     created_at: int | None = None
+    expires_at: int | None = None
     paid_at: int | None = None
 
 
+class TopUpStatus(BaseModel):
+    payment_hash: str
+    paid: bool
+    expired: bool = False
+    amount_sats: int
+    balance_sats: int | None = None  # user's balance once paid
+
+
 class TopUpPaymentRequest(BaseModel):
     topup_id: str
     payment_hash: str
@@ -72,3 +150,30 @@ class AdminAddCredits(BaseModel):
     npub: str
     amount: int
     memo: str | None = "Admin credit addition"
+
+
+class AdminBulkAddCredits(BaseModel):
+    """Credit every npub in `npubs`, or every user matched by the filter"""
+
+    npubs: list[str] | None = None
+    all_users: bool = False
+    active_since: int | None = None  # only users updated at or after this time
+    amount: int = Field(..., ge=1)
+    memo: str | None = "Bulk credit addition"
+
+
+class ImportUserRow(BaseModel):
+    """One row of a user import, missing totals follow the balance change"""
+
+    npub: str
+    balance_sats: int = Field(..., ge=0)
+    total_spent: int | None = Field(None, ge=0)
+    total_deposited: int | None = Field(None, ge=0)
+    message_count: int | None = Field(None, ge=0)
+    memo: str | None = None
+
+
+class BulkCreditResult(BaseModel):
+    npub: str
+    status: str  # 'credited', 'created' or 'duplicate'
+    balance_sats: int | None = None
@@ -0,0 +1,64 @@
+# In-process notification of paid top-ups, keyed by payment_hash
+
+import asyncio
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+
+class TooManyWaitersError(Exception):
+    """Raised when the hub already has `max_waiters` subscribers"""
+
+
+class TopUpHub:
+    """Wakes everything waiting on a top-up when its invoice is settled.
+
+    Waiters on the same payment hash share one `asyncio.Event`, which
+    `publish` sets once the top-up has been credited. The total number of
+    waiters is capped so open pages and bots cannot pile up unbounded.
+    """
+
+    def __init__(self, max_waiters: int = 1000):
+        self.max_waiters = max_waiters
+        self.events: dict[str, asyncio.Event] = {}
+        self.counts: dict[str, int] = {}
+        self.waiters = 0
+        self.published = 0
+        self.rejected = 0
+
+    @contextmanager
+    def subscribe(self, payment_hash: str) -> Iterator[asyncio.Event]:
+        if self.full():
+            self.rejected += 1
+            raise TooManyWaitersError()
+        event = self.events.setdefault(payment_hash, asyncio.Event())
+        self.counts[payment_hash] = self.counts.get(payment_hash, 0) + 1
+        self.waiters += 1
+        try:
+            yield event
+        finally:
+            self.waiters -= 1
+            self.counts[payment_hash] -= 1
+            if not self.counts[payment_hash]:
+                del self.counts[payment_hash]
+                del self.events[payment_hash]
+
+    def full(self) -> bool:
+        return self.waiters >= self.max_waiters
+
+    def publish(self, payment_hash: str) -> None:
+        event = self.events.get(payment_hash)
+        if event:
+            self.published += 1
+            event.set()
+
+    def stats(self) -> dict:
+        return {
+            "waiters": self.waiters,
+            "payment_hashes": len(self.events),
+            "max_waiters": self.max_waiters,
+            "published": self.published,
+            "rejected": self.rejected,
+        }
+
+
+topup_hub = TopUpHub()
@@ -0,0 +1,72 @@
+# In-process token buckets for shedding load before it reaches LNbits
+
+import math
+import time
+from collections import Counter, OrderedDict
+
+
+class RateLimitedError(Exception):
+    """Raised when a request is over one of its limits"""
+
+    def __init__(self, scope: str, retry_after: int):
+        super().__init__(f"Rate limited by {scope}")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token buckets keyed by `(scope, key)`, e.g. `("npub", "npub1...")`.
+
+    A limit of N per minute is a bucket holding N tokens that refills at
+    N/60 per second, so short bursts up to N are allowed. The least recently
+    used buckets are dropped beyond `max_keys`; a dropped key starts again
+    with a full bucket.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self.buckets: OrderedDict[tuple[str, str], tuple[float, float]] = OrderedDict()
+        self.allowed = 0
+        self.rejected: Counter = Counter()
+
+    def _tokens(self, bucket: tuple[str, str], per_minute: int, now: float) -> float:
+        tokens, updated = self.buckets.get(bucket, (per_minute, now))
+        return min(per_minute, tokens + (now - updated) * per_minute / 60)
+
+    def hit(self, limits: list[tuple[str, str, int]]) -> None:
+        """Take one token from every `(scope, key, per_minute)` bucket.
+
+        Nothing is taken unless all of them have a token; raises
+        `RateLimitedError` for the first one that is empty. A limit of 0 or less
+        is not enforced.
+        """
+        now = time.monotonic()
+        limits = [limit for limit in limits if limit[2] > 0]
+        levels = []
+        for scope, key, per_minute in limits:
+            tokens = self._tokens((scope, key), per_minute, now)
+            if tokens < 1:
+                self.rejected[scope] += 1
+                raise RateLimitedError(scope, math.ceil((1 - tokens) * 60 / per_minute))
+            levels.append(tokens)
+
+        self.allowed += 1
+        for (scope, key, _), tokens in zip(limits, levels, strict=True):
+            self.buckets[(scope, key)] = (tokens - 1, now)
+            self.buckets.move_to_end((scope, key))
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+
+    def clear(self) -> None:
+        self.buckets.clear()
+
+    def stats(self) -> dict:
+        return {
+            "tracked_keys": len(self.buckets),
+            "max_keys": self.max_keys,
+            "allowed": self.allowed,
+            "rejected": dict(self.rejected),
+        }
+
+
+invoice_limiter = RateLimiter()
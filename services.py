@@ -1,32 +1,75 @@
+import asyncio
+import csv
+import json
+from collections import deque
+from collections.abc import AsyncIterator
+from datetime import datetime, timezone
+from pathlib import Path
+
+from lnbits.core.crud import get_standalone_payment
 from lnbits.core.models import Payment
 from lnbits.core.services import create_invoice
+from lnbits.helpers import urlsafe_short_hash
+from lnbits.settings import settings
 from loguru import logger
 
-from .crud import create_topup_request, mark_topup_paid
+from .crud import (
+    compact_topups,
+    create_topup_request,
+    expire_topups,
+    get_setting,
+    get_transactions_before,
+    get_unpaid_topups,
+    import_users_batch,
+    mark_topup_paid,
+    prune_transactions,
+    restore_transactions,
+)
+from .ledger_archive import (
+    LedgerArchiveWriter,
+    list_manifests,
+    load_manifest,
+    open_archive_file,
+    read_rows,
+    verify_manifest,
+)
+from .models import ImportUserRow
+from .pubsub import topup_hub
+from .tracing import annotate, traced, tracer
+
+TOPUP_RECONCILE_WINDOW_SECONDS = 7 * 86400
+TOPUP_RECONCILE_CHUNK_SIZE = 50
+TOPUP_INVOICE_EXPIRY_SECONDS = 3600
+TOPUP_RETENTION_DAYS = 30
+LEDGER_ARCHIVE_CHUNK_SIZE = 500
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_REPORTED = 1000
+IMPORT_COLUMN_ALIASES = {"balance": "balance_sats", "spent": "total_spent", "deposited": "total_deposited"}
 
 
+@traced
 async def generate_topup_invoice(npub: str, amount_sats: int, wallet_id: str) -> dict:
     """Generate Lightning invoice for user top-up"""
-    logger.info(f"📝 Generating invoice for {npub[:16]}... - {amount_sats} sats")
-
-    payment: Payment = await create_invoice(
-        wallet_id=wallet_id,
-        amount=amount_sats,  # LNbits create_invoice expects sats
-        memo=f"BitSatRelay top-up for {npub[:16]}...",
-        extra={"tag": "bitsatcredit_topup", "npub": npub}
-    )
+    annotate(npub=npub, amount_sats=amount_sats)
 
-    logger.info(f"✅ Invoice created: {payment.payment_hash}, tag: bitsatcredit_topup")
+    with tracer.span("lnbits.create_invoice"):
+        payment: Payment = await create_invoice(
+            wallet_id=wallet_id,
+            amount=amount_sats,  # LNbits create_invoice expects sats
+            memo=f"BitSatRelay top-up for {npub[:16]}...",
+            expiry=TOPUP_INVOICE_EXPIRY_SECONDS,
+            extra={"tag": "bitsatcredit_topup", "npub": npub}
+        )
 
     # Store top-up request
     topup = await create_topup_request(
         npub=npub,
         amount_sats=amount_sats,
         payment_hash=payment.payment_hash,
-        bolt11=payment.bolt11
+        bolt11=payment.bolt11,
+        expires_at=int(datetime.now(timezone.utc).timestamp()) + TOPUP_INVOICE_EXPIRY_SECONDS,
     )
-
-    logger.info(f"💾 Top-up request stored: {topup.id}")
+    annotate(payment_hash=payment.payment_hash, topup_id=topup.id)
 
     return {
         "topup_id": topup.id,
@@ -35,15 +78,341 @@ async def generate_topup_invoice(npub: str, amount_sats: int, wallet_id: str) ->
     }
 
 
+@traced
 async def process_topup_payment(payment: Payment) -> bool:
-    """Called when invoice is paid"""
-    logger.info(f"🔄 Processing payment: {payment.payment_hash}, tag: {payment.extra.get('tag', 'NO TAG')}")
-
+    """Called when invoice is paid, returns False if nothing was credited"""
     if payment.extra.get("tag") != "bitsatcredit_topup":
         logger.warning(f"⚠️ Wrong tag for payment {payment.payment_hash}")
         return False
 
-    logger.info(f"💳 Marking top-up as paid: {payment.payment_hash}")
-    await mark_topup_paid(payment.payment_hash)
-    logger.info(f"✅ Top-up payment processed: {payment.payment_hash}")
-    return True
+    credited = await mark_topup_paid(payment.payment_hash)
+    annotate(payment_hash=payment.payment_hash, credited=credited)
+    return credited
+
+
+async def check_topup_payment(payment_hash: str) -> tuple[str, Payment | None]:
+    """Look up a top-up invoice in LNbits: 'paid', 'unpaid' or 'missing'"""
+    payment = await get_standalone_payment(payment_hash, incoming=True)
+    if not payment:
+        return "missing", None
+    if payment.success:
+        return "paid", payment
+    if payment.pending:
+        # the listener may have missed it, ask the funding source
+        status = await payment.check_status()
+        if status.success:
+            return "paid", payment
+    return "unpaid", payment
+
+
+async def reconcile_unpaid_topups(dry_run: bool = False, since: int | None = None) -> dict:
+    """Credit top-ups whose invoice was paid but never settled here.
+
+    Streams unpaid top-ups in chunks, looks each chunk's payments up
+    concurrently and settles paid ones through the normal top-up path.
+    With `dry_run` nothing is credited, the report lists what would be.
+    """
+    if since is None:
+        since = int(datetime.now(timezone.utc).timestamp()) - TOPUP_RECONCILE_WINDOW_SECONDS
+
+    report: dict = {
+        "dry_run": dry_run,
+        "checked": 0,
+        "recovered": 0,
+        "unpaid": 0,
+        "missing": 0,
+        "errors": 0,
+        "recovered_payment_hashes": [],
+    }
+    after = None
+    while chunk := await get_unpaid_topups(since, TOPUP_RECONCILE_CHUNK_SIZE, after):
+        after = (chunk[-1].created_at or 0, chunk[-1].id)
+        results = await asyncio.gather(
+            *[check_topup_payment(topup.payment_hash) for topup in chunk], return_exceptions=True
+        )
+        for topup, result in zip(chunk, results, strict=True):
+            report["checked"] += 1
+            if isinstance(result, BaseException):
+                logger.warning(f"⚠️ Could not check top-up {topup.payment_hash}: {result}")
+                report["errors"] += 1
+                continue
+
+            state, payment = result
+            if state != "paid" or not payment:
+                report[state] += 1
+                continue
+
+            if dry_run or await process_topup_payment(payment):
+                if not dry_run:
+                    topup_hub.publish(topup.payment_hash)
+                report["recovered"] += 1
+                report["recovered_payment_hashes"].append(topup.payment_hash)
+
+    if report["recovered"]:
+        logger.info(f"🔁 Reconciled {report['recovered']} missed top-up(s), dry_run={dry_run}")
+    return report
+
+
+async def sweep_topups() -> dict:
+    """Mark expired top-ups and move old unpaid ones out of the hot table.
+
+    Retention is read from the `topup_retention_days` setting and is never
+    shorter than the reconciliation window, so anything compacted can no
+    longer be recovered by `reconcile_unpaid_topups` anyway.
+    `topup_retention_mode` is "archive" (default) or "delete".
+    """
+    days = int(await get_setting("topup_retention_days", str(TOPUP_RETENTION_DAYS)))
+    retention = max(days * 86400, TOPUP_RECONCILE_WINDOW_SECONDS)
+    mode = await get_setting("topup_retention_mode", "archive")
+    older_than = int(datetime.now(timezone.utc).timestamp()) - retention
+
+    expired = await expire_topups()
+    compacted = await compact_topups(older_than, archive=mode != "delete")
+    if expired or compacted:
+        logger.info(f"🧹 Top-up sweep: {expired} expired, {compacted} {mode}d")
+    return {"expired": expired, "compacted": compacted, "mode": mode}
+
+
+async def ledger_archive_root() -> Path:
+    """Archive directory, the `ledger_archive_dir` setting or under the LNbits data folder"""
+    default = Path(settings.lnbits_data_folder, "bitsatcredit", "ledger_archive")
+    return Path(await get_setting("ledger_archive_dir", str(default)))
+
+
+async def archive_ledger(older_than: int | None = None) -> dict:
+    """Move ledger rows older than the retention period into the archive.
+
+    Rows are streamed in keyset chunks into per-day gzip NDJSON files; once
+    the run's manifest with checksums is on disk the same rows are folded
+    into per-user checkpoints and deleted. Without `older_than` the cutoff
+    is UTC midnight `ledger_retention_days` ago, and nothing happens while
+    that setting is 0 (the default).
+    """
+    if older_than is None:
+        days = int(await get_setting("ledger_retention_days", "0"))
+        if days <= 0:
+            return {"run_id": None, "archived": 0, "pruned": 0, "files": []}
+        now = int(datetime.now(timezone.utc).timestamp())
+        older_than = (now - days * 86400) // 86400 * 86400
+
+    root = await ledger_archive_root()
+    run_id = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}-{urlsafe_short_hash()[:8]}"
+    writer = LedgerArchiveWriter(root, run_id)
+    after = None
+    try:
+        while chunk := await get_transactions_before(older_than, LEDGER_ARCHIVE_CHUNK_SIZE, after):
+            after = (chunk[-1]["created_at"], chunk[-1]["id"])
+            await asyncio.to_thread(writer.write, chunk)
+        if after is None:
+            await asyncio.to_thread(writer.abort)
+            return {"run_id": None, "archived": 0, "pruned": 0, "files": []}
+        manifest = await asyncio.to_thread(writer.close, older_than, after)
+    except BaseException:
+        await asyncio.to_thread(writer.abort)
+        raise
+
+    pruned = await prune_transactions(older_than, after, LEDGER_ARCHIVE_CHUNK_SIZE)
+    logger.info(f"🗄️ Archived {manifest['rows']} ledger rows to {root} ({run_id}), pruned {pruned}")
+    return {
+        "run_id": run_id,
+        "archived": manifest["rows"],
+        "pruned": pruned,
+        "files": [entry["path"] for entry in manifest["files"]],
+    }
+
+
+async def verify_ledger_archive() -> list[dict]:
+    """Check every archive run against its manifest checksums"""
+    root = await ledger_archive_root()
+    manifests = await asyncio.to_thread(list_manifests, root)
+    report = []
+    for manifest in manifests:
+        bad = await asyncio.to_thread(verify_manifest, root, manifest)
+        report.append(
+            {
+                "run_id": manifest["run_id"],
+                "rows": manifest["rows"],
+                "older_than": manifest["older_than"],
+                "dates": [entry["date"] for entry in manifest["files"]],
+                "ok": not bad,
+                "bad_files": bad,
+            }
+        )
+    return report
+
+
+async def restore_ledger_archive(run_id: str, date: str | None = None) -> dict:
+    """Load the rows of an archive run (optionally one day of it) back into the ledger.
+
+    Files are verified against the manifest first. Restored rows are taken
+    out of the checkpoints again; rows already in the ledger are skipped.
+    Raises ValueError for an unknown run or a failed checksum.
+    """
+    root = await ledger_archive_root()
+    manifest = await asyncio.to_thread(load_manifest, root, run_id)
+    entries = [entry for entry in manifest["files"] if date is None or entry["date"] == date]
+    bad = await asyncio.to_thread(verify_manifest, root, {"files": entries})
+    if bad:
+        raise ValueError(f"Archive files failed verification: {', '.join(bad)}")
+
+    report: dict = {"run_id": run_id, "read": 0, "restored": 0}
+    for entry in entries:
+        handle = await asyncio.to_thread(open_archive_file, root, entry)
+        try:
+            while rows := await asyncio.to_thread(read_rows, handle, LEDGER_ARCHIVE_CHUNK_SIZE):
+                report["read"] += len(rows)
+                report["restored"] += await restore_transactions(rows)
+        finally:
+            handle.close()
+    logger.info(f"♻️ Restored {report['restored']} ledger rows from archive run {run_id}")
+    return report
+
+
+# header and fields of one CSV record
+CsvRow = tuple[list[str], list[str]]
+
+
+class _CsvFeed:
+    """Lines of a CSV upload for a single `csv.reader`, so quoted fields can span lines.
+
+    The upload arrives asynchronously but the reader pulls lines itself, so
+    lines are buffered until their quotes balance and only then parsed; the
+    reader never runs out of input in the middle of a record.
+    """
+
+    def __init__(self):
+        self.lines: deque[tuple[int, str]] = deque()
+        self.quotes = 0
+        self.header: list[str] | None = None
+        self.reader = csv.reader(self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()[1] + "\n"
+
+    def add(self, line_no: int, line: str) -> bool:
+        """Buffer a line, returns True once the buffer ends on a record boundary"""
+        if not self.lines and not line.strip():
+            return False
+        self.lines.append((line_no, line))
+        self.quotes += line.count('"')
+        return self.quotes % 2 == 0
+
+    def records(self) -> list[tuple[int, CsvRow]]:
+        """Parse the buffered lines into rows with the header, and the line each starts on"""
+        rows = []
+        while self.lines:
+            line_no = self.lines[0][0]
+            fields = next(self.reader)
+            if not fields:
+                continue
+            if self.header is None:
+                self.header = [field.strip() for field in fields]
+            else:
+                rows.append((line_no, (self.header, fields)))
+        self.quotes = 0
+        return rows
+
+
+async def _csv_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, CsvRow]]:
+    feed = _CsvFeed()
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        if feed.add(line_no, line):
+            for record in feed.records():
+                yield record
+    # an unterminated quoted field runs to the end of the upload
+    for record in feed.records():
+        yield record
+
+
+async def _ndjson_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, str]]:
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        if line.strip():
+            yield line_no, line
+
+
+def _parse_import_row(raw: CsvRow | str) -> ImportUserRow:
+    """Validate a CSV row with its header or an NDJSON line"""
+    if isinstance(raw, str):
+        record = json.loads(raw)
+        if not isinstance(record, dict):
+            raise ValueError("expected a JSON object")
+    else:
+        header, fields = raw
+        if len(fields) != len(header):
+            raise ValueError(f"expected {len(header)} fields like the header, got {len(fields)}")
+        record = dict(zip(header, fields, strict=True))
+    values = {
+        IMPORT_COLUMN_ALIASES.get(key.strip(), key.strip()): value
+        for key, value in record.items()
+        if key and value not in (None, "")
+    }
+    row = ImportUserRow(**values)
+    if not row.npub.startswith("npub1"):
+        raise ValueError("npub must start with npub1")
+    return row
+
+
+async def _import_batch(batch: list[ImportUserRow], report: dict, dry_run: bool) -> None:
+    diffs = await import_users_batch(batch, dry_run=dry_run)
+    for diff in diffs:
+        report[diff["action"]] += 1
+        if dry_run and diff["action"] != "unchanged" and len(report["diff"]) < IMPORT_MAX_REPORTED:
+            report["diff"].append(diff)
+
+
+async def import_users(lines: AsyncIterator[str], fmt: str = "csv", dry_run: bool = True) -> dict:
+    """Import users and balances from CSV (with header) or NDJSON lines.
+
+    Rows are validated as they arrive; invalid or repeated rows are reported
+    by line number and skipped. Valid rows are written in batches of
+    `IMPORT_BATCH_SIZE`, each batch one transaction. With `dry_run` nothing
+    is written and the report includes the per-user diff.
+    """
+    report: dict = {
+        "dry_run": dry_run,
+        "rows": 0,
+        "create": 0,
+        "update": 0,
+        "unchanged": 0,
+        "error_count": 0,
+        "errors": [],
+        "diff": [],
+    }
+    seen: set[str] = set()
+    batch: list[ImportUserRow] = []
+
+    records = _csv_records(lines) if fmt == "csv" else _ndjson_records(lines)
+    async for line_no, raw in records:
+        try:
+            row = _parse_import_row(raw)
+            if row.npub in seen:
+                raise ValueError(f"{row.npub} appears more than once")
+        except Exception as exc:
+            report["error_count"] += 1
+            if len(report["errors"]) < IMPORT_MAX_REPORTED:
+                report["errors"].append({"line": line_no, "error": str(exc)})
+            continue
+
+        seen.add(row.npub)
+        report["rows"] += 1
+        batch.append(row)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await _import_batch(batch, report, dry_run)
+            batch = []
+    if batch:
+        await _import_batch(batch, report, dry_run)
+
+    logger.info(
+        f"📥 User import: {report['create']} created, {report['update']} updated, "
+        f"{report['error_count']} invalid, dry_run={dry_run}"
+    )
+    return report
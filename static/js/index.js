@@ -1,3 +1,6 @@
+// Chart.js instance kept outside Vue so it is not made reactive
+let usageChart = null
+
 window.app = Vue.createApp({
   el: '#vue',
   mixins: [windowMixin],
@@ -12,8 +15,13 @@ window.app = Vue.createApp({
         total_messages: 0
       },
 
+      // Usage Analytics
+      usageBucket: 'hour',
+      usageLoading: false,
+
       // User Management
       userList: [],
+      userNextCursor: null,
       selectedUsers: [],
       selectAll: false,
       userTable: {
@@ -41,7 +49,8 @@ window.app = Vue.createApp({
       userDetailsDialog: {
         show: false,
         user: null,
-        transactions: []
+        transactions: [],
+        nextCursor: null
       },
 
       // Settings
@@ -93,6 +102,7 @@ window.app = Vue.createApp({
 
       // Recent Transactions
       transactionList: [],
+      transactionNextCursor: null,
       transactionTable: {
         loading: false,
         columns: [
@@ -155,17 +165,69 @@ window.app = Vue.createApp({
       }
     },
 
+    //////////////// Analytics ////////////////////////
+    async getUsageTimeseries() {
+      try {
+        this.usageLoading = true
+        const {data} = await LNbits.api.request(
+          'GET',
+          `/bitsatcredit/api/v1/analytics/timeseries?bucket=${this.usageBucket}`,
+          this.g.user.wallets[0].adminkey
+        )
+        this.renderUsageChart(data)
+      } catch (error) {
+        LNbits.utils.notifyApiError(error)
+      } finally {
+        this.usageLoading = false
+      }
+    },
+
+    renderUsageChart(points) {
+      const labels = points.map(p => {
+        const date = new Date(p.bucket_start * 1000)
+        return this.usageBucket === 'hour'
+          ? date.toLocaleString([], {month: 'short', day: 'numeric', hour: '2-digit'})
+          : date.toLocaleDateString()
+      })
+      const datasets = [
+        {type: 'bar', label: 'Messages', data: points.map(p => p.messages), yAxisID: 'messages'},
+        {type: 'line', label: 'Deposited (sats)', data: points.map(p => p.deposit_sats), yAxisID: 'sats'},
+        {type: 'line', label: 'Spent (sats)', data: points.map(p => p.spend_sats), yAxisID: 'sats'}
+      ]
+
+      if (usageChart) {
+        usageChart.data.labels = labels
+        usageChart.data.datasets = datasets
+        usageChart.update()
+        return
+      }
+      usageChart = new Chart(this.$refs.usageChart, {
+        data: {labels, datasets},
+        options: {
+          responsive: true,
+          maintainAspectRatio: false,
+          scales: {
+            messages: {type: 'linear', position: 'left', beginAtZero: true},
+            sats: {type: 'linear', position: 'right', beginAtZero: true, grid: {drawOnChartArea: false}}
+          }
+        }
+      })
+    },
+
     //////////////// Users ////////////////////////
-    async getUsers() {
+    async getUsers(cursor = null) {
       try {
         this.userTable.loading = true
+        const query = cursor ? `&cursor=${cursor}` : ''
         const {data} = await LNbits.api.request(
           'GET',
-          '/bitsatcredit/api/v1/users?limit=100&offset=0',
+          `/bitsatcredit/api/v1/users?limit=100${query}`,
           null
         )
-        this.userList = data
-        this.userTable.pagination.rowsNumber = data.length
+        // Keyset pages: a cursor appends the next page, no cursor reloads
+        this.userList = cursor ? this.userList.concat(data.data) : data.data
+        this.userNextCursor = data.next_cursor
+        this.userTable.pagination.rowsNumber = this.userList.length
       } catch (error) {
         LNbits.utils.notifyApiError(error)
       } finally {
@@ -173,18 +235,39 @@ window.app = Vue.createApp({
       }
     },
 
+    async loadMoreUsers() {
+      await this.getUsers(this.userNextCursor)
+    },
+
     async showUserDetails(user) {
       try {
         this.userDetailsDialog.user = user
         this.userDetailsDialog.show = true
+        this.userDetailsDialog.transactions = []
+        this.userDetailsDialog.nextCursor = null
 
         // Fetch user's transaction history
-        const {data} = await LNbits.api.request(
-          'GET',
-          `/bitsatcredit/api/v1/user/${user.npub}/transactions`,
-          null
-        )
-        this.userDetailsDialog.transactions = data
+        await this.loadUserTransactions()
+      } catch (error) {
+        LNbits.utils.notifyApiError(error)
+      }
+    },
+
+    async loadUserTransactions() {
+      const cursor = this.userDetailsDialog.nextCursor
+      const query = cursor ? `?cursor=${cursor}` : ''
+      const {data} = await LNbits.api.request(
+        'GET',
+        `/bitsatcredit/api/v1/user/${this.userDetailsDialog.user.npub}/transactions${query}`,
+        null
+      )
+      this.userDetailsDialog.transactions = this.userDetailsDialog.transactions.concat(data.data)
+      this.userDetailsDialog.nextCursor = data.next_cursor
+    },
+
+    async loadMoreUserTransactions() {
+      try {
+        await this.loadUserTransactions()
       } catch (error) {
         LNbits.utils.notifyApiError(error)
       }
@@ -199,16 +282,18 @@ window.app = Vue.createApp({
     },
 
     //////////////// Transactions ////////////////////////
-    async getRecentTransactions() {
+    async getRecentTransactions(cursor = null) {
       try {
         this.transactionTable.loading = true
+        const query = cursor ? `&cursor=${cursor}` : ''
         const {data} = await LNbits.api.request(
           'GET',
-          '/bitsatcredit/api/v1/transactions/recent?limit=50',
+          `/bitsatcredit/api/v1/transactions/recent?limit=50${query}`,
           null
         )
-        this.transactionList = data
-        this.transactionTable.pagination.rowsNumber = data.length
+        this.transactionList = cursor ? this.transactionList.concat(data.data) : data.data
+        this.transactionNextCursor = data.next_cursor
+        this.transactionTable.pagination.rowsNumber = this.transactionList.length
       } catch (error) {
         LNbits.utils.notifyApiError(error)
       } finally {
@@ -216,6 +301,10 @@ window.app = Vue.createApp({
       }
     },
 
+    async loadMoreTransactions() {
+      await this.getRecentTransactions(this.transactionNextCursor)
+    },
+
     //////////////// Utils ////////////////////////
     dateFromNow(date) {
       return moment(date * 1000).fromNow()  // Convert unix timestamp (seconds) to milliseconds
@@ -242,19 +331,6 @@ window.app = Vue.createApp({
     },
 
     //////////////// Settings ////////////////////////
-    async getPricePerMessage() {
-      try {
-        const {data} = await LNbits.api.request(
-          'GET',
-          '/bitsatcredit/api/v1/settings/price',
-          null
-        )
-        this.pricePerMessage = data.price_per_message_sats
-      } catch (error) {
-        console.error('Error fetching price:', error)
-      }
-    },
-
     async savePriceSetting() {
       try {
         if (!this.pricePerMessage || this.pricePerMessage < 1) {
@@ -317,18 +393,20 @@ window.app = Vue.createApp({
       })
     },
 
-    async getSystemStatus() {
+    async getConfig() {
       try {
+        // Status, message and price in one request
         const {data} = await LNbits.api.request(
           'GET',
-          '/bitsatcredit/api/v1/system/status',
+          '/bitsatcredit/api/v1/config',
           null
         )
         this.systemStatus = data.status
         this.systemOnline = data.is_online
         this.systemStatusMessage = data.message || ''
+        this.pricePerMessage = data.price_per_message_sats
       } catch (error) {
-        console.error('Error fetching system status:', error)
+        console.error('Error fetching config:', error)
       }
     },
 
@@ -589,29 +667,22 @@ window.app = Vue.createApp({
           return
         }
 
-        // Add credits to each selected user
-        let successCount = 0
-        for (const npub of this.selectedUsers) {
-          try {
-            await LNbits.api.request(
-              'POST',
-              `/bitsatcredit/api/v1/admin/add-credits`,
-              this.g.user.wallets[0].adminkey,
-              {
-                npub: npub,
-                amount: amount,
-                memo: memo
-              }
-            )
-            successCount++
-          } catch (error) {
-            console.error(`Failed to add credits to ${npub}:`, error)
+        // One request, applied in a single transaction on the server
+        const {data} = await LNbits.api.request(
+          'POST',
+          '/bitsatcredit/api/v1/admin/add-credits/bulk',
+          this.g.user.wallets[0].adminkey,
+          {
+            npubs: this.selectedUsers,
+            amount: amount,
+            memo: memo
           }
-        }
+        )
+        const creditedCount = data.filter(r => r.status !== 'duplicate').length
 
         Quasar.Notify.create({
           type: 'positive',
-          message: `Added ${amount} sats to ${successCount} user(s)`,
+          message: `Added ${amount} sats to ${creditedCount} user(s)`,
           timeout: 3000
         })
 
@@ -633,8 +704,8 @@ window.app = Vue.createApp({
     await this.getStats()
     await this.getUsers()
     await this.getRecentTransactions()
-    await this.getSystemStatus()
-    await this.getPricePerMessage()
+    await this.getUsageTimeseries()
+    await this.getConfig()
 
     // Load wallet options and settings
     this.loadWalletOptions()
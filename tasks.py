@@ -1,48 +1,254 @@
 import asyncio
+import time
+import traceback
 
 from lnbits.core.models import Payment
 from lnbits.tasks import register_invoice_listener
 from loguru import logger
 
-from .services import process_topup_payment
+from .crud import expire_holds, reconcile_system_totals
+from .metrics import CollectedCounter, Gauge, current_operation, registry, settlement_seconds
+from .pubsub import topup_hub
+from .services import archive_ledger, process_topup_payment, reconcile_unpaid_topups, sweep_topups
+from .tracing import annotate, tracer
+
+HOLD_SWEEP_INTERVAL_SECONDS = 30
+TOTALS_RECONCILE_INTERVAL_SECONDS = 3600
+TOPUP_RECONCILE_INTERVAL_SECONDS = 900
+TOPUP_SWEEP_INTERVAL_SECONDS = 600
+LEDGER_ARCHIVE_INTERVAL_SECONDS = 86400
+
+INVOICE_WORKERS = 4
+INVOICE_WORKER_QUEUE_SIZE = 100
+INVOICE_MAX_ATTEMPTS = 5
+INVOICE_RETRY_BASE_DELAY_SECONDS = 0.5
 
 #######################################
 ########## PAYMENT LISTENER ###########
 #######################################
 
-# Listen for Lightning invoice payments and process top-ups
+# Listen for Lightning invoice payments and process top-ups.
+# Payments are sharded by npub over a pool of workers: different users are
+# settled concurrently, the same user's payments stay in arrival order.
+
+
+class InvoiceWorkerStats:
+    """Queue depth and processing latency of the invoice worker pool"""
+
+    def __init__(self):
+        self.listener: asyncio.Queue | None = None
+        self.queues: list[asyncio.Queue] = []
+        self.processed = 0
+        self.failed = 0
+        self.retries = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def record(self, latency: float, success: bool) -> None:
+        if success:
+            self.processed += 1
+        else:
+            self.failed += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+    def snapshot(self) -> dict:
+        handled = self.processed + self.failed
+        return {
+            "workers": len(self.queues),
+            "listener_queue_depth": self.listener.qsize() if self.listener else 0,
+            "queue_depth": sum(queue.qsize() for queue in self.queues),
+            "processed": self.processed,
+            "failed": self.failed,
+            "retries": self.retries,
+            "last_latency_seconds": round(self.last_latency, 4),
+            "max_latency_seconds": round(self.max_latency, 4),
+            "avg_latency_seconds": round(self.total_latency / handled, 4) if handled else 0.0,
+        }
+
+
+invoice_worker_stats = InvoiceWorkerStats()
+
+registry.register(
+    Gauge(
+        "bitsatcredit_invoice_queue_depth",
+        "Paid invoices waiting in the listener queue and the worker queues",
+        lambda: {
+            ("listener",): invoice_worker_stats.listener.qsize() if invoice_worker_stats.listener else 0,
+            ("workers",): sum(queue.qsize() for queue in invoice_worker_stats.queues),
+        },
+        ("queue",),
+    )
+)
+registry.register(
+    CollectedCounter(
+        "bitsatcredit_invoices_processed_total",
+        "Paid invoices handled by the workers",
+        lambda: {("success",): invoice_worker_stats.processed, ("failed",): invoice_worker_stats.failed},
+        ("result",),
+    )
+)
 
 
 async def wait_for_paid_invoices():
     invoice_queue = asyncio.Queue()
     register_invoice_listener(invoice_queue, "ext_bitsatcredit")
+    invoice_worker_stats.listener = invoice_queue
+
+    # Bounded worker queues: when they are full the dispatcher stops pulling
+    # from the listener queue instead of buffering without limit
+    worker_queues: list[asyncio.Queue] = [
+        asyncio.Queue(maxsize=INVOICE_WORKER_QUEUE_SIZE) for _ in range(INVOICE_WORKERS)
+    ]
+    invoice_worker_stats.queues = worker_queues
+    workers = [asyncio.create_task(invoice_worker(queue)) for queue in worker_queues]
 
-    logger.info("BitSatCredit payment listener started")
+    logger.info(f"BitSatCredit payment listener started with {INVOICE_WORKERS} workers")
 
+    try:
+        while True:
+            payment = await invoice_queue.get()
+            shard_key = payment.extra.get("npub") or payment.payment_hash
+            queue = worker_queues[hash(shard_key) % len(worker_queues)]
+            await queue.put((time.monotonic(), payment))
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+
+async def invoice_worker(queue: asyncio.Queue):
+    current_operation.set("invoice_worker")
     while True:
-        payment = await invoice_queue.get()
-        await on_invoice_paid(payment)
+        received_at, payment = await queue.get()
+        try:
+            with tracer.trace("invoice_worker"):
+                outcome = await on_invoice_paid(payment)
+            latency = time.monotonic() - received_at
+            invoice_worker_stats.record(latency, outcome != "failed")
+            # only top-ups credited by this call count towards settlement lag
+            if outcome == "credited":
+                settlement_seconds.observe(latency)
+        finally:
+            queue.task_done()
 
 
-async def on_invoice_paid(payment: Payment) -> None:
-    """Process paid invoices - credits user balance automatically"""
+async def on_invoice_paid(payment: Payment) -> str:
+    """Process paid invoices - credits user balance automatically.
 
-    logger.info(f"Payment received: {payment.payment_hash}, tag: {payment.extra.get('tag', 'NO TAG')}, amount: {payment.amount} msat")
+    Database errors are retried with exponential backoff. Returns 'credited'
+    if this call credited a top-up, 'skipped' for other payments and top-ups
+    that were already paid, or 'failed' if the payment could not be processed.
+    """
+    annotate(payment_hash=payment.payment_hash, tag=payment.extra.get("tag"), amount_msat=payment.amount)
 
     # Check if this payment is for a top-up
-    if payment.extra.get("tag") == "bitsatcredit_topup":
-        logger.info(f"✅ Top-up invoice paid: {payment.payment_hash}")
+    if payment.extra.get("tag") != "bitsatcredit_topup":
+        # every payment on the node comes through here, format lazily
+        logger.debug(
+            "⏭️ Ignoring non-topup payment: {}, tag: {}", payment.payment_hash, payment.extra.get("tag", "NO TAG")
+        )
+        return "skipped"
+
+    for attempt in range(1, INVOICE_MAX_ATTEMPTS + 1):
+        try:
+            if await process_topup_payment(payment):
+                # wake public pages waiting on this invoice
+                topup_hub.publish(payment.payment_hash)
+                return "credited"
+            logger.warning(f"⚠️ Payment not processed (wrong tag or already paid): {payment.payment_hash}")
+            return "skipped"
+        except Exception as e:
+            if attempt == INVOICE_MAX_ATTEMPTS:
+                logger.error(
+                    f"❌ Error processing top-up payment {payment.payment_hash}, giving up after {attempt} attempts: {e}"
+                )
+                logger.error(traceback.format_exc())
+                return "failed"
+
+            delay = INVOICE_RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1)
+            invoice_worker_stats.retries += 1
+            logger.warning(
+                f"⚠️ Error processing top-up payment {payment.payment_hash} (attempt {attempt}), retrying in {delay}s: {e}"
+            )
+            await asyncio.sleep(delay)
+    return "failed"
+
+
+#######################################
+########### HOLD SWEEPER ##############
+#######################################
+
+# Return expired credit holds to the user's available balance
+
+
+async def expire_holds_periodically():
+    logger.info("BitSatCredit hold sweeper started")
+    current_operation.set("hold_sweeper")
+
+    while True:
+        try:
+            expired = await expire_holds()
+            if expired:
+                logger.info(f"⏱️ Released {expired} expired credit hold(s)")
+        except Exception as e:
+            logger.error(f"❌ Error expiring credit holds: {e}")
+        await asyncio.sleep(HOLD_SWEEP_INTERVAL_SECONDS)
+
+
+#######################################
+######## TOTALS RECONCILIATION ########
+#######################################
+
+# Check the incrementally maintained system totals against the real sums
+
+
+async def reconcile_system_totals_periodically():
+    current_operation.set("totals_reconcile")
+    while True:
+        await asyncio.sleep(TOTALS_RECONCILE_INTERVAL_SECONDS)
+        try:
+            drift = await reconcile_system_totals()
+            if drift:
+                logger.warning(f"⚠️ System totals drifted and were repaired: {drift}")
+        except Exception as e:
+            logger.error(f"❌ Error reconciling system totals: {e}")
+
+
+#######################################
+######## TOP-UP RECONCILIATION ########
+#######################################
+
+# Credit top-ups whose payment event was missed (restart, listener gap).
+# Runs once at startup and then on a schedule.
+
+
+async def reconcile_topups_periodically():
+    current_operation.set("topup_reconcile")
+    while True:
+        try:
+            await reconcile_unpaid_topups()
+        except Exception as e:
+            logger.error(f"❌ Error reconciling unpaid top-ups: {e}")
+        await asyncio.sleep(TOPUP_RECONCILE_INTERVAL_SECONDS)
 
+
+async def sweep_topups_periodically():
+    current_operation.set("topup_sweeper")
+    while True:
+        try:
+            await sweep_topups()
+        except Exception as e:
+            logger.error(f"❌ Error sweeping top-up requests: {e}")
+        await asyncio.sleep(TOPUP_SWEEP_INTERVAL_SECONDS)
+
+
+async def archive_ledger_periodically():
+    current_operation.set("ledger_archive")
+    while True:
         try:
-            success = await process_topup_payment(payment)
-            if success:
-                npub = payment.extra.get("npub", "unknown")
-                logger.info(f"💰 User {npub[:16]}... credited with {payment.amount} msat")
-            else:
-                logger.warning(f"⚠️ Payment not processed (wrong tag or already paid): {payment.payment_hash}")
+            await archive_ledger()
         except Exception as e:
-            logger.error(f"❌ Error processing top-up payment {payment.payment_hash}: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
-    else:
-        logger.debug(f"⏭️ Ignoring non-topup payment: {payment.payment_hash}, tag: {payment.extra.get('tag', 'NO TAG')}")
+            logger.error(f"❌ Error archiving ledger: {e}")
+        await asyncio.sleep(LEDGER_ARCHIVE_INTERVAL_SECONDS)
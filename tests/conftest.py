@@ -0,0 +1,29 @@
+import re
+
+import pytest_asyncio
+from lnbits.db import Database
+from lnbits.settings import settings
+
+from .. import crud, migrations
+from ..cache import settings_snapshot, user_cache
+from ..ratelimit import invoice_limiter
+
+
+# fresh sqlite database per test with all migrations applied
+@pytest_asyncio.fixture
+async def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "lnbits_data_folder", str(tmp_path))
+    test_db = Database("ext_bitsatcredit")
+    monkeypatch.setattr(crud, "db", test_db)
+    user_cache.clear()
+    settings_snapshot.clear()
+    invoice_limiter.clear()
+
+    matcher = re.compile(r"^m\d\d\d_")
+    async with test_db.connect() as conn:
+        for key, migrate in list(migrations.__dict__.items()):
+            if matcher.match(key):
+                await migrate(conn)
+
+    yield test_db
+    await test_db.engine.dispose()
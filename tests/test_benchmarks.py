@@ -0,0 +1,74 @@
+from pathlib import Path
+
+import pytest
+from lnbits.db import SQLITE
+from lnbits.settings import settings
+
+from ..benchmarks.bench import OPERATIONS, bench_npub, open_database, run_suite, seed_users
+from ..benchmarks.simulate import check_invariants, parse_args, simulate
+
+
+# keeps the benchmark suite runnable, the numbers themselves are not checked
+@pytest.mark.asyncio
+async def test_benchmark_smoke(db):
+    results = await run_suite([20, 50], requests=10, concurrency=2)
+    assert [(r["users"], r["operation"]) for r in results] == [
+        (users, operation) for users in (20, 50) for operation in OPERATIONS
+    ]
+    assert all(r["errors"] == 0 and r["requests"] == 10 for r in results)
+
+
+@pytest.mark.asyncio
+async def test_simulation_smoke(db):
+    args = parse_args(
+        [
+            "--users",
+            "50",
+            "--balance",
+            "20",
+            "--duration",
+            "1",
+            "--relays",
+            "4",
+            "--pass-interval",
+            "0.3",
+            "--pass-size",
+            "20",
+            "--topup-clients",
+            "2",
+            "--topup-delay",
+            "0.05",
+            "--duplicate-rate",
+            "0.5",
+            "--admin-interval",
+            "0.3",
+        ]
+    )
+    report = await simulate(args)
+    assert report["counters"]["messages"] > 0 and report["counters"]["topups_credited"] > 0
+    assert report["violations"] == []
+
+
+@pytest.mark.asyncio
+async def test_invariant_check_catches_drift(db):
+    await seed_users(0, 5, balance=100, ledger=True)
+    assert await check_invariants() == []
+
+    await db.execute("UPDATE bitsatcredit.users SET balance_sats = 90 WHERE npub = :npub", {"npub": bench_npub(3)})
+    checks = [violation["check"] for violation in await check_invariants()]
+    assert checks == ["user_ledger", "system_totals"]
+
+
+@pytest.mark.asyncio
+async def test_open_database_uses_a_scratch_data_folder(db, monkeypatch):
+    monkeypatch.setattr(settings, "lnbits_data_folder", "/nonexistent/lnbits-data")
+    with pytest.raises(RuntimeError, match="LNBITS_DATABASE_URL"):
+        await open_database(postgres=True)
+
+    bench_db = await open_database()
+    try:
+        assert bench_db.type == SQLITE
+        assert settings.lnbits_data_folder != "/nonexistent/lnbits-data"
+        assert list(Path(settings.lnbits_data_folder).glob("*.sqlite3"))
+    finally:
+        await bench_db.engine.dispose()
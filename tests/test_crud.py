@@ -0,0 +1,322 @@
+import asyncio
+import time
+
+import pytest
+
+from ..cache import settings_snapshot, user_cache
+from ..crud import (
+    add_credits_batch,
+    backfill_usage_rollups,
+    compact_topups,
+    create_hold,
+    create_topup_request,
+    create_transaction,
+    delete_user,
+    expire_holds,
+    expire_topups,
+    get_all_users,
+    get_hold,
+    get_npubs,
+    get_or_create_user,
+    get_setting,
+    get_system_stats,
+    get_topup_by_payment_hash,
+    get_usage_timeseries,
+    get_user,
+    get_user_transactions,
+    mark_topup_paid,
+    reconcile_system_totals,
+    set_setting,
+    set_user_memo,
+    settle_hold,
+    spend_credits,
+    spend_credits_batch,
+    stream_transactions,
+    stream_users,
+    update_user_balance,
+    update_user_stats,
+)
+from ..helpers import export_lines
+from ..models import BatchSpendItem, CreateTransaction
+
+NPUB = "npub1testuser"
+
+
+@pytest.mark.asyncio
+async def test_spend_credits(db):
+    await get_or_create_user(NPUB)
+    await update_user_balance(NPUB, 10)
+
+    user = await spend_credits(NPUB, 3, "relay message")
+    assert user
+    assert user.balance_sats == 7
+    assert user.total_spent == 3
+    assert user.message_count == 1
+
+    transactions = await get_user_transactions(NPUB)
+    assert [(t.type, t.amount_sats, t.memo) for t in transactions if t.type == "spend"] == [
+        ("spend", 3, "relay message")
+    ]
+
+
+@pytest.mark.asyncio
+async def test_spend_credits_rejects(db):
+    assert await spend_credits(NPUB, 1) is None
+
+    await get_or_create_user(NPUB)
+    await update_user_balance(NPUB, 5)
+
+    # concurrent spends can never overdraw
+    results = await asyncio.gather(*[spend_credits(NPUB, 2) for _ in range(5)])
+    assert len([r for r in results if r]) == 2
+
+    user = await get_user(NPUB)
+    assert user
+    assert user.balance_sats == 1
+    assert user.message_count == 2
+
+    for amount in (0, -5):
+        with pytest.raises(ValueError):
+            await spend_credits(NPUB, amount)
+    user = await get_user(NPUB)
+    assert user
+    assert user.balance_sats == 1
+
+
+@pytest.mark.asyncio
+async def test_spend_credits_batch(db):
+    await get_or_create_user(NPUB)
+    await update_user_balance(NPUB, 5)
+
+    items = [
+        BatchSpendItem(npub=NPUB, amount=2, idempotency_key="a"),
+        BatchSpendItem(npub=NPUB, amount=2, idempotency_key="a"),
+        BatchSpendItem(npub=NPUB, amount=2, idempotency_key="b"),
+        BatchSpendItem(npub=NPUB, amount=2, idempotency_key="c"),
+        BatchSpendItem(npub="npub1unknown", amount=1),
+    ]
+    results = await spend_credits_batch(items)
+    assert [r.status for r in results] == ["spent", "duplicate", "spent", "insufficient_funds", "not_found"]
+    assert results[0].balance_sats == 1
+
+    # replaying the batch charges nothing
+    results = await spend_credits_batch(items[:3])
+    assert [r.status for r in results] == ["duplicate", "duplicate", "duplicate"]
+
+    transactions = await get_user_transactions(NPUB)
+    assert sorted(t.idempotency_key for t in transactions if t.type == "spend") == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_user_cache_write_through(db):
+    await get_or_create_user(NPUB)
+    await update_user_balance(NPUB, 10)
+    await spend_credits(NPUB, 4)
+    await set_user_memo(NPUB, "vip")
+
+    hits = user_cache.hits
+    user = await get_user(NPUB)
+    assert user_cache.hits == hits + 1
+    assert user
+    assert (user.balance_sats, user.total_spent, user.memo) == (6, 4, "vip")
+
+    await delete_user(NPUB)
+    assert await get_user(NPUB) is None
+
+
+@pytest.mark.asyncio
+async def test_credit_holds(db):
+    await get_or_create_user(NPUB)
+    await update_user_balance(NPUB, 10)
+
+    assert await create_hold(NPUB, 11, 60) is None
+    hold = await create_hold(NPUB, 6, 60)
+    assert hold
+    user = await get_user(NPUB)
+    assert user
+    assert (user.balance_sats, user.held_sats) == (4, 6)
+
+    captured = await settle_hold(hold.id, "captured", 4, messages=2)
+    assert captured
+    assert captured.status == "captured"
+    assert await settle_hold(hold.id, "released") is None
+
+    user = await get_user(NPUB)
+    assert user
+    assert (user.balance_sats, user.held_sats, user.total_spent, user.message_count) == (6, 0, 4, 2)
+
+    lapsed = await create_hold(NPUB, 5, -1)
+    assert lapsed
+    assert await settle_hold(lapsed.id, "captured", 5, messages=1) is None
+    lapsed_hold = await get_hold(lapsed.id)
+    assert lapsed_hold
+    assert (lapsed_hold.status, lapsed_hold.captured_sats) == ("expired", 0)
+    user = await get_user(NPUB)
+    assert user
+    assert (user.balance_sats, user.held_sats, user.total_spent) == (6, 0, 4)
+
+    expiring = await create_hold(NPUB, 5, -1)
+    assert expiring
+    assert await expire_holds() == 1
+    user = await get_user(NPUB)
+    assert user
+    assert (user.balance_sats, user.held_sats) == (6, 0)
+
+
+@pytest.mark.asyncio
+async def test_keyset_pagination(db):
+    await get_or_create_user(NPUB)
+    await update_user_balance(NPUB, 100)
+    for _ in range(25):
+        await spend_credits(NPUB, 1)
+    for i in range(5):
+        await get_or_create_user(f"npub1other{i}")
+
+    seen: list[str] = []
+    after = None
+    while page := await get_user_transactions(NPUB, limit=10, after=after):
+        seen.extend(t.id for t in page)
+        after = (page[-1].created_at, page[-1].id)
+    assert len(seen) == len(set(seen)) == 25
+
+    first = await get_all_users(limit=4)
+    rest = await get_all_users(limit=4, after=(first[-1].updated_at, first[-1].npub))
+    assert len(first) + len(rest) == 6
+    assert not {u.npub for u in first} & {u.npub for u in rest}
+
+
+@pytest.mark.asyncio
+async def test_system_totals_stay_in_sync(db):
+    await get_or_create_user(NPUB)
+    await update_user_balance(NPUB, 20)
+    await update_user_balance("npub1other", 7)
+    await spend_credits(NPUB, 2)
+    await spend_credits_batch([BatchSpendItem(npub=NPUB, amount=3)])
+    hold = await create_hold(NPUB, 5, 60)
+    assert hold
+    await settle_hold(hold.id, "captured", 1, messages=1)
+    await create_hold(NPUB, 2, 60)
+    await update_user_stats(NPUB, message_count=10)
+    await delete_user("npub1other")
+
+    stats = await get_system_stats()
+    assert stats["total_users"] == 1
+    assert stats["total_balance"] == 12
+    assert stats["total_held"] == 2
+    assert stats["total_messages"] == 10
+    assert await reconcile_system_totals() == {}
+
+
+@pytest.mark.asyncio
+async def test_usage_rollups(db):
+    await get_or_create_user(NPUB)
+    await update_user_balance(NPUB, 10)
+    await create_transaction(CreateTransaction(npub=NPUB, type="deposit", amount_sats=10))
+    await spend_credits(NPUB, 2)
+    await spend_credits_batch([BatchSpendItem(npub=NPUB, amount=1), BatchSpendItem(npub=NPUB, amount=1)])
+
+    now = int(time.time())
+    for bucket in ("hour", "day"):
+        points = await get_usage_timeseries(bucket, now - 86400, now)
+        assert sum(p.deposit_sats for p in points) == 10
+        assert sum(p.spend_sats for p in points) == 4
+        assert sum(p.messages for p in points) == 3
+
+    live = await get_usage_timeseries("hour", now - 3600, now)
+    await backfill_usage_rollups()
+    assert await get_usage_timeseries("hour", now - 3600, now) == live
+
+
+@pytest.mark.asyncio
+async def test_settings_snapshot(db):
+    assert await get_setting("price_per_message") == "1"
+    version = settings_snapshot.version
+
+    await set_setting("price_per_message", "3")
+    assert await get_setting("price_per_message") == "3"
+    assert settings_snapshot.version > version
+
+
+@pytest.mark.asyncio
+async def test_mark_topup_paid_is_idempotent(db):
+    await create_topup_request(NPUB, 21, "hash1", "lnbc1")
+
+    results = await asyncio.gather(*[mark_topup_paid("hash1") for _ in range(3)])
+    assert sorted(results) == [False, False, True]
+    assert await mark_topup_paid("unknown") is False
+
+    user = await get_user(NPUB)
+    assert user
+    assert (user.balance_sats, user.total_deposited) == (21, 21)
+    deposits = [t for t in await get_user_transactions(NPUB) if t.type == "deposit"]
+    assert [(t.amount_sats, t.payment_hash) for t in deposits] == [(21, "hash1")]
+    topup = await get_topup_by_payment_hash("hash1")
+    assert topup
+    assert topup.paid
+
+
+@pytest.mark.asyncio
+async def test_expire_and_compact_topups(db):
+    now = int(time.time())
+    for i in range(5):
+        await create_topup_request(NPUB, 10, f"hash{i}", "lnbc1", expires_at=now - 60 if i < 3 else now + 3600)
+    await mark_topup_paid("hash0")
+
+    assert await expire_topups(chunk_size=1) == 2
+    assert await expire_topups() == 0
+    assert [(await get_topup_by_payment_hash(f"hash{i}")).expired for i in range(5)] == [
+        False, True, True, False, False
+    ]
+
+    # paid rows are never compacted, unpaid ones go to the archive in chunks
+    assert await compact_topups(now + 60, chunk_size=2) == 4
+    assert await get_topup_by_payment_hash("hash0")
+    assert await get_topup_by_payment_hash("hash1") is None
+    archived = await db.fetchall("SELECT payment_hash FROM bitsatcredit.topup_requests_archive")
+    assert sorted(row["payment_hash"] for row in archived) == ["hash1", "hash2", "hash3", "hash4"]
+
+
+@pytest.mark.asyncio
+async def test_stream_exports(db):
+    for i in range(5):
+        await update_user_balance(f"npub1user{i}", 10)
+        await spend_credits(f"npub1user{i}", 1, memo="msg, with comma")
+
+    chunks = [chunk async for chunk in stream_users(chunk_size=2)]
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert [row["npub"] for chunk in chunks for row in chunk] == [f"npub1user{i}" for i in range(5)]
+
+    rows = [row async for chunk in stream_transactions(npub="npub1user3", chunk_size=1) for row in chunk]
+    assert [row["type"] for row in rows] == ["spend"]
+    assert [chunk async for chunk in stream_transactions(since=int(time.time()) + 60)] == []
+
+    lines = "".join(
+        [line async for line in export_lines(stream_transactions(npub="npub1user3"), ["npub", "memo"])]
+    )
+    assert lines == 'npub,memo\nnpub1user3,"msg, with comma"\n'
+
+
+@pytest.mark.asyncio
+async def test_add_credits_batch(db, monkeypatch):
+    from .. import crud
+
+    monkeypatch.setattr(crud, "BULK_CHUNK_SIZE", 2)
+    await update_user_balance("npub1user0", 5)
+    assert await get_user("npub1user0")  # cached before the bulk write
+
+    npubs = ["npub1user0", "npub1user1", "npub1user2", "npub1user1"]
+    results = await add_credits_batch(npubs, 10, memo="campaign")
+    assert [(r.npub, r.status, r.balance_sats) for r in results] == [
+        ("npub1user0", "credited", 15),
+        ("npub1user1", "created", 10),
+        ("npub1user2", "created", 10),
+        ("npub1user1", "duplicate", 10),
+    ]
+    user = await get_user("npub1user0")
+    assert user
+    assert (user.balance_sats, user.total_deposited) == (15, 15)
+    deposits = await get_user_transactions("npub1user2")
+    assert [(t.type, t.amount_sats, t.memo) for t in deposits] == [("deposit", 10, "campaign")]
+    stats = await get_system_stats()
+    assert (stats["total_users"], stats["total_balance"], stats["total_deposited"]) == (3, 35, 35)
+    assert sorted(await get_npubs()) == ["npub1user0", "npub1user1", "npub1user2"]
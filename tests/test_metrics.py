@@ -0,0 +1,62 @@
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from .. import bitsatcredit_ext
+from ..crud import create_topup_request, create_user, mark_topup_paid
+from ..metrics import Histogram, instrument_database, registry
+from ..models import CreateUser
+
+NPUB = "npub1testuser"
+
+
+def sample(text: str, line_prefix: str) -> float:
+    values = [float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith(line_prefix)]
+    assert len(values) == 1, line_prefix
+    return values[0]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency_seconds", "Latency", ("path",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, "/a")
+    assert list(histogram.lines()) == [
+        'latency_seconds_bucket{path="/a",le="0.1"} 2',
+        'latency_seconds_bucket{path="/a",le="1.0"} 3',
+        'latency_seconds_bucket{path="/a",le="+Inf"} 4',
+        'latency_seconds_sum{path="/a"} 3.65',
+        'latency_seconds_count{path="/a"} 4',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(db):
+    instrument_database(db)
+    registry.reset()
+    app = FastAPI()
+    app.include_router(bitsatcredit_ext)
+
+    await create_user(CreateUser(npub=NPUB))
+    await create_topup_request(NPUB, 21, "hash1", "lnbc1")
+    await mark_topup_paid("hash1")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        assert (await client.post(f"/bitsatcredit/api/v1/user/{NPUB}/spend", params={"amount": 5})).status_code == 200
+        assert (await client.post(f"/bitsatcredit/api/v1/user/{NPUB}/spend", params={"amount": 50})).status_code == 402
+        response = await client.get("/bitsatcredit/api/v1/metrics")
+
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    spend = 'method="POST",path="/bitsatcredit/api/v1/user/{npub}/spend"'
+    assert sample(text, f"bitsatcredit_http_requests_total{{{spend},status=\"200\"}}") == 1
+    assert sample(text, f"bitsatcredit_http_requests_total{{{spend},status=\"402\"}}") == 1
+    assert sample(text, f"bitsatcredit_http_request_duration_seconds_count{{{spend}}}") == 2
+    assert sample(text, 'bitsatcredit_spend_rejections_total{endpoint="spend",reason="insufficient_funds"}') == 1
+    assert sample(text, "bitsatcredit_topups_created_total") == 1
+    assert sample(text, "bitsatcredit_topups_paid_total") == 1
+    assert sample(text, "bitsatcredit_topup_sats_paid_total") == 21
+    # statements are attributed to the endpoint that ran them
+    assert sample(text, 'bitsatcredit_db_statements_total{operation="Spend Credits"}') >= 4
+    assert 'bitsatcredit_db_statements_total{operation="other"}' in text
+    assert 'bitsatcredit_invoice_queue_depth{queue="workers"} 0' in text
+    assert "bitsatcredit_user_cache_hits_total" in text
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from ..crud import create_topup_request, mark_topup_paid
+from ..pubsub import TooManyWaitersError, TopUpHub, topup_hub
+from ..views_api import api_topup_events, api_wait_for_topup
+
+NPUB = "npub1testuser"
+
+
+@pytest.mark.asyncio
+async def test_hub_wakes_waiters_and_caps_them():
+    hub = TopUpHub(max_waiters=2)
+    with hub.subscribe("hash1") as first, hub.subscribe("hash1") as second:
+        with pytest.raises(TooManyWaitersError):
+            with hub.subscribe("hash2"):
+                pass
+        hub.publish("hash2")
+        hub.publish("hash1")
+        assert first.is_set() and second.is_set()
+    assert hub.stats()["waiters"] == 0 and not hub.events
+
+
+@pytest.mark.asyncio
+async def test_topup_events_stream(db):
+    await create_topup_request(NPUB, 21, "hash1", "lnbc1")
+    response = await api_topup_events("hash1")
+    stream = response.body_iterator
+
+    frame = asyncio.ensure_future(stream.__anext__())
+    await asyncio.sleep(0.05)
+    assert not frame.done() and topup_hub.stats()["waiters"] == 1
+
+    await mark_topup_paid("hash1")
+    topup_hub.publish("hash1")
+    event, data = (await frame).strip().split("\n")
+    assert event == "event: paid"
+    assert json.loads(data.removeprefix("data: ")) == {
+        "payment_hash": "hash1",
+        "amount_sats": 21,
+        "balance_sats": 21,
+    }
+    with pytest.raises(StopAsyncIteration):
+        await stream.__anext__()
+    assert topup_hub.stats()["waiters"] == 0
+
+    # already paid: answered straight away
+    response = await api_topup_events("hash1")
+    assert "event: paid" in await response.body_iterator.__anext__()
+
+
+@pytest.mark.asyncio
+async def test_wait_for_topup(db):
+    await create_topup_request(NPUB, 21, "hash1", "lnbc1", expires_at=int(time.time()) + 3600)
+
+    status = await api_wait_for_topup("hash1", timeout=0)
+    assert (status.paid, status.expired, status.balance_sats) == (False, False, None)
+
+    waiter = asyncio.ensure_future(api_wait_for_topup("hash1", timeout=5))
+    await asyncio.sleep(0.05)
+    await mark_topup_paid("hash1")
+    topup_hub.publish("hash1")
+    status = await asyncio.wait_for(waiter, 1)
+    assert (status.paid, status.amount_sats, status.balance_sats) == (True, 21, 21)
+
+    await create_topup_request(NPUB, 5, "hash2", "lnbc1", expires_at=int(time.time()) - 1)
+    status = await api_wait_for_topup("hash2", timeout=5)
+    assert (status.paid, status.expired) == (False, True)
@@ -0,0 +1,74 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import event
+
+from ..crud import (
+    create_hold,
+    delete_user,
+    expire_holds,
+    get_all_users,
+    get_npubs,
+    get_or_create_user,
+    get_recent_transactions,
+    get_system_stats,
+    get_topup_by_payment_hash,
+    get_unpaid_topups,
+    get_usage_timeseries,
+    get_user_transactions,
+    spend_credits,
+    stream_transactions,
+    stream_users,
+    update_user_balance,
+)
+
+NPUB = "npub1testuser"
+
+
+# every statement the hot and admin paths run must be served by an index
+@pytest.mark.asyncio
+async def test_no_full_table_scans(db):
+    statements: list[tuple[str, tuple]] = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")) and not executemany:
+            statements.append((statement, tuple(parameters)))
+
+    event.listen(db.engine.sync_engine, "before_cursor_execute", capture)
+    await get_or_create_user(NPUB)
+    await update_user_balance(NPUB, 10)
+    await spend_credits(NPUB, 1)
+    await create_hold(NPUB, 1, 60)
+    await expire_holds()
+    await get_user_transactions(NPUB)
+    await get_user_transactions(NPUB, after=(2**31, "id"))
+    await get_recent_transactions()
+    await get_recent_transactions(after=(2**31, "id"))
+    await get_all_users()
+    await get_all_users(after=(2**31, NPUB))
+    await get_npubs()
+    await get_npubs(active_since=0)
+    await get_topup_by_payment_hash("hash")
+    await get_system_stats()
+    await get_unpaid_topups(0)
+    await get_unpaid_topups(0, after=(0, "id"))
+    await get_usage_timeseries("hour", 0, 7200)
+    async for _ in stream_users(chunk_size=1):
+        pass
+    async for _ in stream_transactions(NPUB, since=0, chunk_size=1):
+        pass
+    async for _ in stream_transactions(since=0, until=2**31, chunk_size=1):
+        pass
+    await delete_user(NPUB)
+    event.remove(db.engine.sync_engine, "before_cursor_execute", capture)
+
+    assert statements
+    plan_db = sqlite3.connect(db.path)
+    plan_db.execute(f"ATTACH '{db.path}' AS bitsatcredit")
+    for statement, parameters in statements:
+        plan = plan_db.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+        details = [row[-1] for row in plan]
+        scans = [d for d in details if d.startswith("SCAN") and "USING" not in d]
+        sorts = [d for d in details if "TEMP B-TREE" in d]
+        assert not scans and not sorts, f"{statement.strip()} -> {details}"
+    plan_db.close()
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from .. import bitsatcredit_ext, ratelimit, services
+from ..crud import set_setting
+from ..ratelimit import RateLimitedError, RateLimiter, invoice_limiter
+from ..views_api import INVOICE_LIMIT_PER_IP, INVOICE_LIMIT_PER_NPUB, api_get_rate_limits
+
+
+def test_token_buckets(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    limiter = RateLimiter()
+
+    limits = [("ip", "1.2.3.4", 10), ("npub", "npub1a", 2)]
+    limiter.hit(limits)
+    limiter.hit(limits)
+    with pytest.raises(RateLimitedError) as exc:
+        limiter.hit(limits)
+    assert (exc.value.scope, exc.value.retry_after) == ("npub", 30)
+    # a rejected request takes no token from the other buckets
+    assert limiter.buckets[("ip", "1.2.3.4")][0] == 8
+
+    now[0] += 30
+    limiter.hit(limits)
+    limiter.hit([("ip", "1.2.3.4", 0), ("npub", "npub1b", 2)])  # 0 is not enforced
+    assert limiter.stats()["allowed"] == 4 and limiter.stats()["rejected"] == {"npub": 1}
+
+
+@pytest.mark.asyncio
+async def test_invoice_endpoints_are_rate_limited(db, monkeypatch):
+    invoices = []
+
+    async def fake_create_invoice(*, wallet_id: str, amount: int, **kwargs):
+        invoices.append(amount)
+        return SimpleNamespace(payment_hash=f"hash{len(invoices)}", bolt11="lnbc1")
+
+    monkeypatch.setattr(services, "create_invoice", fake_create_invoice)
+    invoice_limiter.rejected.clear()
+    await set_setting("invoice_limit_per_npub", "2")
+    await set_setting("invoice_limit_per_ip", "3")
+
+    app = FastAPI()
+    app.include_router(bitsatcredit_ext)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+
+        async def topup(npub):
+            return await client.post(
+                "/bitsatcredit/api/v1/topup", params={"wallet_id": "w"}, json={"npub": npub, "amount_sats": 21}
+            )
+
+        assert [(await topup("npub1a")).status_code for _ in range(3)] == [200, 200, 429]
+        assert (await client.post("/bitsatcredit/api/v1/user/npub1b/invoice", params={"amount": 10})).status_code == 200
+        response = await client.post("/bitsatcredit/api/v1/user/npub1c/invoice", params={"amount": 10})
+
+    assert response.status_code == 429
+    assert response.json()["detail"].startswith("Too many invoice requests for this ip")
+    assert int(response.headers["Retry-After"]) > 0
+    assert len(invoices) == 3
+    assert invoice_limiter.rejected == {"npub": 1, "ip": 1}
+    rows = await db.fetchone("SELECT COUNT(*) as count FROM bitsatcredit.topup_requests")
+    assert rows["count"] == 3
+
+
+@pytest.mark.asyncio
+async def test_invalid_limit_settings_fall_back_to_defaults(db, monkeypatch):
+    async def fake_create_invoice(*, wallet_id: str, amount: int, **kwargs):
+        return SimpleNamespace(payment_hash="hash1", bolt11="lnbc1")
+
+    monkeypatch.setattr(services, "create_invoice", fake_create_invoice)
+    await set_setting("invoice_limit_per_npub", "ten")
+    await set_setting("invoice_limit_per_ip", "")
+
+    app = FastAPI()
+    app.include_router(bitsatcredit_ext)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post(
+            "/bitsatcredit/api/v1/topup", params={"wallet_id": "w"}, json={"npub": "npub1a", "amount_sats": 21}
+        )
+    assert response.status_code == 200
+
+    limits = await api_get_rate_limits()
+    assert (limits["invoice_limit_per_npub"], limits["invoice_limit_per_ip"]) == (
+        INVOICE_LIMIT_PER_NPUB,
+        INVOICE_LIMIT_PER_IP,
+    )
@@ -0,0 +1,216 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from .. import ledger_archive, services
+from ..crud import (
+    backfill_usage_rollups,
+    create_topup_request,
+    create_transaction,
+    get_ledger_checkpoint,
+    get_system_stats,
+    get_usage_timeseries,
+    get_user,
+    get_user_transactions,
+    set_setting,
+    update_user_balance,
+)
+from ..models import CreateTransaction
+
+NPUB = "npub1testuser"
+
+
+def lnbits_payment(payment_hash: str, success: bool):
+    return SimpleNamespace(
+        payment_hash=payment_hash,
+        success=success,
+        pending=False,
+        extra={"tag": "bitsatcredit_topup", "npub": NPUB},
+    )
+
+
+@pytest.mark.asyncio
+async def test_reconcile_unpaid_topups(db, monkeypatch):
+    for i in range(5):
+        await create_topup_request(NPUB, 10, f"hash{i}", "lnbc1")
+
+    async def get_standalone_payment(payment_hash, incoming=False):
+        if payment_hash == "hash4":
+            return None
+        return lnbits_payment(payment_hash, success=payment_hash in {"hash1", "hash3"})
+
+    monkeypatch.setattr(services, "get_standalone_payment", get_standalone_payment)
+    monkeypatch.setattr(services, "TOPUP_RECONCILE_CHUNK_SIZE", 2)
+
+    report = await services.reconcile_unpaid_topups(dry_run=True, since=0)
+    assert (report["checked"], report["recovered"], report["unpaid"], report["missing"]) == (5, 2, 2, 1)
+    assert await get_user(NPUB) is None
+
+    report = await services.reconcile_unpaid_topups(since=0)
+    assert sorted(report["recovered_payment_hashes"]) == ["hash1", "hash3"]
+    user = await get_user(NPUB)
+    assert user
+    assert user.balance_sats == 20
+
+    report = await services.reconcile_unpaid_topups(since=0)
+    assert (report["checked"], report["recovered"]) == (3, 0)
+
+
+@pytest.mark.asyncio
+async def test_archive_and_restore_ledger(db, tmp_path):
+    await set_setting("ledger_archive_dir", str(tmp_path / "archive"))
+    day = 86400
+    for i, (tx_type, amount) in enumerate([("deposit", 100), ("spend", 3), ("spend", 2), ("deposit", 50)]):
+        await create_transaction(CreateTransaction(npub=NPUB, type=tx_type, amount_sats=amount))
+        # spread the first three over two old days, keep the last one recent
+        created_at = 10 * day + i * day // 2 if i < 3 else 100 * day
+        await db.execute(
+            "UPDATE bitsatcredit.transactions SET created_at = :created_at WHERE amount_sats = :amount",
+            {"created_at": created_at, "amount": amount},
+        )
+    await backfill_usage_rollups()
+
+    report = await services.archive_ledger(older_than=50 * day)
+    assert (report["archived"], report["pruned"], len(report["files"])) == (3, 3, 2)
+    assert [t.amount_sats for t in await get_user_transactions(NPUB)] == [50]
+    checkpoint = await get_ledger_checkpoint(NPUB)
+    assert checkpoint
+    assert (checkpoint.deposited_sats, checkpoint.spent_sats, checkpoint.balance_sats) == (100, 5, 95)
+
+    # rollups for the pruned days survive a rebuild from the remaining ledger
+    await backfill_usage_rollups()
+    buckets = await get_usage_timeseries("day", 10 * day, 11 * day)
+    assert [(b.deposit_sats, b.spend_sats) for b in buckets] == [(100, 3), (0, 2)]
+
+    runs = await services.verify_ledger_archive()
+    assert [(r["run_id"], r["rows"], r["ok"]) for r in runs] == [(report["run_id"], 3, True)]
+
+    restored = await services.restore_ledger_archive(report["run_id"], date="1970-01-11")
+    assert (restored["read"], restored["restored"]) == (2, 2)
+    restored = await services.restore_ledger_archive(report["run_id"])
+    assert (restored["read"], restored["restored"]) == (3, 1)
+    assert sorted(t.amount_sats for t in await get_user_transactions(NPUB)) == [2, 3, 50, 100]
+    checkpoint = await get_ledger_checkpoint(NPUB)
+    assert checkpoint
+    assert (checkpoint.balance_sats, checkpoint.transaction_count) == (0, 0)
+
+    with open(tmp_path / "archive" / report["files"][0], "ab") as f:
+        f.write(b"tampered")
+    assert not (await services.verify_ledger_archive())[0]["ok"]
+    with pytest.raises(ValueError):
+        await services.restore_ledger_archive(report["run_id"])
+
+
+@pytest.mark.asyncio
+async def test_archive_is_fsynced_before_pruning(db, tmp_path, monkeypatch):
+    await set_setting("ledger_archive_dir", str(tmp_path / "archive"))
+    for amount, created_at in [(100, 86400), (3, 2 * 86400)]:
+        await create_transaction(CreateTransaction(npub=NPUB, type="deposit", amount_sats=amount))
+        await db.execute(
+            "UPDATE bitsatcredit.transactions SET created_at = :created_at WHERE amount_sats = :amount",
+            {"created_at": created_at, "amount": amount},
+        )
+
+    synced: list[int] = []
+    real_fsync, real_prune = os.fsync, services.prune_transactions
+
+    def fsync(fd):
+        synced.append(os.fstat(fd).st_ino)
+        real_fsync(fd)
+
+    async def prune_transactions(*args):
+        paths = [*tmp_path.glob("archive/**/*.gz"), *tmp_path.glob("archive/**/*.json")]
+        dirs = {path.parent for path in paths} | {tmp_path / "archive"}
+        assert {p.stat().st_ino for p in [*paths, *dirs]} <= set(synced)
+        return await real_prune(*args)
+
+    monkeypatch.setattr(ledger_archive.os, "fsync", fsync)
+    monkeypatch.setattr(services, "prune_transactions", prune_transactions)
+    report = await services.archive_ledger(older_than=10 * 86400)
+    assert (report["archived"], report["pruned"]) == (2, 2)
+
+
+@pytest.mark.asyncio
+async def test_backfill_after_unaligned_prune(db, tmp_path):
+    await set_setting("ledger_archive_dir", str(tmp_path / "archive"))
+    day, hour = 86400, 3600
+    for tx_type, amount, created_at in [
+        ("deposit", 100, 10 * day + hour),
+        ("spend", 3, 10 * day + 3 * hour),
+        ("spend", 2, 10 * day + 12 * hour),
+        ("deposit", 50, 100 * day),
+    ]:
+        await create_transaction(CreateTransaction(npub=NPUB, type=tx_type, amount_sats=amount))
+        await db.execute(
+            "UPDATE bitsatcredit.transactions SET created_at = :created_at WHERE amount_sats = :amount",
+            {"created_at": created_at, "amount": amount},
+        )
+    await backfill_usage_rollups()
+
+    # the cutoff falls inside the day bucket of the first three rows
+    report = await services.archive_ledger(older_than=10 * day + 6 * hour)
+    assert report["pruned"] == 2
+    await backfill_usage_rollups()
+    for bucket, expected in [("day", [(100, 5), (50, 0)]), ("hour", [(100, 0), (0, 3), (0, 2), (50, 0)])]:
+        buckets = await get_usage_timeseries(bucket, 10 * day, 100 * day)
+        assert [(b.deposit_sats, b.spend_sats) for b in buckets if b.deposit_sats or b.spend_sats] == expected
+
+
+async def lines_of(text: str):
+    for line in text.splitlines():
+        yield line
+
+
+@pytest.mark.asyncio
+async def test_import_users(db, monkeypatch):
+    await update_user_balance("npub1old", 50)
+    monkeypatch.setattr(services, "IMPORT_BATCH_SIZE", 2)
+    upload = "\n".join(
+        [
+            "npub,balance,total_spent,message_count,memo",
+            "npub1old,20,,,migrated",
+            "npub1new,100,7,7,",
+            "npub1new,5,,,",
+            "not-an-npub,1,,,",
+            "npub1bad,-3,,,",
+            "npub1zero,0,,,",
+        ]
+    )
+
+    report = await services.import_users(lines_of(upload), dry_run=True)
+    assert (report["rows"], report["create"], report["update"], report["error_count"]) == (3, 2, 1, 3)
+    assert [e["line"] for e in report["errors"]] == [4, 5, 6]
+    assert report["diff"][0]["before"]["balance_sats"] == 50
+    assert report["diff"][0]["after"]["total_spent"] == 30
+    assert await get_user("npub1new") is None
+
+    report = await services.import_users(lines_of(upload), dry_run=False)
+    assert (report["create"], report["update"]) == (2, 1)
+    old, new = await get_user("npub1old"), await get_user("npub1new")
+    assert old and new
+    assert (old.balance_sats, old.total_spent, old.total_deposited, old.memo) == (20, 30, 50, "migrated")
+    assert (new.balance_sats, new.total_spent, new.total_deposited, new.message_count) == (100, 7, 100, 7)
+    assert [(t.type, t.amount_sats) for t in await get_user_transactions("npub1old")] == [("spend", 30)]
+    stats = await get_system_stats()
+    assert (stats["total_users"], stats["total_balance"], stats["total_messages"]) == (3, 120, 7)
+
+    ndjson = '{"npub": "npub1old", "balance_sats": 20, "memo": "migrated"}\n{"npub": 1}'
+    report = await services.import_users(lines_of(ndjson), fmt="ndjson", dry_run=False)
+    assert (report["unchanged"], report["error_count"]) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_import_users_multiline_csv_fields(db):
+    upload = (
+        'npub,balance,memo\nnpub1q,5,"line one\nline two"\n\nnpub1r,-1,"say ""hi"""\nnpub1s,7,\n'
+        "npub1t,8,memo,extra\nnpub1u,9\n"
+    )
+    report = await services.import_users(lines_of(upload), dry_run=False)
+    assert (report["rows"], report["error_count"]) == (2, 3)
+    assert [e["line"] for e in report["errors"]] == [5, 7, 8]
+    assert report["errors"][1]["error"] == "expected 3 fields like the header, got 4"
+    assert await get_user("npub1t") is None and await get_user("npub1u") is None
+    user = await get_user("npub1q")
+    assert user
+    assert (user.balance_sats, user.memo) == (5, "line one\nline two")
@@ -0,0 +1,87 @@
+from contextlib import asynccontextmanager
+
+import pytest
+from sqlalchemy import event
+
+from .. import crud
+from ..crud import (
+    create_topup_request,
+    create_transaction,
+    create_user,
+    increment_message_count,
+    mark_topup_paid,
+    set_user_memo,
+    spend_credits,
+    update_user_balance,
+    update_user_stats,
+)
+from ..models import CreateTransaction, CreateUser
+
+NPUB = "npub1testuser"
+
+
+@asynccontextmanager
+async def count_statements(db):
+    statements: list[str] = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine.sync_engine, "before_cursor_execute", capture)
+
+
+async def run_operations(db) -> dict[str, int]:
+    operations = {
+        "create_user": lambda: create_user(CreateUser(npub=NPUB)),
+        "update_user_balance": lambda: update_user_balance(NPUB, 10),
+        "increment_message_count": lambda: increment_message_count(NPUB),
+        "spend_credits": lambda: spend_credits(NPUB, 1),
+        "create_transaction": lambda: create_transaction(
+            CreateTransaction(npub=NPUB, type="deposit", amount_sats=5)
+        ),
+        "create_topup_request": lambda: create_topup_request(NPUB, 21, "hash1", "lnbc1"),
+        "mark_topup_paid": lambda: mark_topup_paid("hash1"),
+        "set_user_memo": lambda: set_user_memo(NPUB, "note"),
+        "update_user_stats": lambda: update_user_stats(NPUB, message_count=7),
+    }
+    counts = {}
+    for name, operation in operations.items():
+        async with count_statements(db) as statements:
+            assert await operation()
+        # ATTACH is the per-connection round trip on SQLite
+        counts[name] = len(statements)
+    return counts
+
+
+# statements per write, with RETURNING the written row comes back from the write itself
+@pytest.mark.asyncio
+async def test_write_statement_counts(db):
+    assert crud.supports_returning()
+    assert await run_operations(db) == {
+        "create_user": 3,  # was 4
+        "update_user_balance": 3,  # was 5
+        "increment_message_count": 3,  # was 4
+        "spend_credits": 5,  # was 6
+        "create_transaction": 3,  # was 4
+        "create_topup_request": 2,  # was 4
+        "mark_topup_paid": 6,  # was 9
+        "set_user_memo": 2,  # was 4
+        "update_user_stats": 3,  # was 5
+    }
+    stats = await crud.get_system_stats()
+    assert (stats["total_balance"], stats["total_messages"], stats["total_deposited"]) == (30, 7, 31)
+
+
+@pytest.mark.asyncio
+async def test_write_statement_counts_without_returning(db, monkeypatch):
+    monkeypatch.setattr(crud, "supports_returning", lambda: False)
+    counts = await run_operations(db)
+    assert counts["update_user_balance"] == 4
+    assert counts["mark_topup_paid"] == 9
+    user = await crud.get_user(NPUB)
+    assert user
+    assert (user.balance_sats, user.total_deposited, user.message_count, user.memo) == (30, 31, 7, "note")
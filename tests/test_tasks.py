@@ -0,0 +1,161 @@
+import asyncio
+import time
+from contextlib import suppress
+from types import SimpleNamespace
+
+import pytest
+
+from .. import tasks
+from ..crud import create_topup_request, get_user
+from ..metrics import settlement_seconds
+from ..views_api import api_get_payment_worker_stats
+
+NPUB = "npub1testuser"
+
+
+def paid_invoice(payment_hash: str, tag: str = "bitsatcredit_topup", npub: str = NPUB):
+    return SimpleNamespace(payment_hash=payment_hash, amount=21_000, extra={"tag": tag, "npub": npub})
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    fresh = tasks.InvoiceWorkerStats()
+    monkeypatch.setattr(tasks, "invoice_worker_stats", fresh)
+    return fresh
+
+
+async def start_pool(monkeypatch) -> tuple[asyncio.Task, asyncio.Queue]:
+    """Run the listener with a queue the test feeds instead of LNbits"""
+    listener: list[asyncio.Queue] = []
+    monkeypatch.setattr(tasks, "register_invoice_listener", lambda queue, name: listener.append(queue))
+    pool = asyncio.create_task(tasks.wait_for_paid_invoices())
+    await asyncio.sleep(0)
+    return pool, listener[0]
+
+
+async def stop_pool(pool: asyncio.Task) -> None:
+    pool.cancel()
+    with suppress(asyncio.CancelledError):
+        await pool
+
+
+async def wait_until(condition, timeout: float = 2) -> None:
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.001)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+async def drain(queue: asyncio.Queue) -> None:
+    worker = asyncio.create_task(tasks.invoice_worker(queue))
+    await queue.join()
+    worker.cancel()
+
+
+@pytest.mark.asyncio
+async def test_settlement_lag_counts_credited_topups_only(db, stats):
+    await create_topup_request(NPUB, 21, "hash1", "lnbc1")
+    settlement_seconds.values.clear()
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for payment in (paid_invoice("other", tag="lnurlp"), paid_invoice("hash1"), paid_invoice("hash1")):
+        queue.put_nowait((time.monotonic(), payment))
+    await drain(queue)
+
+    user = await get_user(NPUB)
+    assert user
+    assert user.balance_sats == 21
+    assert stats.processed == 3
+    ((counts, _),) = settlement_seconds.values.values()
+    assert sum(counts) == 1
+
+
+@pytest.mark.asyncio
+async def test_same_npub_is_settled_in_order(stats, monkeypatch):
+    settled: list[str] = []
+
+    async def process_topup_payment(payment):
+        # earlier payments take longer, so only sharding keeps them in order
+        await asyncio.sleep(0.001 * (5 - int(payment.payment_hash[1:])))
+        settled.append(payment.payment_hash)
+        return True
+
+    monkeypatch.setattr(tasks, "process_topup_payment", process_topup_payment)
+    pool, listener = await start_pool(monkeypatch)
+    try:
+        for i in range(5):
+            listener.put_nowait(paid_invoice(f"a{i}", npub="npub1a"))
+            listener.put_nowait(paid_invoice(f"b{i}", npub="npub1b"))
+        await wait_until(lambda: len(settled) == 10)
+    finally:
+        await stop_pool(pool)
+
+    assert [h for h in settled if h[0] == "a"] == [f"a{i}" for i in range(5)]
+    assert [h for h in settled if h[0] == "b"] == [f"b{i}" for i in range(5)]
+    assert (stats.processed, stats.failed) == (10, 0)
+
+
+@pytest.mark.asyncio
+async def test_full_worker_queue_applies_backpressure(stats, monkeypatch):
+    release = asyncio.Event()
+    settled: list[str] = []
+
+    async def process_topup_payment(payment):
+        await release.wait()
+        settled.append(payment.payment_hash)
+        return True
+
+    monkeypatch.setattr(tasks, "process_topup_payment", process_topup_payment)
+    monkeypatch.setattr(tasks, "INVOICE_WORKERS", 1)
+    monkeypatch.setattr(tasks, "INVOICE_WORKER_QUEUE_SIZE", 2)
+    pool, listener = await start_pool(monkeypatch)
+    try:
+        for i in range(6):
+            listener.put_nowait(paid_invoice(f"hash{i}"))
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+        # one in the worker, two queued, one held by the dispatcher, the rest wait in the listener
+        worker_stats = await api_get_payment_worker_stats()
+        assert (worker_stats["workers"], worker_stats["queue_depth"], worker_stats["listener_queue_depth"]) == (1, 2, 2)
+
+        release.set()
+        await wait_until(lambda: len(settled) == 6)
+    finally:
+        await stop_pool(pool)
+
+    assert settled == [f"hash{i}" for i in range(6)]
+    worker_stats = await api_get_payment_worker_stats()
+    assert (worker_stats["processed"], worker_stats["failed"], worker_stats["queue_depth"]) == (6, 0, 0)
+    assert worker_stats["max_latency_seconds"] >= worker_stats["avg_latency_seconds"] > 0
+    assert "topup_waiters" in worker_stats
+
+
+@pytest.mark.asyncio
+async def test_retries_back_off_and_give_up(stats, monkeypatch):
+    delays: list[float] = []
+    failures = [0]
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    async def process_topup_payment(payment):
+        if failures[0]:
+            failures[0] -= 1
+            raise RuntimeError("database is locked")
+        return True
+
+    monkeypatch.setattr(tasks.asyncio, "sleep", sleep)
+    monkeypatch.setattr(tasks, "process_topup_payment", process_topup_payment)
+
+    failures[0] = 2
+    assert await tasks.on_invoice_paid(paid_invoice("hash1")) == "credited"
+    assert delays == [0.5, 1.0]
+
+    delays.clear()
+    failures[0] = 100
+    assert await tasks.on_invoice_paid(paid_invoice("hash2")) == "failed"
+    assert failures[0] == 100 - tasks.INVOICE_MAX_ATTEMPTS
+    assert delays == [tasks.INVOICE_RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1) for attempt in range(1, 5)]
+    assert stats.retries == 6
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from .. import bitsatcredit_ext, services
+from ..cache import settings_snapshot
+from ..crud import update_user_balance
+from ..metrics import instrument_database
+from ..tracing import Tracer, tracer
+from ..views_api import api_get_traces
+
+NPUB = "npub1testuser"
+
+
+async def fake_create_invoice(*, wallet_id: str, amount: int, **kwargs):
+    return SimpleNamespace(payment_hash="hash1", bolt11="lnbc1")
+
+
+def test_unsampled_requests_are_not_traced():
+    local = Tracer()
+    settings_snapshot.load({"trace_sample_rate": "0"})
+    with local.trace("request") as span:
+        assert span is None
+        with local.span("child") as child:
+            assert child is None
+    assert local.stats()["unsampled"] == 1 and not local.traces
+    settings_snapshot.clear()
+
+
+@pytest.mark.asyncio
+async def test_sampled_request_spans(db, monkeypatch):
+    instrument_database(db)
+    monkeypatch.setattr(services, "create_invoice", fake_create_invoice)
+    settings_snapshot.load({"trace_sample_rate": "1"})
+    tracer.traces.clear()
+    await update_user_balance(NPUB, 100)
+    assert not tracer.traces  # only requests and paid invoices start traces
+
+    app = FastAPI()
+    app.include_router(bitsatcredit_ext)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        response = await client.post(f"/bitsatcredit/api/v1/user/{NPUB}/spend", params={"amount": 5})
+        assert response.status_code == 200
+        response = await client.post(
+            "/bitsatcredit/api/v1/topup", params={"wallet_id": "w"}, json={"npub": NPUB, "amount_sats": 21}
+        )
+        assert response.status_code == 200
+
+    dump = await api_get_traces(limit=10, min_ms=0)
+    topup, spend = dump["traces"]
+
+    assert spend["name"] == "Spend Credits"
+    names = [span["name"] for span in spend["spans"]]
+    assert names[:2] == ["Spend Credits", "crud.spend_credits"]
+    assert "db UPDATE users" in names and "db INSERT transactions" in names
+    crud_span = spend["spans"][1]
+    assert crud_span["statements"] >= 3 and spend["statements"] == sum(s["statements"] for s in spend["spans"])
+    assert spend["spans"][0]["attributes"]["status"] == 200
+
+    names = [span["name"] for span in topup["spans"]]
+    invoice = names.index("services.generate_topup_invoice")
+    assert names[invoice + 1] == "lnbits.create_invoice"
+    assert "crud.create_topup_request" in names[invoice:]
+    attributes = topup["spans"][invoice]["attributes"]
+    assert (attributes["npub"], attributes["amount_sats"], attributes["payment_hash"]) == (NPUB, 21, "hash1")
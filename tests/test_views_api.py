@@ -0,0 +1,43 @@
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from lnbits.decorators import check_admin, check_user_exists
+
+from .. import bitsatcredit_ext
+from ..crud import update_user_balance
+from ..views_api import api_get_usage_timeseries
+
+NPUB = "npub1testuser"
+
+
+@pytest.mark.asyncio
+async def test_export_and_import_format_parameter(db):
+    await update_user_balance(NPUB, 21)
+    app = FastAPI()
+    app.include_router(bitsatcredit_ext)
+    app.dependency_overrides[check_admin] = lambda: None
+    app.dependency_overrides[check_user_exists] = lambda: None
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        users = await client.get("/bitsatcredit/api/v1/export/users", params={"format": "ndjson"})
+        ledger = await client.get("/bitsatcredit/api/v1/export/transactions", params={"format": "csv"})
+        bad = await client.get("/bitsatcredit/api/v1/export/users", params={"format": "xml"})
+        report = await client.post(
+            "/bitsatcredit/api/v1/admin/import/users",
+            params={"format": "ndjson"},
+            content=json.dumps({"npub": NPUB, "balance_sats": 21}),
+        )
+
+    assert users.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line)["npub"] for line in users.text.splitlines()] == [NPUB]
+    assert ledger.headers["content-type"].startswith("text/csv")
+    assert bad.status_code == 422
+    assert report.json()["unchanged"] == 1
+
+
+@pytest.mark.asyncio
+async def test_usage_timeseries_accepts_from_zero(db):
+    buckets = await api_get_usage_timeseries(bucket="day", start=0, end=2 * 86400)
+    assert [b.bucket_start for b in buckets] == [0, 86400, 2 * 86400]
@@ -0,0 +1,220 @@
+# Sampled in-process tracing, kept in a ring buffer for GET /api/v1/admin/traces
+#
+# A trace is started for a sampled API request or paid invoice. While it is
+# open, `@traced` functions and every SQL statement add child spans with
+# their duration; statements are also counted on the span that ran them.
+# Outside a sampled trace the instrumentation is one context variable read.
+
+import functools
+import random
+import re
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from secrets import token_hex
+from typing import Any
+
+from .cache import settings_snapshot
+
+DEFAULT_SAMPLE_RATE = 0.01
+TRACE_BUFFER_SIZE = 500
+MAX_SPANS_PER_TRACE = 500
+TABLE_PATTERN = re.compile(r"bitsatcredit\.(\w+)")
+
+
+class Span:
+    __slots__ = (
+        "attributes",
+        "db_seconds",
+        "duration",
+        "error",
+        "id",
+        "name",
+        "parent_id",
+        "start",
+        "statements",
+        "trace",
+    )
+
+    def __init__(self, trace: "Trace", name: str, parent_id: str | None, start: float | None = None):
+        self.trace = trace
+        self.name = name
+        self.id = token_hex(8)
+        self.parent_id = parent_id
+        self.start = time.perf_counter() if start is None else start
+        self.duration: float | None = None
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.attributes: dict[str, Any] = {}
+        self.error: str | None = None
+
+    def to_dict(self) -> dict:
+        return {
+            "span_id": self.id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "start_ms": round((self.start - self.trace.start) * 1000, 3),
+            "duration_ms": round((self.duration or 0) * 1000, 3),
+            "statements": self.statements,
+            "db_ms": round(self.db_seconds * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.id = token_hex(16)
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans: list[Span] = []
+        self.dropped = 0
+
+    def add(self, span: Span) -> None:
+        if len(self.spans) < MAX_SPANS_PER_TRACE:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+    def to_dict(self) -> dict:
+        root = self.spans[0]
+        return {
+            "trace_id": self.id,
+            "name": self.name,
+            "started_at": round(self.started_at, 3),
+            "duration_ms": round((root.duration or 0) * 1000, 3),
+            "statements": sum(span.statements for span in self.spans),
+            "db_ms": round(sum(span.db_seconds for span in self.spans) * 1000, 3),
+            "dropped_spans": self.dropped,
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+
+current_span: ContextVar[Span | None] = ContextVar("bitsatcredit_span", default=None)
+
+
+class Tracer:
+    """Samples traces and keeps the last `capacity` finished ones.
+
+    The sample rate comes from the `trace_sample_rate` setting when it is
+    set, otherwise `DEFAULT_SAMPLE_RATE`.
+    """
+
+    def __init__(self, capacity: int = TRACE_BUFFER_SIZE):
+        self.traces: deque[Trace] = deque(maxlen=capacity)
+        self.sampled = 0
+        self.unsampled = 0
+
+    def sample_rate(self) -> float:
+        value = (settings_snapshot.values or {}).get("trace_sample_rate")
+        try:
+            return float(value) if value else DEFAULT_SAMPLE_RATE
+        except ValueError:
+            return DEFAULT_SAMPLE_RATE
+
+    @contextmanager
+    def trace(self, name: str) -> Iterator[Span | None]:
+        """Start a trace if this one is sampled, yields the root span or None"""
+        if current_span.get() is not None:
+            with self.span(name) as span:
+                yield span
+            return
+        if random.random() >= self.sample_rate():
+            self.unsampled += 1
+            yield None
+            return
+
+        self.sampled += 1
+        trace = Trace(name)
+        root = Span(trace, name, None)
+        trace.add(root)
+        token = current_span.set(root)
+        try:
+            yield root
+        except BaseException as exc:
+            root.error = type(exc).__name__
+            raise
+        finally:
+            root.duration = time.perf_counter() - root.start
+            current_span.reset(token)
+            self.traces.append(trace)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span | None]:
+        """Child span of the current span, a no-op outside a sampled trace"""
+        parent = current_span.get()
+        if parent is None:
+            yield None
+            return
+
+        span = Span(parent.trace, name, parent.id)
+        parent.trace.add(span)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.error = type(exc).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - span.start
+            current_span.reset(token)
+
+    def record_statement(self, statement: str, seconds: float) -> None:
+        span = current_span.get()
+        if span is None:
+            return
+        span.statements += 1
+        span.db_seconds += seconds
+        # "db UPDATE users", "db SELECT topup_requests", ...
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+        table = TABLE_PATTERN.search(statement)
+        name = f"db {verb} {table.group(1)}" if table else f"db {verb}"
+        child = Span(span.trace, name, span.id, time.perf_counter() - seconds)
+        child.duration = seconds
+        span.trace.add(child)
+
+    def dump(self, limit: int = 50, min_duration_ms: float = 0) -> list[dict]:
+        """Finished traces, newest first"""
+        traces: list[dict] = []
+        for trace in reversed(self.traces):
+            if len(traces) >= limit:
+                break
+            if (trace.spans[0].duration or 0) * 1000 >= min_duration_ms:
+                traces.append(trace.to_dict())
+        return traces
+
+    def stats(self) -> dict:
+        return {
+            "sample_rate": self.sample_rate(),
+            "sampled": self.sampled,
+            "unsampled": self.unsampled,
+            "buffered": len(self.traces),
+            "capacity": self.traces.maxlen,
+        }
+
+
+tracer = Tracer()
+
+
+def traced(func: Callable) -> Callable:
+    """Run an async function in a span named after its module and name"""
+    name = f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if current_span.get() is None:
+            return await func(*args, **kwargs)
+        with tracer.span(name):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+def annotate(**attributes: Any) -> None:
+    """Attach attributes to the current span, if this request is sampled"""
+    span = current_span.get()
+    if span is not None:
+        span.attributes.update(attributes)
@@ -1,26 +1,108 @@
+import asyncio
+from datetime import datetime, timezone
 from http import HTTPStatus
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Depends, Query, Request
 from fastapi.exceptions import HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from lnbits.core.models import SimpleStatus, User
 from lnbits.decorators import check_user_exists, check_admin
 
+from .cache import settings_snapshot, user_cache
 from .crud import (
     get_or_create_user,
+    get_settings,
     get_user,
     update_user_balance,
-    increment_message_count,
+    spend_credits,
+    spend_credits_batch,
+    create_hold,
+    get_hold,
+    settle_hold,
     get_user_transactions,
 )
 from .models import (
     User as BitSatUser,
+    BatchSpendItem,
+    BatchSpendResult,
+    Hold,
     CreateTopUp,
     TopUpPaymentRequest,
+    TopUpStatus,
     Transaction,
+    TransactionPage,
+    UsageBucket,
+    UserPage,
     AdminAddCredits,
+    AdminBulkAddCredits,
+    BulkCreditResult,
 )
-from .services import generate_topup_invoice
+from .helpers import decode_cursor, encode_cursor, export_lines, iter_lines, sse_event
+from .metrics import MetricsRoute, registry, spend_rejections
+from .tracing import tracer
+from .pubsub import TooManyWaitersError, topup_hub
+from .ratelimit import RateLimitedError, invoice_limiter
+from .services import TOPUP_INVOICE_EXPIRY_SECONDS, generate_topup_invoice
+
+bitsatcredit_api_router = APIRouter(route_class=MetricsRoute)
+
+MAX_BATCH_SPEND_ITEMS = 1000
+MAX_BULK_CREDIT_USERS = 10_000
+MAX_TIMESERIES_BUCKETS = 2000
+SSE_KEEPALIVE_SECONDS = 15
+MAX_TOPUP_WAIT_SECONDS = 120
+# invoices per minute, overridden by the invoice_limit_per_* settings (0 disables)
+INVOICE_LIMIT_PER_NPUB = 10
+INVOICE_LIMIT_PER_IP = 30
+USER_EXPORT_FIELDS = [
+    "npub", "balance_sats", "held_sats", "total_spent", "total_deposited",
+    "message_count", "memo", "created_at", "updated_at",
+]
+TRANSACTION_EXPORT_FIELDS = [
+    "id", "npub", "type", "amount_sats", "payment_hash", "memo", "idempotency_key", "created_at",
+]
+
+
+def parse_cursor(cursor: str | None) -> tuple[int, str] | None:
+    if not cursor:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, "Invalid cursor") from exc
+
+
+def int_setting(settings: dict, key: str, default: int) -> int:
+    """An integer setting, `default` when it is unset or not a number"""
+    try:
+        return int(settings.get(key, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def invoice_limits(settings: dict) -> tuple[int, int]:
+    """Invoices per minute per npub and per IP"""
+    return (
+        int_setting(settings, "invoice_limit_per_npub", INVOICE_LIMIT_PER_NPUB),
+        int_setting(settings, "invoice_limit_per_ip", INVOICE_LIMIT_PER_IP),
+    )
+
+
+async def check_invoice_rate_limit(request: Request, npub: str) -> None:
+    """Answer 429 when the client IP or npub is over its invoice limit.
 
-bitsatcredit_api_router = APIRouter()
+    Runs before `create_invoice` and any database work; the limits come
+    from the in-memory settings snapshot.
+    """
+    per_npub, per_ip = invoice_limits(await get_settings())
+    client_ip = request.client.host if request.client else "unknown"
+    try:
+        invoice_limiter.hit([("ip", client_ip, per_ip), ("npub", npub, per_npub)])
+    except RateLimitedError as exc:
+        raise HTTPException(
+            HTTPStatus.TOO_MANY_REQUESTS,
+            f"Too many invoice requests for this {exc.scope}, retry in {exc.retry_after}s",
+            headers={"Retry-After": str(exc.retry_after)},
+        ) from exc
 
 
 ############################# User Management #############################
@@ -53,7 +135,8 @@ async def api_get_balance(npub: str) -> dict:
         "balance_sats": user.balance_sats,
         "total_spent": user.total_spent,
         "total_deposited": user.total_deposited,
-        "message_count": user.message_count
+        "message_count": user.message_count,
+        "held_sats": user.held_sats
     }
 
 
@@ -92,23 +175,135 @@ async def api_can_spend(npub: str, amount: int = Query(..., description="Amount
     response_description="Updated balance",
     response_model=BitSatUser,
 )
-async def api_spend_credits(npub: str, amount: int = Query(..., description="Amount in sats"), memo: str | None = None) -> BitSatUser:
+async def api_spend_credits(
+    npub: str, amount: int = Query(..., ge=1, description="Amount in sats"), memo: str | None = None
+) -> BitSatUser:
     """Deduct credits from user balance (called by BitSatRelay)"""
+    # Deduct balance, increment message count and record the spend atomically
+    spent = await spend_credits(npub, amount, memo)
+    if spent:
+        return spent
+
+    # Only the rejected path pays for an extra read to explain why
     user = await get_user(npub)
     if not user:
+        spend_rejections.inc("spend", "not_found")
         raise HTTPException(HTTPStatus.NOT_FOUND, f"User {npub} not found")
 
-    if user.balance_sats < amount:
+    spend_rejections.inc("spend", "insufficient_funds")
+    raise HTTPException(
+        HTTPStatus.PAYMENT_REQUIRED,
+        f"Insufficient balance. Have {user.balance_sats} sats, need {amount} sats"
+    )
+
+
+@bitsatcredit_api_router.post(
+    "/api/v1/spend/batch",
+    name="Batch Spend Credits",
+    summary="Deduct credits for a batch of relayed messages",
+    response_description="Per-item spend results",
+    response_model=list[BatchSpendResult],
+)
+async def api_spend_credits_batch(items: list[BatchSpendItem]) -> list[BatchSpendResult]:
+    """Apply many spends in one transaction (called by BitSatRelay after a satellite pass)"""
+    if not items:
+        return []
+    if len(items) > MAX_BATCH_SPEND_ITEMS:
         raise HTTPException(
-            HTTPStatus.PAYMENT_REQUIRED,
-            f"Insufficient balance. Have {user.balance_sats} sats, need {amount} sats"
+            HTTPStatus.BAD_REQUEST,
+            f"Batch cannot exceed {MAX_BATCH_SPEND_ITEMS} items"
         )
 
-    # Deduct balance and increment message count
-    user = await update_user_balance(npub, -amount)
-    user = await increment_message_count(npub)
+    results = await spend_credits_batch(items)
+    for result in results:
+        if result.status in ("insufficient_funds", "not_found"):
+            spend_rejections.inc("batch", result.status)
+    return results
+
+
+############################# Credit Holds #############################
+@bitsatcredit_api_router.post(
+    "/api/v1/user/{npub}/hold",
+    name="Hold Credits",
+    summary="Reserve credits before transmitting",
+    response_description="Hold details",
+    response_model=Hold,
+)
+async def api_hold_credits(
+    npub: str,
+    amount: int = Query(..., ge=1, description="Amount in sats"),
+    ttl: int = Query(300, ge=1, le=3600, description="Seconds before the hold expires and is released"),
+    memo: str | None = None,
+) -> Hold:
+    """Move sats into a hold; capture or release it once the uplink result is known"""
+    hold = await create_hold(npub, amount, ttl, memo)
+    if hold:
+        return hold
+
+    user = await get_user(npub)
+    if not user:
+        spend_rejections.inc("hold", "not_found")
+        raise HTTPException(HTTPStatus.NOT_FOUND, f"User {npub} not found")
+
+    spend_rejections.inc("hold", "insufficient_funds")
+    raise HTTPException(
+        HTTPStatus.PAYMENT_REQUIRED,
+        f"Insufficient balance. Have {user.balance_sats} sats, need {amount} sats"
+    )
 
-    return user
+
+@bitsatcredit_api_router.post(
+    "/api/v1/hold/{hold_id}/capture",
+    name="Capture Hold",
+    summary="Charge held credits",
+    response_description="Settled hold",
+    response_model=Hold,
+)
+async def api_capture_hold(
+    hold_id: str,
+    amount: int | None = Query(None, ge=0, description="Sats to charge (default: whole hold)"),
+    messages: int = Query(1, ge=0, description="Messages sent under this hold"),
+    memo: str | None = None,
+) -> Hold:
+    """Charge all or part of a hold, the remainder returns to the balance"""
+    hold = await get_hold(hold_id)
+    if not hold:
+        raise HTTPException(HTTPStatus.NOT_FOUND, f"Hold {hold_id} not found")
+
+    capture_amount = hold.amount_sats if amount is None else amount
+    if capture_amount > hold.amount_sats:
+        raise HTTPException(
+            HTTPStatus.BAD_REQUEST,
+            f"Cannot capture {capture_amount} sats from a {hold.amount_sats} sat hold"
+        )
+
+    settled = await settle_hold(hold_id, "captured", capture_amount, messages, memo)
+    if not settled:
+        # settled concurrently, or expired just now
+        hold = await get_hold(hold_id) or hold
+        raise HTTPException(HTTPStatus.CONFLICT, f"Hold {hold_id} is already {hold.status}")
+    return settled
+
+
+@bitsatcredit_api_router.post(
+    "/api/v1/hold/{hold_id}/release",
+    name="Release Hold",
+    summary="Return held credits to the balance",
+    response_description="Settled hold",
+    response_model=Hold,
+)
+async def api_release_hold(hold_id: str) -> Hold:
+    """Release a hold without charging"""
+    hold = await get_hold(hold_id)
+    if not hold:
+        raise HTTPException(HTTPStatus.NOT_FOUND, f"Hold {hold_id} not found")
+
+    settled = await settle_hold(hold_id, "released")
+    if not settled:
+        # settled concurrently, or expired just now
+        hold = await get_hold(hold_id) or hold
+        raise HTTPException(HTTPStatus.CONFLICT, f"Hold {hold_id} is already {hold.status}")
+    return settled
 
 
 ############################# Top-Up #############################
@@ -120,6 +315,7 @@ async def api_spend_credits(npub: str, amount: int = Query(..., description="Amo
     response_model=TopUpPaymentRequest,
 )
 async def api_create_topup(
+    request: Request,
     data: CreateTopUp,
     wallet_id: str = Query(..., description="Wallet ID to receive payment"),
 ) -> TopUpPaymentRequest:
@@ -127,6 +323,8 @@ async def api_create_topup(
     if data.amount_sats < 1:
         raise HTTPException(HTTPStatus.BAD_REQUEST, "Amount must be at least 1 sat")
 
+    await check_invoice_rate_limit(request, data.npub)
+
     # Generate invoice using provided wallet_id
     result = await generate_topup_invoice(
         npub=data.npub,
@@ -141,6 +339,114 @@ async def api_create_topup(
     )
 
 
+@bitsatcredit_api_router.get(
+    "/api/v1/topup/{payment_hash}/events",
+    name="Top-Up Events",
+    summary="Server-sent events stream that fires once the top-up is paid (public endpoint)",
+    response_description="text/event-stream with a `paid` or `expired` event",
+)
+async def api_topup_events(payment_hash: str) -> StreamingResponse:
+    """Push payment confirmation to the public page instead of polling the balance"""
+    from .crud import get_topup_by_payment_hash
+
+    topup = await get_topup_by_payment_hash(payment_hash)
+    if not topup:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Top-up not found")
+    if topup_hub.full():
+        raise HTTPException(HTTPStatus.SERVICE_UNAVAILABLE, "Too many open payment streams")
+
+    async def events():
+        try:
+            with topup_hub.subscribe(payment_hash) as paid:
+                # re-read after subscribing so a payment settled in between is not missed
+                current = await get_topup_by_payment_hash(payment_hash)
+                if current and not current.paid:
+                    deadline = current.expires_at or (
+                        int(datetime.now(timezone.utc).timestamp()) + TOPUP_INVOICE_EXPIRY_SECONDS
+                    )
+                    while not paid.is_set():
+                        remaining = deadline - int(datetime.now(timezone.utc).timestamp())
+                        if remaining <= 0:
+                            yield sse_event("expired", {"payment_hash": payment_hash})
+                            return
+                        try:
+                            await asyncio.wait_for(paid.wait(), min(SSE_KEEPALIVE_SECONDS, remaining))
+                        except asyncio.TimeoutError:
+                            yield ": keepalive\n\n"
+                    current = await get_topup_by_payment_hash(payment_hash)
+        except TooManyWaitersError:
+            yield sse_event("error", {"detail": "Too many open payment streams"})
+            return
+
+        if not current:
+            return
+        user = await get_user(current.npub)
+        yield sse_event(
+            "paid",
+            {
+                "payment_hash": payment_hash,
+                "amount_sats": current.amount_sats,
+                "balance_sats": user.balance_sats if user else None,
+            },
+        )
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@bitsatcredit_api_router.get(
+    "/api/v1/topup/{payment_hash}/wait",
+    name="Wait For Top-Up",
+    summary="Long-poll until the top-up is paid or the timeout passes (public endpoint)",
+    response_description="Top-up status",
+    response_model=TopUpStatus,
+)
+async def api_wait_for_topup(
+    payment_hash: str,
+    timeout: int = Query(30, ge=0, le=MAX_TOPUP_WAIT_SECONDS, description="Seconds to wait"),
+) -> TopUpStatus:
+    """Answer as soon as the invoice is paid, for bots that would otherwise poll"""
+    from .crud import get_topup_by_payment_hash
+
+    topup = await get_topup_by_payment_hash(payment_hash)
+    if not topup:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Top-up not found")
+
+    now = int(datetime.now(timezone.utc).timestamp())
+    expired = topup.expired or bool(topup.expires_at and topup.expires_at <= now)
+    if topup.expires_at:
+        timeout = min(timeout, max(topup.expires_at - now, 0))
+
+    if not topup.paid and not expired and timeout:
+        try:
+            with topup_hub.subscribe(payment_hash) as paid:
+                # re-read after subscribing so a payment settled in between is not missed
+                topup = await get_topup_by_payment_hash(payment_hash)
+                if topup and not topup.paid:
+                    try:
+                        await asyncio.wait_for(paid.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    else:
+                        topup = await get_topup_by_payment_hash(payment_hash)
+        except TooManyWaitersError as exc:
+            raise HTTPException(HTTPStatus.SERVICE_UNAVAILABLE, "Too many waiting requests") from exc
+        if not topup:
+            raise HTTPException(HTTPStatus.NOT_FOUND, "Top-up not found")
+
+    user = await get_user(topup.npub) if topup.paid else None
+    return TopUpStatus(
+        payment_hash=payment_hash,
+        paid=topup.paid,
+        expired=not topup.paid and (expired or topup.expired),
+        amount_sats=topup.amount_sats,
+        balance_sats=user.balance_sats if user else None,
+    )
+
+
 @bitsatcredit_api_router.post(
     "/api/v1/user/{npub}/invoice",
     name="Create User Invoice",
@@ -148,6 +454,7 @@ async def api_create_topup(
     response_model=TopUpPaymentRequest,
 )
 async def api_create_user_invoice(
+    request: Request,
     npub: str,
     amount: int = Query(..., ge=10, description="Amount in sats (minimum 10)"),
 ) -> TopUpPaymentRequest:
@@ -174,6 +481,8 @@ async def api_create_user_invoice(
     if amount > 1000000:
         raise HTTPException(HTTPStatus.BAD_REQUEST, "Amount cannot exceed 1,000,000 sats")
 
+    await check_invoice_rate_limit(request, npub)
+
     # BitSatCredit extension wallet ID (hardcoded)
     BITSATCREDIT_WALLET_ID = "6e1faaf6356b43029124fdeb5f93a297"
 
@@ -196,13 +505,27 @@ async def api_create_user_invoice(
     "/api/v1/user/{npub}/transactions",
     name="Transaction History",
     summary="Get user's transaction history",
-    response_description="List of transactions",
-    response_model=list[Transaction],
+    response_description="Page of transactions",
+    response_model=TransactionPage,
 )
-async def api_get_transactions(npub: str) -> list[Transaction]:
-    """Get user's transaction history (last 100)"""
-    transactions = await get_user_transactions(npub)
-    return transactions
+async def api_get_transactions(
+    npub: str,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: str | None = Query(None, description="next_cursor from the previous page"),
+) -> TransactionPage:
+    """Get user's transaction history, newest first"""
+    transactions = await get_user_transactions(npub, limit + 1, parse_cursor(cursor))
+    return transaction_page(transactions, limit)
+
+
+def transaction_page(transactions: list[Transaction], limit: int) -> TransactionPage:
+    if len(transactions) <= limit:
+        return TransactionPage(data=transactions)
+    last = transactions[limit - 1]
+    return TransactionPage(
+        data=transactions[:limit],
+        next_cursor=encode_cursor(last.created_at or 0, last.id),
+    )
 
 
 ############################# Admin Endpoints #############################
@@ -210,28 +533,86 @@ async def api_get_transactions(npub: str) -> list[Transaction]:
     "/api/v1/users",
     name="Get All Users",
     summary="Get list of all users (admin)",
-    response_description="List of users",
-    response_model=list[BitSatUser],
+    response_description="Page of users",
+    response_model=UserPage,
 )
-async def api_get_all_users(limit: int = 100, offset: int = 0) -> list[BitSatUser]:
-    """Get paginated list of all users"""
+async def api_get_all_users(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: str | None = Query(None, description="next_cursor from the previous page"),
+) -> UserPage:
+    """Get users by last activity, one keyset page at a time"""
     from .crud import get_all_users
-    users = await get_all_users(limit, offset)
-    return users
+    users = await get_all_users(limit + 1, parse_cursor(cursor))
+    if len(users) <= limit:
+        return UserPage(data=users)
+    last = users[limit - 1]
+    return UserPage(data=users[:limit], next_cursor=encode_cursor(last.updated_at or 0, last.npub))
 
 
 @bitsatcredit_api_router.get(
     "/api/v1/transactions/recent",
     name="Recent Transactions",
     summary="Get recent transactions across all users",
-    response_description="List of recent transactions",
-    response_model=list[Transaction],
+    response_description="Page of recent transactions",
+    response_model=TransactionPage,
 )
-async def api_get_recent_transactions(limit: int = 50) -> list[Transaction]:
+async def api_get_recent_transactions(
+    limit: int = Query(50, ge=1, le=1000),
+    cursor: str | None = Query(None, description="next_cursor from the previous page"),
+) -> TransactionPage:
     """Get recent transactions (admin view)"""
     from .crud import get_recent_transactions
-    transactions = await get_recent_transactions(limit)
-    return transactions
+    transactions = await get_recent_transactions(limit + 1, parse_cursor(cursor))
+    return transaction_page(transactions, limit)
+
+
+def export_response(chunks, fields: list[str], fmt: str, name: str) -> StreamingResponse:
+    media_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_lines(chunks, fields, fmt),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="bitsatcredit-{name}.{fmt}"'},
+    )
+
+
+@bitsatcredit_api_router.get(
+    "/api/v1/export/users",
+    name="Export Users",
+    summary="Stream all users as CSV or NDJSON (admin only)",
+    response_description="CSV or NDJSON stream",
+    dependencies=[Depends(check_admin)],
+)
+async def api_export_users(
+    fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+    npub: str | None = Query(None),
+    since: int | None = Query(None, alias="from", description="Unix timestamp, created at or after"),
+    until: int | None = Query(None, alias="to", description="Unix timestamp, created before"),
+    user: User = Depends(check_user_exists)
+) -> StreamingResponse:
+    """Admin endpoint to export users for accounting"""
+    from .crud import stream_users
+    return export_response(stream_users(npub, since, until), USER_EXPORT_FIELDS, fmt, "users")
+
+
+@bitsatcredit_api_router.get(
+    "/api/v1/export/transactions",
+    name="Export Transactions",
+    summary="Stream the transaction ledger as CSV or NDJSON (admin only)",
+    response_description="CSV or NDJSON stream",
+    dependencies=[Depends(check_admin)],
+)
+async def api_export_transactions(
+    fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+    npub: str | None = Query(None),
+    since: int | None = Query(None, alias="from", description="Unix timestamp, created at or after"),
+    until: int | None = Query(None, alias="to", description="Unix timestamp, created before"),
+    user: User = Depends(check_user_exists)
+) -> StreamingResponse:
+    """Admin endpoint to export the ledger for accounting, oldest first"""
+    from .crud import stream_transactions
+    return export_response(
+        stream_transactions(npub, since, until), TRANSACTION_EXPORT_FIELDS, fmt, "transactions"
+    )
 
 
 @bitsatcredit_api_router.get(
@@ -247,6 +628,247 @@ async def api_get_stats() -> dict:
     return stats
 
 
+@bitsatcredit_api_router.get(
+    "/api/v1/admin/cache",
+    name="Cache Statistics",
+    summary="Get user cache hit/miss counters (admin only)",
+    response_description="Cache stats",
+    dependencies=[Depends(check_admin)],
+)
+async def api_get_cache_stats() -> dict:
+    """Admin endpoint to inspect the in-memory user cache"""
+    return user_cache.stats()
+
+
+############################# Analytics #############################
+@bitsatcredit_api_router.get(
+    "/api/v1/analytics/timeseries",
+    name="Usage Timeseries",
+    summary="Deposits, spends and messages per hour or day (admin only)",
+    response_description="Usage buckets",
+    response_model=list[UsageBucket],
+    dependencies=[Depends(check_admin)],
+)
+async def api_get_usage_timeseries(
+    bucket: str = Query("hour", pattern="^(hour|day)$"),
+    start: int | None = Query(None, alias="from", description="Unix timestamp, default 48 hours / 30 days ago"),
+    end: int | None = Query(None, alias="to", description="Unix timestamp, default now"),
+) -> list[UsageBucket]:
+    """Usage rollups for capacity planning"""
+    from .crud import ROLLUP_BUCKETS, get_usage_timeseries
+
+    if end is None:
+        end = int(datetime.now(timezone.utc).timestamp())
+    if start is None:
+        start = end - (48 * 3600 if bucket == "hour" else 30 * 86400)
+    if start > end:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, "'from' must be before 'to'")
+    if (end - start) // ROLLUP_BUCKETS[bucket] > MAX_TIMESERIES_BUCKETS:
+        raise HTTPException(
+            HTTPStatus.BAD_REQUEST,
+            f"Range cannot exceed {MAX_TIMESERIES_BUCKETS} {bucket} buckets"
+        )
+
+    return await get_usage_timeseries(bucket, start, end)
+
+
+@bitsatcredit_api_router.post(
+    "/api/v1/admin/analytics/backfill",
+    name="Backfill Usage Rollups",
+    summary="Rebuild usage rollups from the transaction ledger (admin only)",
+    response_description="Number of buckets",
+    dependencies=[Depends(check_admin)],
+)
+async def api_backfill_usage_rollups(user: User = Depends(check_user_exists)) -> dict:
+    """Admin endpoint to rebuild the hourly and daily rollups"""
+    from .crud import backfill_usage_rollups
+
+    buckets = await backfill_usage_rollups()
+    return {"buckets": buckets}
+
+
+@bitsatcredit_api_router.post(
+    "/api/v1/admin/topups/reconcile",
+    name="Reconcile Top-Ups",
+    summary="Credit paid top-ups the invoice listener missed (admin only)",
+    response_description="Reconciliation report",
+    dependencies=[Depends(check_admin)],
+)
+async def api_reconcile_topups(
+    dry_run: bool = Query(True, description="Only report what would be credited"),
+    since: int | None = Query(None, description="Unix timestamp, default 7 days ago"),
+    user: User = Depends(check_user_exists)
+) -> dict:
+    """Admin endpoint to check unpaid top-ups against LNbits payments"""
+    from .services import reconcile_unpaid_topups
+
+    return await reconcile_unpaid_topups(dry_run=dry_run, since=since)
+
+
+@bitsatcredit_api_router.post(
+    "/api/v1/admin/topups/sweep",
+    name="Sweep Top-Ups",
+    summary="Expire stale top-ups and archive old unpaid ones (admin only)",
+    response_description="Sweep report",
+    dependencies=[Depends(check_admin)],
+)
+async def api_sweep_topups(user: User = Depends(check_user_exists)) -> dict:
+    """Admin endpoint to run the top-up retention job now"""
+    from .services import sweep_topups
+
+    return await sweep_topups()
+
+
+@bitsatcredit_api_router.post(
+    "/api/v1/admin/ledger/archive",
+    name="Archive Ledger",
+    summary="Archive and prune ledger rows past the retention period (admin only)",
+    response_description="Archive run report",
+    dependencies=[Depends(check_admin)],
+)
+async def api_archive_ledger(
+    older_than: int | None = Query(None, description="Unix timestamp, default from ledger_retention_days"),
+    user: User = Depends(check_user_exists)
+) -> dict:
+    """Admin endpoint to run the ledger retention job now"""
+    from .services import archive_ledger
+
+    return await archive_ledger(older_than=older_than)
+
+
+@bitsatcredit_api_router.get(
+    "/api/v1/admin/ledger/archive",
+    name="Verify Ledger Archive",
+    summary="List ledger archive runs and verify their checksums (admin only)",
+    response_description="One entry per archive run",
+    dependencies=[Depends(check_admin)],
+)
+async def api_verify_ledger_archive(user: User = Depends(check_user_exists)) -> list[dict]:
+    """Admin endpoint to verify the ledger archive on disk"""
+    from .services import verify_ledger_archive
+
+    return await verify_ledger_archive()
+
+
+@bitsatcredit_api_router.post(
+    "/api/v1/admin/ledger/restore",
+    name="Restore Ledger Archive",
+    summary="Load an archive run back into the ledger (admin only)",
+    response_description="Restore report",
+    dependencies=[Depends(check_admin)],
+)
+async def api_restore_ledger_archive(
+    run_id: str = Query(..., description="Archive run id"),
+    date: str | None = Query(None, description="Only restore this day (YYYY-MM-DD)"),
+    user: User = Depends(check_user_exists)
+) -> dict:
+    """Admin endpoint to restore archived ledger rows"""
+    from .services import restore_ledger_archive
+
+    try:
+        return await restore_ledger_archive(run_id, date)
+    except ValueError as exc:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, str(exc)) from exc
+
+
+@bitsatcredit_api_router.get(
+    "/api/v1/admin/payments/stats",
+    name="Payment Worker Statistics",
+    summary="Get invoice worker queue depth and latency (admin only)",
+    response_description="Worker stats",
+    dependencies=[Depends(check_admin)],
+)
+async def api_get_payment_worker_stats() -> dict:
+    """Admin endpoint to inspect the paid-invoice worker pool"""
+    from .tasks import invoice_worker_stats
+
+    return {**invoice_worker_stats.snapshot(), "topup_waiters": topup_hub.stats()}
+
+
+@bitsatcredit_api_router.get(
+    "/api/v1/metrics",
+    name="Metrics",
+    summary="Prometheus metrics",
+    response_description="Metrics in the Prometheus text format",
+    response_class=PlainTextResponse,
+)
+async def api_metrics() -> PlainTextResponse:
+    """Request, database, settlement and cache metrics for Prometheus to scrape"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@bitsatcredit_api_router.get(
+    "/api/v1/admin/traces",
+    name="Traces",
+    summary="Dump sampled request traces (admin only)",
+    response_description="Recent traces, newest first",
+    dependencies=[Depends(check_admin)],
+)
+async def api_get_traces(
+    limit: int = Query(50, ge=1, le=500),
+    min_ms: float = Query(0, ge=0, description="Only traces at least this slow"),
+) -> dict:
+    """Admin endpoint to dump the in-memory trace buffer"""
+    return {**tracer.stats(), "traces": tracer.dump(limit, min_ms)}
+
+
+@bitsatcredit_api_router.post(
+    "/api/v1/admin/settings/trace-sample-rate",
+    name="Set Trace Sample Rate",
+    summary="Set the share of requests that are traced (admin only)",
+    response_description="Updated sample rate",
+    dependencies=[Depends(check_admin)],
+)
+async def api_set_trace_sample_rate(
+    rate: float = Query(..., ge=0, le=1, description="0 disables tracing, 1 traces every request"),
+    user: User = Depends(check_user_exists)
+) -> dict:
+    """Admin endpoint to set the trace sample rate"""
+    from .crud import set_setting
+
+    await set_setting("trace_sample_rate", str(rate))
+    return {"trace_sample_rate": rate, "updated": True}
+
+
+@bitsatcredit_api_router.get(
+    "/api/v1/admin/rate-limits",
+    name="Rate Limits",
+    summary="Get invoice rate limits and rejection counters (admin only)",
+    response_description="Limits and counters",
+    dependencies=[Depends(check_admin)],
+)
+async def api_get_rate_limits() -> dict:
+    """Admin endpoint to inspect the invoice rate limiter"""
+    per_npub, per_ip = invoice_limits(await get_settings())
+    return {
+        "invoice_limit_per_npub": per_npub,
+        "invoice_limit_per_ip": per_ip,
+        **invoice_limiter.stats(),
+    }
+
+
+@bitsatcredit_api_router.post(
+    "/api/v1/admin/settings/rate-limits",
+    name="Set Rate Limits",
+    summary="Set invoice requests per minute per npub and per IP (admin only)",
+    response_description="Updated limits",
+    dependencies=[Depends(check_admin)],
+)
+async def api_set_rate_limits(
+    per_npub: int | None = Query(None, ge=0, description="Invoices per minute per npub, 0 disables"),
+    per_ip: int | None = Query(None, ge=0, description="Invoices per minute per client IP, 0 disables"),
+    user: User = Depends(check_user_exists)
+) -> dict:
+    """Admin endpoint to set the invoice rate limits"""
+    from .crud import set_setting
+
+    if per_npub is not None:
+        await set_setting("invoice_limit_per_npub", str(per_npub))
+    if per_ip is not None:
+        await set_setting("invoice_limit_per_ip", str(per_ip))
+    return {**await api_get_rate_limits(), "updated": True}
+
+
 ############################# Admin Actions #############################
 @bitsatcredit_api_router.post(
     "/api/v1/admin/add-credits",
@@ -285,6 +907,61 @@ async def api_admin_add_credits(
     return user_account
 
 
+@bitsatcredit_api_router.post(
+    "/api/v1/admin/add-credits/bulk",
+    name="Admin Bulk Add Credits",
+    summary="Add credits to many users in one transaction (admin only)",
+    response_description="Per-npub results",
+    response_model=list[BulkCreditResult],
+    dependencies=[Depends(check_admin)],
+)
+async def api_admin_bulk_add_credits(
+    data: AdminBulkAddCredits,
+    user: User = Depends(check_user_exists)
+) -> list[BulkCreditResult]:
+    """Admin endpoint to credit a list of npubs, or all (recently active) users"""
+    from .crud import add_credits_batch, get_npubs
+
+    if data.npubs is not None:
+        npubs = data.npubs
+    elif data.all_users or data.active_since is not None:
+        npubs = await get_npubs(data.active_since, limit=MAX_BULK_CREDIT_USERS + 1)
+    else:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, "Give npubs, all_users or active_since")
+
+    if not npubs:
+        return []
+    if len(npubs) > MAX_BULK_CREDIT_USERS:
+        raise HTTPException(
+            HTTPStatus.BAD_REQUEST, f"At most {MAX_BULK_CREDIT_USERS} users per bulk credit"
+        )
+    return await add_credits_batch(npubs, data.amount, data.memo)
+
+
+@bitsatcredit_api_router.post(
+    "/api/v1/admin/import/users",
+    name="Import Users",
+    summary="Import users and balances from a CSV or NDJSON upload (admin only)",
+    response_description="Import report, with the per-user diff on a dry run",
+    dependencies=[Depends(check_admin)],
+)
+async def api_import_users(
+    request: Request,
+    fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+    dry_run: bool = Query(True, description="Only report what would change"),
+    user: User = Depends(check_user_exists)
+) -> dict:
+    """Admin endpoint to migrate users from another credit system.
+
+    The request body is the raw file: CSV with a header row or one JSON
+    object per line, with `npub`, `balance_sats` and optionally
+    `total_spent`, `total_deposited`, `message_count` and `memo`.
+    """
+    from .services import import_users
+
+    return await import_users(iter_lines(request.stream()), fmt=fmt, dry_run=dry_run)
+
+
 @bitsatcredit_api_router.delete(
     "/api/v1/admin/user/{npub}",
     name="Delete User",
@@ -377,7 +1054,26 @@ async def api_set_system_status(
     }
 
 
-############################# Health Check #############################
+@bitsatcredit_api_router.get(
+    "/api/v1/config",
+    name="Get Public Config",
+    summary="Get system status, status message and price in one call (public)",
+    response_description="Public config with version",
+)
+async def api_get_config() -> dict:
+    """Public endpoint combining system status and price, served from memory"""
+    settings = await get_settings()
+    system_status = settings.get("system_status", "online")
+
+    return {
+        "status": system_status,
+        "message": settings.get("status_message", ""),
+        "is_online": system_status == "online",
+        "price_per_message_sats": int(settings.get("price_per_message", "1")),
+        "version": settings_snapshot.version,
+    }
+
+
 ############################# Settings #############################
 @bitsatcredit_api_router.get(
     "/api/v1/settings/price",